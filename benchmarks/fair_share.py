@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Fair-share benchmark.
+#
+# Starts a large job and, once its ERI slices are queued, runs a small job end to end on the same workers (the
+# sequence and stand-ins of benchmarks/orchestration.py). Reports the wall time of the small job, which is bounded
+# by the scheduling of the workers rather than by the large job's backlog when every job's slices have a queue of
+# their own (see shared/bulk_queue.py), and the wall time of the large job. Runs every mode of --modes:
+#
+#   shared    the slices of every job are sent to the task queue (as before the per-job queues)
+#   fair      the slices of every job are sent to the job's own queue
+#   priority  as fair, with one slot of every worker reserved for the task queue
+#
+#   python3 benchmarks/fair_share.py --large_parts 200 --workers 2 --tei_runtime 0.1
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.orchestration import Benchmark  # noqa: E402
+
+# (fair_share, priority_slots) of every mode
+MODES = {'shared': (False, 0), 'fair': (True, 0), 'priority': (True, 1)}
+
+
+def run_mode(mode, args) -> dict:
+    fair_share, priority_slots = MODES[mode]
+    with tempfile.TemporaryDirectory() as root:
+        bench = Benchmark(
+            root, args.basis_size, args.large_parts, args.workers, args.slots, args.iterations, args.runtime,
+            args.tei_runtime, args.output_bytes, fair_share=fair_share, priority_slots=priority_slots)
+        bench.start_workers()
+        try:
+            large_start = time.monotonic()
+            large = threading.Thread(target=bench.job, args=(args.large_parts, 1))
+            large.start()
+            # The small job starts once the large job's fan-out is done
+            while 'fan_out' not in bench.phases and large.is_alive():
+                time.sleep(0.01)
+            small_start = time.monotonic()
+            bench.job(args.small_parts, args.iterations)
+            small = time.monotonic() - small_start
+            large.join()
+            return {'small_job': small, 'large_job': time.monotonic() - large_start}
+        finally:
+            bench.stop_workers()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fair-share benchmark")
+    parser.add_argument('--modes', default='shared,fair,priority')
+    parser.add_argument('--basis_size', type=int, default=40)
+    parser.add_argument('--large_parts', type=int, default=200, help="Slices of the large job")
+    parser.add_argument('--small_parts', type=int, default=2, help="Slices of the small job")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--slots', type=int, default=2, help="Slots per worker")
+    parser.add_argument('--iterations', type=int, default=3, help="Iterations of the small job")
+    parser.add_argument('--runtime', type=float, default=0.0, help="Stub runtime of every step (seconds)")
+    parser.add_argument('--tei_runtime', type=float, default=0.1, help="Stub runtime of an ERI slice (seconds)")
+    parser.add_argument('--output_bytes', type=int, default=4096, help="Size of every stub output")
+    args = parser.parse_args()
+
+    for mode in args.modes.split(','):
+        result = run_mode(mode, args)
+        print(f"{mode:9} small job {result['small_job']:7.3f}s, large job {result['large_job']:7.3f}s")
+
+
+if __name__ == '__main__':
+    main()
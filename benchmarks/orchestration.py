@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# Orchestration overhead benchmark.
+#
+# Runs the sequence of the state machine (info, the parallel one-electron steps and ERI fan-out, the Fock-SCF
+# loop, then deleteJob) with the real Lambda handlers and worker processes, against local stand-ins for S3, SQS,
+# DynamoDB and Step Functions (benchmarks/standins.py) and a stub integrals binary (benchmarks/stub_integrals.py)
+# with a configurable runtime and output size. With --runtime 0 the wall time of a phase is orchestration only
+# (plus starting the stub processes).
+#
+# Sweeps the basis set size, the number of parts, the number of workers and the iteration count, and writes one
+# record per combination to a JSON file. Pass an earlier file with --compare to print the change per phase.
+#
+#   python3 benchmarks/orchestration.py --basis_sizes 10,40 --num_parts 4,32 --workers 1,4 --iterations 3
+import argparse
+import importlib.util
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(REPO_ROOT, 'cdk', 'lambda')
+sys.path[:0] = [REPO_ROOT, os.path.join(LAMBDA_DIR, 'layer', 'python'), os.path.join(LAMBDA_DIR, 'setupTei')]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ca-central-1')
+
+from shared.completion import CompletionTracker, LocalBackend  # noqa: E402
+from shared.result_cache import ResultCache  # noqa: E402
+
+from benchmarks.standins import LocalCloudWatch, LocalDynamo, LocalS3, LocalSession, LocalSfn, LocalSqs  # noqa: E402
+from worker.worker import Worker, WorkerConfig  # noqa: E402
+
+BUCKET = 'bench'
+QUEUE = 'bench-queue'
+STUB = os.path.join(REPO_ROOT, 'benchmarks', 'stub_integrals.py')
+XYZ = "3\nwater\nO 0.000 0.000 0.117\nH 0.000 0.757 -0.467\nH 0.000 -0.757 -0.467\n"
+
+
+# Loads a Lambda handler module and replaces its module-level clients with the stand-ins
+def load_lambda(name, clients):
+    os.environ.update({
+        'ER_S3_BUCKET': BUCKET, 'TASK_QUEUE': QUEUE, 'BATCH_TABLE': 'batch', 'DELETED_JOB_TABLE': 'deleted',
+    })
+    spec = importlib.util.spec_from_file_location(f"bench_{name}", os.path.join(LAMBDA_DIR, name, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for attr, client in clients.items():
+        if hasattr(module, attr):
+            setattr(module, attr, client)
+    return module
+
+
+def distribution(values) -> dict:
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, math.ceil(len(values) * 0.95) - 1)],
+        'max': values[-1],
+    }
+
+
+class Benchmark:
+    # fair_share=False sends the ERI slices to the task queue as before the per-job queues (see shared/bulk_queue.py),
+    # priority_slots is the number of slots of every worker reserved for the task queue and slices_per_message the
+    # number of ERI slices setupTei sends in one message
+    def __init__(self, root, basis_size, num_parts, workers, slots, iterations, runtime, tei_runtime, output_bytes,
+                 fair_share=True, priority_slots=0, slices_per_message=1):
+        self.root = root
+        self.params = {
+            'basis_size': basis_size, 'num_parts': num_parts, 'workers': workers, 'slots': slots,
+            'iterations': iterations, 'runtime': runtime, 'tei_runtime': tei_runtime, 'output_bytes': output_bytes,
+        }
+        self.s3 = LocalS3(os.path.join(root, 's3'))
+        self.sqs = LocalSqs()
+        self.dynamo = LocalDynamo()
+        self.sfn = LocalSfn()
+        self.cloudwatch = LocalCloudWatch()
+        self.tracker = CompletionTracker(LocalBackend())
+        clients = {
+            's3': self.s3, 'sqs': self.sqs, 'dynamo': self.dynamo, 'sfn': self.sfn, 'tracker': self.tracker,
+            'result_cache': ResultCache(self.s3, BUCKET), 'cloudwatch': self.cloudwatch,
+        }
+        self.setup_calculations = load_lambda('setupCalculations', clients)
+        self.setup_tei = load_lambda('setupTei', clients)
+        self.setup_tei.fair_share = fair_share
+        self.setup_tei.slices_per_message = lambda: slices_per_message
+        self.update_loop_variables = load_lambda('updateLoopVariables', clients)
+        self.delete_job = load_lambda('deleteJob', clients)
+        session = LocalSession(sqs=self.sqs, s3=self.s3, stepfunctions=self.sfn, dynamodb=self.dynamo, ecs=None,
+                               cloudwatch=self.cloudwatch)
+        self.workers = []
+        for i in range(workers):
+            config = WorkerConfig(
+                task_queue=QUEUE, batch_table='batch', deleted_job_table='deleted', integrals_path=STUB,
+                work_dir=os.path.join(root, f"worker_{i}"), slots=slots, wait_time_seconds=1, affinity=False,
+                priority_slots=priority_slots, bulk_queues_refresh_seconds=0.5)
+            worker = Worker(config, session=session)
+            worker.tracker = self.tracker
+            self.workers.append(worker)
+        os.environ.update({
+            'BENCH_S3_ROOT': self.s3.root,
+            'BENCH_RUNTIMES': json.dumps({
+                **{step: runtime for step in
+                   ('info', 'core_hamiltonian', 'overlap', 'initial_guess', 'fock_matrix', 'scf_step')},
+                'two_electrons_integrals': tei_runtime,
+            }),
+            'BENCH_OUTPUT_BYTES': str(output_bytes),
+            'BENCH_BASIS_SIZE': str(basis_size),
+        })
+        self.phases = {}
+
+    # Sends a task to the queue the way the state machine does and returns its token
+    def submit(self, state) -> str:
+        token = str(uuid.uuid4())
+        self.sqs.send_message(QueueUrl=QUEUE, MessageBody=json.dumps({'token': token, 'input': {'value': state}}))
+        return token
+
+    def setup(self, state, step):
+        return self.setup_calculations.lambda_handler({**state, 'output': {'stepName': step}}, None)
+
+    # Runs a phase and records its wall time, the queue and task latencies of the messages sent during it and the
+    # bytes moved through S3
+    def phase(self, name, run, tasks=1, runtime=0.0):
+        first_message = len(self.sqs.timings)
+        read, written, requests = self.s3.bytes_read, self.s3.bytes_written, self.s3.requests
+        start = time.monotonic()
+        result = run()
+        wall = time.monotonic() - start
+        timings = list(self.sqs.timings.values())[first_message:]
+        # Best possible wall time of the phase's compute on the available slots
+        ideal = runtime * math.ceil(tasks / (len(self.workers) * self.params['slots']))
+        record = self.phases.setdefault(name, {
+            'runs': 0, 'wall': 0.0, 'ideal_compute': 0.0, 'queue_latency': [], 'task_latency': [],
+            'bytes_read': 0, 'bytes_written': 0, 's3_requests': 0,
+        })
+        record['runs'] += 1
+        record['wall'] += wall
+        record['ideal_compute'] += ideal
+        record['queue_latency'] += [t['received'] - t['sent'] for t in timings if t['received']]
+        record['task_latency'] += [t['deleted'] - t['sent'] for t in timings if t.get('deleted')]
+        record['bytes_read'] += self.s3.bytes_read - read
+        record['bytes_written'] += self.s3.bytes_written - written
+        record['s3_requests'] += self.s3.requests - requests
+        return result
+
+    def start_workers(self):
+        self.threads = [threading.Thread(target=worker.run, daemon=True) for worker in self.workers]
+        for thread in self.threads:
+            thread.start()
+
+    def stop_workers(self):
+        for worker in self.workers:
+            worker.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    # Runs one job through the whole sequence, its phases are added to the phase records
+    def job(self, num_parts, iterations):
+        jobid = str(uuid.uuid4())
+        xyz_path = os.path.join(self.root, f"{jobid}.xyz")
+        with open(xyz_path, 'w') as f:
+            f.write(XYZ)
+        p = self.params
+        state = {
+            'commands': ['info', '--xyz', f"file://{xyz_path}", '--basis_set', 'sto-3g'],
+            's3_bucket_path': f"s3://{BUCKET}/job_files/{jobid}/json_files/{jobid}_info.json",
+            'num_batch_jobs': num_parts,
+            'jobid': jobid,
+            'batch_execution': 'true',
+            'max_iter': iterations,
+            'epsilon': 0,
+            'fused_scf': 'false',
+            'result_cache': 'false',
+        }
+        state = self.phase('info', lambda: self.sfn.wait(self.submit(state), 600), runtime=p['runtime'])
+
+        def parallel():
+            tokens = [self.submit(self.setup(state, 'one_electron'))]
+            tei_token = str(uuid.uuid4())
+            fan_out_start = time.monotonic()
+            self.setup_tei.lambda_handler({'payload': state, 'task_token': tei_token}, None)
+            self.phases['fan_out'] = {'wall': time.monotonic() - fan_out_start}
+            outputs = [self.sfn.wait(token, 600) for token in tokens + [tei_token]]
+            return {
+                **{key: outputs[0][key] for key in (
+                    'commands', 's3_bucket_path', 'jobid', 'max_iter', 'epsilon', 'diis', 'diis_epsilon')},
+                'fused_scf': 'false',
+                'eri_prefix': outputs[1]['eri_prefix'],
+                'loopData': {'loopCount': 1, 'hartree_diff': sys.float_info.max},
+            }
+        state = self.phase(
+            'parallel', parallel, tasks=1 + num_parts, runtime=max(3 * p['runtime'], p['tei_runtime']))
+
+        def iteration(state):
+            for step in ('fock_matrix', 'scf_step'):
+                state = self.sfn.wait(self.submit(self.setup(state, step)), 600)
+            return self.update_loop_variables.lambda_handler(state, None)
+        while state['loopData']['loopCount'] <= int(state['max_iter']):
+            state = self.phase('iteration', lambda: iteration(state), tasks=1, runtime=2 * p['runtime'])
+        self.phase('delete_job', lambda: self.delete_job.lambda_handler({'jobid': jobid}, None))
+
+    def run(self) -> dict:
+        p = self.params
+        self.start_workers()
+        start = time.monotonic()
+        try:
+            self.job(p['num_parts'], p['iterations'])
+        finally:
+            self.stop_workers()
+        total = time.monotonic() - start
+        phases = {}
+        for name, record in self.phases.items():
+            phases[name] = {
+                key: distribution(value) if isinstance(value, list) else value for key, value in record.items()
+            }
+            if 'ideal_compute' in record:
+                phases[name]['overhead'] = record['wall'] - record['ideal_compute']
+        return {
+            'params': p,
+            'total_wall': total,
+            'phases': phases,
+            'bytes_read': self.s3.bytes_read,
+            'bytes_written': self.s3.bytes_written,
+            's3_requests': self.s3.requests,
+            'sqs_requests': self.sqs.requests,
+            'dynamo_requests': self.dynamo.requests,
+        }
+
+
+def parse_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+# Prints the change of the total and per-phase wall times against an earlier result file, matching runs by params
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {json.dumps(run['params'], sort_keys=True): run for run in json.load(f)['runs']}
+    for run in results['runs']:
+        old = baseline.get(json.dumps(run['params'], sort_keys=True))
+        if old is None:
+            continue
+        print(f"{run['params']}")
+        rows = [('total', old['total_wall'], run['total_wall'])] + [
+            (name, old['phases'][name]['wall'], phase['wall'])
+            for name, phase in run['phases'].items() if name in old['phases']
+        ]
+        for name, before, after in rows:
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"  {name:12} {before:9.3f}s -> {after:9.3f}s ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Orchestration overhead benchmark")
+    parser.add_argument('--basis_sizes', type=parse_list, default=[10, 40])
+    parser.add_argument('--num_parts', type=parse_list, default=[4, 32])
+    parser.add_argument('--workers', type=parse_list, default=[1, 4])
+    parser.add_argument('--iterations', type=parse_list, default=[3])
+    parser.add_argument('--slots', type=int, default=2, help="Slots per worker")
+    parser.add_argument('--runtime', type=float, default=0.0, help="Stub runtime of every step (seconds)")
+    parser.add_argument('--tei_runtime', type=float, default=0.0, help="Stub runtime of an ERI slice (seconds)")
+    parser.add_argument('--output_bytes', type=int, default=4096, help="Size of every stub output")
+    parser.add_argument('--slices_per_message', type=int, default=1, help="ERI slices sent in one message")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="Earlier result file to compare with")
+    args = parser.parse_args()
+
+    commit = subprocess.run(
+        ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    results = {'commit': commit, 'created': datetime.now(timezone.utc).isoformat(), 'runs': []}
+    for basis_size, num_parts, workers, iterations in itertools.product(
+            args.basis_sizes, args.num_parts, args.workers, args.iterations):
+        with tempfile.TemporaryDirectory() as root:
+            run = Benchmark(
+                root, basis_size, num_parts, workers, args.slots, iterations, args.runtime, args.tei_runtime,
+                args.output_bytes, slices_per_message=args.slices_per_message).run()
+        results['runs'].append(run)
+        phases = run['phases']
+        print(f"basis_size={basis_size} num_parts={num_parts} workers={workers} iterations={iterations}: "
+              f"total {run['total_wall']:.3f}s, fan-out {phases['fan_out']['wall']:.3f}s, "
+              f"parallel {phases['parallel']['wall']:.3f}s "
+              f"(queue p95 {phases['parallel']['queue_latency'].get('p95', 0):.3f}s), "
+              f"iteration {phases['iteration']['wall'] / phases['iteration']['runs']:.3f}s")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
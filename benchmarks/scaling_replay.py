@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Scaling replay.
+#
+# Replays a trace of jobs on a simulated worker service, scaled either by the queue depth step policy of the
+# Fargate service (cdk-stack.ts) alone or together with the decisions of shared/scaling.py as the scaleWorkers Lambda
+# makes them.
+# Every job queues its ERI slices at its start and then runs its loop iterations one after the other. New workers
+# take --startup seconds to receive tasks, and workers are only stopped when idle (task protection). Reports the
+# duration of every job, the time the last job ends and the worker hours of every mode.
+#
+# A trace is a JSON list of jobs: {"start", "slices", "slice_seconds", "iterations", "iteration_seconds"}.
+#
+#   python3 benchmarks/scaling_replay.py --trace trace.json --startup 90
+import argparse
+import json
+import math
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'cdk', 'lambda', 'layer', 'python'))
+
+from shared.scaling import DEFAULT_TASK_SECONDS, Demand, Service, desired_counts, desired_slots  # noqa: E402
+
+# A large job, a small job arriving during its slices and a burst of short slices
+DEFAULT_TRACE = [
+    {'start': 0, 'slices': 400, 'slice_seconds': 20, 'iterations': 15, 'iteration_seconds': 10},
+    {'start': 120, 'slices': 20, 'slice_seconds': 20, 'iterations': 15, 'iteration_seconds': 10},
+    {'start': 1500, 'slices': 2000, 'slice_seconds': 5, 'iterations': 10, 'iteration_seconds': 10},
+]
+# Steps of the queue depth policy of the Fargate service: (lower bound of the queue depth, change)
+STEP_POLICY = [(100, 5), (30, 1), (10, 0)]
+
+
+@dataclass
+class Job:
+    start: float
+    slices: int
+    slice_seconds: float
+    iterations: int
+    iteration_seconds: float
+    queued: int = 0
+    running: int = 0
+    iteration: int = 0
+    loop_running: bool = False
+    end: float = None
+
+    @property
+    def in_loop(self) -> bool:
+        return self.end is None and self.slices == 0 and self.queued == 0 and self.running == 0
+
+
+@dataclass
+class Worker:
+    ready_at: float
+    # End time and job of the task of every busy slot
+    busy: List[tuple] = field(default_factory=list)
+
+
+class Simulation:
+    def __init__(self, trace, mode, service: Service, startup, drain):
+        self.jobs = [Job(**job) for job in sorted(trace, key=lambda job: job['start'])]
+        self.mode = mode
+        self.service = service
+        self.startup = startup
+        self.drain = drain
+        self.workers: List[Worker] = []
+        self.worker_seconds = 0.0
+        self.slice_durations: List[float] = []
+        self.sampled_depth = 0
+        # Minimum capacity the scaler set in predictive mode
+        self.minimum = service.min_count
+
+    def started(self, t):
+        return [job for job in self.jobs if job.start <= t]
+
+    def depth(self, t) -> int:
+        jobs = [job for job in self.started(t) if job.end is None]
+        return sum(job.queued for job in jobs) + sum(job.in_loop and not job.loop_running for job in jobs)
+
+    def step(self, t):
+        for job in self.jobs:
+            if job.start == t:
+                job.queued, job.slices = job.slices, 0
+                if self.mode == 'predictive':
+                    # setupTei invokes the scaler before it sends the slices
+                    self.scale(t, policy=False)
+        for worker in self.workers:
+            for end, job, kind in [task for task in worker.busy if task[0] <= t]:
+                worker.busy.remove((end, job, kind))
+                if kind == 'slice':
+                    job.running -= 1
+                else:
+                    job.loop_running = False
+                    job.iteration += 1
+                    if job.iteration == job.iterations:
+                        job.end = t
+        self.assign(t)
+        if t % 60 == 0:
+            self.scale(t)
+            self.sampled_depth = self.depth(t)
+        self.worker_seconds += len(self.workers)
+
+    # Free slots take the loop tasks first, then the slices of the jobs in turn
+    def assign(self, t):
+        for worker in self.workers:
+            if worker.ready_at > t:
+                continue
+            while len(worker.busy) < self.service.slots:
+                loop = [job for job in self.started(t) if job.in_loop and not job.loop_running]
+                waiting = [job for job in self.started(t) if job.queued]
+                if loop:
+                    job = loop[0]
+                    job.loop_running = True
+                    worker.busy.append((t + job.iteration_seconds, job, 'loop'))
+                elif waiting:
+                    job = min(waiting, key=lambda job: job.running)
+                    job.queued -= 1
+                    job.running += 1
+                    self.slice_durations.append(job.slice_seconds)
+                    worker.busy.append((t + job.slice_seconds, job, 'slice'))
+                else:
+                    break
+
+    # change of the queue depth step policy, from the queue depth sampled by the alarms the minute before
+    def policy_change(self) -> int:
+        for lower, step in STEP_POLICY:
+            if self.sampled_depth >= lower:
+                return step
+        return -1
+
+    # policy is False when setupTei invokes the scaler, the step policy only runs every minute
+    def scale(self, t, policy=True):
+        count = len(self.workers)
+        if self.mode == 'reactive':
+            desired = count + self.policy_change()
+        else:
+            jobs = [job for job in self.started(t) if job.end is None]
+            demand = Demand(
+                critical=sum(job.loop_running or job.in_loop for job in jobs), planned=0,
+                bulk=sum(job.queued + job.running for job in jobs), loop_jobs=sum(job.in_loop for job in jobs))
+            task_seconds = (
+                sum(self.slice_durations) / len(self.slice_durations) if self.slice_durations
+                else DEFAULT_TASK_SECONDS)
+            slots = desired_slots(demand, task_seconds, count * self.service.slots, self.drain, self.startup)
+            planned = desired_counts([self.service], slots)[self.service.name]
+            # The scaler raises the minimum capacity while slices are queued and the desired count, the step policy
+            # scales beyond them and scales in
+            self.minimum = max(self.minimum, planned) if demand.bulk else self.service.min_count
+            desired = max(count + self.policy_change() if policy else count, planned, self.minimum)
+        desired = min(self.service.max_count, max(self.service.min_count, desired))
+        if desired > count:
+            self.workers += [Worker(ready_at=t + self.startup) for _ in range(desired - count)]
+        elif desired < count:
+            # Workers that are starting or idle are stopped, busy ones are protected
+            idle = sorted((w for w in self.workers if not w.busy), key=lambda w: -w.ready_at)[:count - desired]
+            self.workers = [w for w in self.workers if w not in idle]
+
+    def run(self) -> dict:
+        t = 0
+        while any(job.end is None for job in self.jobs):
+            self.step(t)
+            t += 1
+        return {
+            'jobs': [job.end - job.start for job in self.jobs],
+            'end': max(job.end for job in self.jobs),
+            'worker_hours': self.worker_seconds / 3600,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling replay")
+    parser.add_argument('--trace', help="JSON trace of jobs (a built-in trace by default)")
+    parser.add_argument('--modes', default='reactive,predictive')
+    parser.add_argument('--max_count', type=int, default=20, help="Maximum number of workers")
+    parser.add_argument('--slots', type=int, default=2, help="Slots per worker")
+    parser.add_argument('--startup', type=float, default=90, help="Seconds until a new worker receives tasks")
+    parser.add_argument('--drain', type=float, default=300, help="DRAIN_SECONDS of the scaleWorkers Lambda")
+    args = parser.parse_args()
+
+    trace = DEFAULT_TRACE
+    if args.trace:
+        with open(args.trace) as f:
+            trace = json.load(f)
+    service = Service('workers', 0, args.max_count, args.slots)
+    for mode in args.modes.split(','):
+        result = Simulation(trace, mode, service, args.startup, args.drain).run()
+        jobs = ', '.join(f"{math.ceil(duration)}s" for duration in result['jobs'])
+        print(f"{mode:10} jobs {jobs}, last job ends at {result['end']}s, {result['worker_hours']:.2f} worker hours")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,453 @@
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+
+class ClientError(Exception):
+    pass
+
+
+# Directory-backed stand-in for the S3 calls made by the Lambdas and the worker. Objects are files under
+# <root>/<bucket>/<key>. Counts the bytes read and written.
+class LocalS3:
+    class exceptions:
+        NoSuchKey = type('NoSuchKey', (ClientError,), {})
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.requests = 0
+
+    def path(self, bucket, key) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def count(self, read=0, written=0):
+        with self.lock:
+            self.requests += 1
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def get_object(self, Bucket, Key, **kwargs):
+        try:
+            with open(self.path(Bucket, Key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise self.exceptions.NoSuchKey(Key)
+        if 'Range' in kwargs:
+            start, end = kwargs['Range'][len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        self.count(read=len(data))
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body if isinstance(Body, bytes) else Body.encode()
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.count(written=len(data))
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': os.path.getsize(self.path(Bucket, Key))}
+
+    def copy(self, source, bucket, key):
+        os.makedirs(os.path.dirname(self.path(bucket, key)), exist_ok=True)
+        shutil.copyfile(self.path(source['Bucket'], source['Key']), self.path(bucket, key))
+        self.count()
+
+    def download_file(self, bucket, key, path):
+        shutil.copyfile(self.path(bucket, key), path)
+        self.count(read=os.path.getsize(path))
+
+    def upload_file(self, path, bucket, key):
+        os.makedirs(os.path.dirname(self.path(bucket, key)), exist_ok=True)
+        shutil.copyfile(path, self.path(bucket, key))
+        self.count(written=os.path.getsize(path))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(Fileobj, f)
+        self.count(written=os.path.getsize(path))
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            try:
+                os.remove(self.path(Bucket, obj['Key']))
+            except FileNotFoundError:
+                pass
+        self.count()
+        return {}
+
+    def get_paginator(self, name):
+        return LocalPaginator(self)
+
+
+class LocalPaginator:
+    def __init__(self, s3: LocalS3):
+        self.s3 = s3
+
+    # Lists the keys under Prefix in pages of 1000, like list_objects_v2
+    def paginate(self, Bucket, Prefix='', **kwargs):
+        root = os.path.join(self.s3.root, Bucket)
+        keys = []
+        for directory, _, files in os.walk(root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), root)
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+        for i in range(0, max(len(keys), 1), 1000):
+            self.s3.count()
+            yield {'Contents': [
+                {'Key': key, 'Size': os.path.getsize(os.path.join(root, key))} for key in keys[i:i + 1000]
+            ]}
+
+
+# In-memory SQS queue with visibility timeouts and long polling. Records when each message was sent and first
+# received, which gives the queue latency of a task.
+class LocalSqs:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queues: Dict[str, List[dict]] = {}
+        # message id -> {'sent': time, 'received': time of first receive, 'deleted': time the task finished}
+        self.timings: Dict[str, dict] = {}
+        self.requests = 0
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        message_id = str(uuid.uuid4())
+        with self.condition:
+            self.requests += 1
+            self.queues.setdefault(QueueUrl, []).append({
+                'MessageId': message_id,
+                'Body': MessageBody,
+                'MessageAttributes': MessageAttributes or {},
+                'visible_at': 0.0,
+                'receipt': None,
+                'sent_timestamp': str(int(time.time() * 1000)),
+            })
+            self.timings[message_id] = {'sent': time.monotonic(), 'received': None}
+            self.condition.notify_all()
+        return {'MessageId': message_id}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        for entry in Entries:
+            self.send_message(QueueUrl, entry['MessageBody'], entry.get('MessageAttributes'))
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30, **kwargs):
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self.condition:
+            self.requests += 1
+            while True:
+                now = time.monotonic()
+                visible = [m for m in self.queues.get(QueueUrl, []) if m['visible_at'] <= now]
+                if visible or now >= deadline:
+                    break
+                self.condition.wait(min(deadline - now, 0.05))
+            messages = []
+            for message in visible[:MaxNumberOfMessages]:
+                message['visible_at'] = now + VisibilityTimeout
+                message['receipt'] = str(uuid.uuid4())
+                timing = self.timings[message['MessageId']]
+                timing['received'] = timing['received'] or now
+                messages.append({
+                    'MessageId': message['MessageId'],
+                    'ReceiptHandle': message['receipt'],
+                    'Body': message['Body'],
+                    'MessageAttributes': message['MessageAttributes'],
+                    'Attributes': {'SentTimestamp': message['sent_timestamp']},
+                })
+        return {'Messages': messages}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self.condition:
+            self.requests += 1
+            queue = self.queues.get(QueueUrl, [])
+            for message in queue:
+                if message['receipt'] == ReceiptHandle:
+                    self.timings[message['MessageId']]['deleted'] = time.monotonic()
+            queue[:] = [m for m in queue if m['receipt'] != ReceiptHandle]
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        with self.condition:
+            self.requests += 1
+            receipts = {entry['ReceiptHandle'] for entry in Entries}
+            queue = self.queues.get(QueueUrl, [])
+            queue[:] = [m for m in queue if m['receipt'] not in receipts]
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def create_queue(self, QueueName, **kwargs):
+        url = f"https://sqs.local/000000000000/{QueueName}"
+        with self.condition:
+            self.requests += 1
+            self.queues.setdefault(url, [])
+        return {'QueueUrl': url}
+
+    def list_queues(self, QueueNamePrefix='', **kwargs):
+        with self.condition:
+            self.requests += 1
+            return {'QueueUrls': [url for url in self.queues if url.rsplit('/', 1)[-1].startswith(QueueNamePrefix)]}
+
+    def delete_queue(self, QueueUrl):
+        with self.condition:
+            self.requests += 1
+            self.queues.pop(QueueUrl, None)
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        with self.condition:
+            self.requests += 1
+            now = time.monotonic()
+            visible = sum(m['visible_at'] <= now for m in self.queues.get(QueueUrl, []))
+            total = len(self.queues.get(QueueUrl, []))
+        return {'Attributes': {
+            'ApproximateNumberOfMessages': str(visible), 'ApproximateNumberOfMessagesNotVisible': str(total - visible),
+        }}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        with self.condition:
+            self.requests += 1
+            receipts = {entry['ReceiptHandle']: entry['VisibilityTimeout'] for entry in Entries}
+            for message in self.queues.get(QueueUrl, []):
+                if message['receipt'] in receipts:
+                    message['visible_at'] = time.monotonic() + receipts[message['receipt']]
+        return {}
+
+
+class ConditionalCheckFailedException(ClientError):
+    pass
+
+
+# Evaluates the condition and filter expressions used with the tables: attribute_exists, attribute_not_exists and
+# begins_with, comparisons with =, < and >, AND, OR and parentheses
+class Expression:
+    TOKEN = re.compile(r"\s*(\(|\)|,|=|<|>|[#:]?\w+)")
+
+    def __init__(self, text, names=None, values=None):
+        self.tokens = self.TOKEN.findall(text)
+        self.names = names or {}
+        self.values = values or {}
+        self.position = 0
+
+    def evaluate(self, item) -> bool:
+        self.position = 0
+        return self.disjunction(item)
+
+    def next(self) -> str:
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def disjunction(self, item) -> bool:
+        result = self.conjunction(item)
+        while self.peek() == 'OR':
+            self.next()
+            result = self.conjunction(item) or result
+        return result
+
+    def conjunction(self, item) -> bool:
+        result = self.term(item)
+        while self.peek() == 'AND':
+            self.next()
+            result = self.term(item) and result
+        return result
+
+    def term(self, item) -> bool:
+        token = self.next()
+        if token == '(':
+            result = self.disjunction(item)
+            self.next()
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists', 'begins_with'):
+            self.next()
+            arguments = [self.operand(item)]
+            while self.next() == ',':
+                arguments.append(self.operand(item))
+            if token == 'begins_with':
+                return arguments[0] is not None and arguments[0].startswith(arguments[1])
+            return (arguments[0] is not None) == (token == 'attribute_exists')
+        self.position -= 1
+        left, operator, right = self.operand(item), self.next(), self.operand(item)
+        if left is None:
+            return False
+        return {'=': left == right, '<': left < right, '>': left > right}[operator]
+
+    # Value of an attribute of the item or of a placeholder, numbers as floats
+    def operand(self, item):
+        token = self.next()
+        if token.startswith(':'):
+            value = self.values[token]
+        else:
+            value = item.get(self.names.get(token, token))
+        if value is None:
+            return None
+        if 'N' in value:
+            return float(value['N'])
+        if 'NS' in value:
+            return frozenset(float(v) for v in value['NS'])
+        return value['S']
+
+
+# In-memory DynamoDB tables keyed by jobid, with the conditional writes, set updates, scans and batch deletes used by
+# the completion tracker, the affinity registry, the plans of shared/scaling.py and the deleted-job table. Every
+# call is atomic, as single item writes are.
+class LocalDynamo:
+    class exceptions:
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables: Dict[str, Dict[str, dict]] = {}
+        self.requests = 0
+
+    # Items of a table by key, created on first use
+    def table(self, name) -> Dict[str, dict]:
+        return self.tables.setdefault(name, {})
+
+    def check(self, item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        condition = Expression(ConditionExpression or '', ExpressionAttributeNames, ExpressionAttributeValues)
+        if ConditionExpression and not condition.evaluate(item or {}):
+            raise ConditionalCheckFailedException()
+
+    def put_item(self, TableName, Item, **kwargs):
+        with self.lock:
+            self.requests += 1
+            items = self.table(TableName)
+            self.check(items.get(Item['jobid']['S']), **kwargs)
+            items[Item['jobid']['S']] = dict(Item)
+
+    # Supports the SET #attr = :value and DELETE #attr :value updates of shared/completion.py
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                    ReturnValues=None, **kwargs):
+        with self.lock:
+            self.requests += 1
+            items = self.table(TableName)
+            item = items.get(Key['jobid']['S'])
+            self.check(item, ExpressionAttributeNames=ExpressionAttributeNames,
+                       ExpressionAttributeValues=ExpressionAttributeValues, **kwargs)
+            item = item if item is not None else dict(Key)
+            action, name, value = UpdateExpression.replace('=', ' ').split()
+            attribute, value = ExpressionAttributeNames.get(name, name), ExpressionAttributeValues[value]
+            if action == 'DELETE':
+                remaining = set(item.get(attribute, {}).get('NS', [])) - set(value['NS'])
+                if remaining:
+                    item[attribute] = {'NS': sorted(remaining)}
+                else:
+                    item.pop(attribute, None)
+            else:
+                item[attribute] = value
+            items[Key['jobid']['S']] = item
+            return {'Attributes': dict(item)}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        with self.lock:
+            self.requests += 1
+            items = self.table(TableName)
+            self.check(items.get(Key['jobid']['S']), **kwargs)
+            items.pop(Key['jobid']['S'], None)
+
+    def get_item(self, TableName, Key, **kwargs):
+        with self.lock:
+            self.requests += 1
+            item = self.table(TableName).get(Key['jobid']['S'])
+            return {'Item': dict(item)} if item else {}
+
+    # Supports the query of a single key (KeyConditionExpression='jobid = :id')
+    def query(self, TableName, ExpressionAttributeValues, **kwargs):
+        with self.lock:
+            self.requests += 1
+            return {'Count': int(ExpressionAttributeValues[':id']['S'] in self.table(TableName))}
+
+    def batch_write_item(self, RequestItems):
+        with self.lock:
+            self.requests += 1
+            for table, requests in RequestItems.items():
+                assert len(requests) <= 25
+                for request in requests:
+                    self.table(table).pop(request['DeleteRequest']['Key']['jobid']['S'], None)
+        return {}
+
+    def get_paginator(self, name):
+        return self
+
+    # The scan paginator: one page with the items that pass the filter
+    def paginate(self, TableName, FilterExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ProjectionExpression=None, **kwargs):
+        condition = Expression(FilterExpression or '', ExpressionAttributeNames, ExpressionAttributeValues)
+        with self.lock:
+            self.requests += 1
+            items = [dict(item) for item in self.table(TableName).values()
+                     if not FilterExpression or condition.evaluate(item)]
+        if ProjectionExpression:
+            names = [name.strip() for name in ProjectionExpression.split(',')]
+            items = [{name: item[name] for name in names if name in item} for item in items]
+        yield {'Items': items}
+
+
+# Stand-in for CloudWatch that keeps the last value published for every metric (the mean of a statistic set)
+class LocalCloudWatch:
+    def __init__(self):
+        self.metrics: Dict[str, float] = {}
+
+    def put_metric_data(self, Namespace, MetricData):
+        for datum in MetricData:
+            name = '/'.join([Namespace, datum['MetricName']] + [d['Value'] for d in datum.get('Dimensions', [])])
+            if 'StatisticValues' in datum:
+                stats = datum['StatisticValues']
+                self.metrics[name] = stats['Sum'] / stats['SampleCount']
+            else:
+                self.metrics[name] = datum['Value']
+
+    def get_metric_statistics(self, Namespace, MetricName, Dimensions, **kwargs):
+        name = '/'.join([Namespace, MetricName] + [d['Value'] for d in Dimensions])
+        if name not in self.metrics:
+            return {'Datapoints': []}
+        return {'Datapoints': [{'SampleCount': 1.0, 'Sum': self.metrics[name]}]}
+
+
+# Stand-in for the task token callbacks of Step Functions. wait() blocks until a task reports back.
+class LocalSfn:
+    def __init__(self):
+        self.condition = threading.Condition()
+        # token -> (succeeded, output or cause, time)
+        self.results: Dict[str, tuple] = {}
+
+    def send_task_success(self, taskToken, output):
+        with self.condition:
+            self.results.setdefault(taskToken, (True, json.loads(output), time.monotonic()))
+            self.condition.notify_all()
+
+    def send_task_failure(self, taskToken, cause='', **kwargs):
+        with self.condition:
+            self.results.setdefault(taskToken, (False, cause, time.monotonic()))
+            self.condition.notify_all()
+
+    def wait(self, token, timeout: Optional[float] = None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: token in self.results, timeout):
+                raise TimeoutError(f"Task {token} did not report back")
+            succeeded, result, _ = self.results[token]
+        if not succeeded:
+            raise Exception(f"Task {token} failed: {result}")
+        return result
+
+
+# Returns the stand-in clients in place of boto3 (Worker(config, session=LocalSession(...)))
+class LocalSession:
+    def __init__(self, **clients):
+        self.clients = clients
+
+    def client(self, service, config=None):
+        return self.clients[service]
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# Stand-in for the integrals binary used by the orchestration benchmark. Sleeps for the configured runtime of the
+# sub-command and writes an output of the configured size where the real binary would.
+#
+# BENCH_S3_ROOT      directory of the local S3 stand-in (--output_object is written to <root>/<bucket>/<key>)
+# BENCH_RUNTIMES     JSON object of sub-command -> seconds (two_electrons_integrals is per slice)
+# BENCH_OUTPUT_BYTES size of every binary output
+# BENCH_BASIS_SIZE   basis_set_instance_size reported by info
+import json
+import os
+import sys
+import time
+
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+
+def main():
+    step = sys.argv[1]
+    args = dict(zip(sys.argv[2::2], sys.argv[3::2]))
+    runtimes = json.loads(os.environ.get('BENCH_RUNTIMES', '{}'))
+    size = int(os.environ.get('BENCH_OUTPUT_BYTES', 1024))
+    time.sleep(float(runtimes.get(step, 0)))
+    output = {'success': True}
+    if step == 'info':
+        output['basis_set_instance_size'] = int(os.environ.get('BENCH_BASIS_SIZE', 10))
+    elif step == 'scf_step':
+        # Energy halves its distance to -1 every iteration, so the loop runs until max_iter with epsilon 0
+        iteration = int(args['--output_object'].rsplit('_', 1)[-1].split('.')[0]) if '--output_object' in args else 0
+        output['hartree_fock_energy'] = -1.0 - 0.5 ** (iteration + 1)
+    if '--output_object' in args:
+        write(os.path.join(os.environ['BENCH_S3_ROOT'], args['--bucket'], args['--output_object']), size)
+    elif args.get('--output_url', '').startswith('file://'):
+        write(args['--output_url'][len('file://'):], size)
+    print(json.dumps(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,21 @@
 import json
 import boto3
 import os
+import time
+
+from shared.bulk_queue import delete_job_queues
+from shared.completion import CompletionTracker, DynamoBackend
+from shared.scaling import delete_plan
 
 dynamo = boto3.client("dynamodb")
+sqs = boto3.client("sqs")
 
 deleted_job_table = os.environ["DELETED_JOB_TABLE"]
 batch_table = os.environ["BATCH_TABLE"]
+tracker = CompletionTracker(DynamoBackend(dynamo, batch_table))
+# Deleted jobs are forgotten after the longest time their messages can stay in the task queue (SQS keeps messages
+# for at most 14 days), which keeps the table the workers read small
+DELETED_JOB_TTL = 14 * 24 * 3600
 
 
 def verify_inputs(event):
@@ -20,9 +30,13 @@ def lambda_handler(event, context):
         TableName=deleted_job_table,
         Item={
             "jobid": {"S": jobid},
+            "expires": {"N": str(int(time.time()) + DELETED_JOB_TTL)},
         },
     )
-    dynamo.delete_item(TableName=batch_table, Key={"jobid": {"S": jobid}})
+    tracker.delete_attempts(jobid)
+    # The queued slices of the job are dropped with its queues
+    delete_job_queues(sqs, jobid)
+    delete_plan(dynamo, batch_table, jobid)
     return {
         "statusCode": 200,
         "headers": {"Content-Type": "application/json"},
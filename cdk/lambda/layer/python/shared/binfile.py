@@ -0,0 +1,175 @@
+import io
+import os
+import struct
+import zlib
+from typing import Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+# Compressed .bin objects start with MAGIC followed by the codec id and the shuffle element size. Objects without
+# it are stored raw, so objects written before compression existed (or with compression off) are read unchanged.
+MAGIC = b'\x89BINZ\r\n\x1a'
+HEADER = struct.Struct('<8sBB6x')
+# Every frame is its compressed and raw length followed by the compressed bytes, a zero-length frame ends the object
+FRAME = struct.Struct('<II')
+CODECS = {'zlib': 1, 'zstd': 2}
+# Raw bytes per frame, frames are compressed independently so objects are written and read as streams
+FRAME_BYTES = 8 * 1024 * 1024
+# Matrices and ERI shards are arrays of doubles
+ELEMENT_SIZE = 8
+
+
+class BinFormatError(Exception):
+    pass
+
+
+# Codec used when none is configured: zstd when the zstandard module is installed, zlib otherwise
+def default_codec() -> str:
+    return 'zstd' if zstandard is not None else 'zlib'
+
+
+# Byte shuffle: the i-th bytes of all elements are stored together. The sign/exponent bytes of neighbouring doubles
+# are mostly equal, which makes them compress far better than the interleaved values. A trailing partial element
+# is left in place.
+def shuffle(data: bytes, size=ELEMENT_SIZE) -> bytes:
+    whole = len(data) - len(data) % size
+    return b''.join(data[i:whole:size] for i in range(size)) + data[whole:]
+
+
+def unshuffle(data: bytes, size=ELEMENT_SIZE) -> bytes:
+    whole = len(data) - len(data) % size
+    count = whole // size
+    out = bytearray(len(data))
+    for i in range(size):
+        out[i:whole:size] = data[i * count:(i + 1) * count]
+    out[whole:] = data[whole:]
+    return bytes(out)
+
+
+def compressor(codec, level: Optional[int]):
+    if codec == 'zlib':
+        return lambda data: zlib.compress(data, 1 if level is None else level)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise BinFormatError("The zstd codec needs the zstandard module")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress
+    raise BinFormatError(f"Unknown codec {codec}")
+
+
+def decompressor(codec_id):
+    if codec_id == CODECS['zlib']:
+        return zlib.decompress
+    if codec_id == CODECS['zstd']:
+        if zstandard is None:
+            raise BinFormatError("The object is compressed with zstd, install the zstandard module to read it")
+        return zstandard.ZstdDecompressor().decompress
+    raise BinFormatError(f"Unknown codec id {codec_id}")
+
+
+# Encodes the contents of a raw file object frame by frame
+def encode(source, codec, level: Optional[int] = None) -> Iterator[bytes]:
+    compress = compressor(codec, level)
+    yield HEADER.pack(MAGIC, CODECS[codec], ELEMENT_SIZE)
+    for chunk in iter(lambda: source.read(FRAME_BYTES), b''):
+        data = compress(shuffle(chunk))
+        yield FRAME.pack(len(data), len(chunk)) + data
+    yield FRAME.pack(0, 0)
+
+
+def read_exactly(read, size) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = read(size - len(data))
+        if not chunk:
+            raise BinFormatError("Truncated object")
+        data += chunk
+    return bytes(data)
+
+
+# Decodes an object read through read(n), raw objects are passed through unchanged
+def decode(read) -> Iterator[bytes]:
+    head = read(HEADER.size)
+    while len(head) < HEADER.size:
+        chunk = read(HEADER.size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    if len(head) < HEADER.size or not head.startswith(MAGIC):
+        yield head
+        yield from iter(lambda: read(FRAME_BYTES), b'')
+        return
+    _, codec_id, size = HEADER.unpack(head)
+    decompress = decompressor(codec_id)
+    while True:
+        compressed, raw = FRAME.unpack(read_exactly(read, FRAME.size))
+        if compressed == 0:
+            return
+        data = unshuffle(decompress(read_exactly(read, compressed)), size)
+        if len(data) != raw:
+            raise BinFormatError("Corrupt frame")
+        yield data
+
+
+# Readable file object over an iterator of byte strings, for upload_fileobj
+class IteratorReader(io.RawIOBase):
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.buffer = b''
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, target) -> int:
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = chunk
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.position += size
+        return size
+
+
+# Uploads a local file, compressed with codec (None uploads it raw). The compressed stream is sent as a multipart
+# upload while it is produced, without a compressed copy on disk. Returns the number of bytes sent.
+def upload(s3, path, bucket, key, codec: Optional[str] = None) -> int:
+    if codec is None:
+        s3.upload_file(path, bucket, key)
+        return os.path.getsize(path)
+    with open(path, 'rb') as source:
+        reader = IteratorReader(encode(source, codec))
+        s3.upload_fileobj(io.BufferedReader(reader, FRAME_BYTES), bucket, key)
+        return reader.position
+
+
+# Downloads an object to a local file, decompressing it while it is read. The file only appears once complete.
+# Returns the number of bytes received.
+def download(s3, bucket, key, path) -> int:
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    received = 0
+
+    def read(size):
+        nonlocal received
+        data = body.read(size)
+        received += len(data)
+        return data
+
+    decode_to_file(read, path)
+    return received
+
+
+# Writes the decoded object read through read(n) to path, the file only appears once complete
+def decode_to_file(read, path):
+    with open(f"{path}.part", 'wb') as target:
+        for data in decode(read):
+            target.write(data)
+    os.replace(f"{path}.part", path)
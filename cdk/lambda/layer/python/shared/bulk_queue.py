@@ -0,0 +1,68 @@
+# The ERI slices of a job are sent to a queue of the job's own (created by setupTei) rather than the shared task
+# queue, which only carries the latency-critical tasks of the state machine (info, the one-electron steps and the
+# Fock-SCF loop). Workers take tasks from the task queue first and share the rest of their slots between the bulk
+# queues of all running jobs, so the loop of a small job does not wait behind the slices of a large one.
+BULK_QUEUE_PREFIX = 'integrals-bulk-'
+
+
+# Queue name of a job's slices, tracker_id is the job id or {jobid}/r{N} for a resumed job
+def bulk_queue_name(tracker_id) -> str:
+    return BULK_QUEUE_PREFIX + tracker_id.replace('/', '-')
+
+
+# The visibility timeout is the task queue's, the workers set their own when they receive
+def create_bulk_queue(sqs, tracker_id, visibility_timeout=7200) -> str:
+    return sqs.create_queue(
+        QueueName=bulk_queue_name(tracker_id), Attributes={'VisibilityTimeout': str(visibility_timeout)}
+    )['QueueUrl']
+
+
+# URLs of the bulk queues whose name starts with prefix (all of them by default)
+def list_bulk_queues(sqs, prefix=BULK_QUEUE_PREFIX) -> list:
+    urls = []
+    args = {'QueueNamePrefix': prefix, 'MaxResults': 1000}
+    while True:
+        response = sqs.list_queues(**args)
+        urls.extend(response.get('QueueUrls', []))
+        if not response.get('NextToken'):
+            return urls
+        args['NextToken'] = response['NextToken']
+
+
+def is_bulk_queue(url) -> bool:
+    return url.rsplit('/', 1)[-1].startswith(BULK_QUEUE_PREFIX)
+
+
+# Deletes the bulk queues of a job (of every attempt) with the messages still in them
+def delete_job_queues(sqs, jobid):
+    for url in list_bulk_queues(sqs, bulk_queue_name(jobid)):
+        try:
+            sqs.delete_queue(QueueUrl=url)
+        except sqs.exceptions.QueueDoesNotExist:
+            # Deleted by the worker that completed the job since it was listed
+            pass
+
+
+# CloudWatch metric of the number of slices waiting in the bulk queues, the ECS service scales on it together with
+# the depth of the task queue. Published by setupTei after a fan-out and by the workers every heartbeat.
+BACKLOG_NAMESPACE = 'Integrals'
+BACKLOG_METRIC = 'BulkMessagesVisible'
+
+
+# Messages waiting in the queues, with in_flight also the messages being run
+def queue_backlog(sqs, urls, in_flight=False) -> int:
+    names = ['ApproximateNumberOfMessages'] + (['ApproximateNumberOfMessagesNotVisible'] if in_flight else [])
+    total = 0
+    for url in urls:
+        try:
+            attributes = sqs.get_queue_attributes(QueueUrl=url, AttributeNames=names)
+        except sqs.exceptions.QueueDoesNotExist:
+            # The queue was deleted since it was listed
+            continue
+        total += sum(int(attributes['Attributes'].get(name, 0)) for name in names)
+    return total
+
+
+def publish_backlog(cloudwatch, count):
+    cloudwatch.put_metric_data(
+        Namespace=BACKLOG_NAMESPACE, MetricData=[{'MetricName': BACKLOG_METRIC, 'Value': count, 'Unit': 'Count'}])
@@ -0,0 +1,194 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+# Slices are spread over shard items so that concurrent completions do not all update the same key
+SLICES_PER_SHARD = 64
+
+
+# Completion tracking for batched tasks (the two_electrons_integrals slices of a job).
+#
+# Every job has a root item "{jobid}" holding the set of shards that still have pending slices, and one
+# item "{jobid}#{shard}" per shard holding the set of its pending slice ids. Completing a slice removes it
+# from its shard, and a shard that becomes empty is removed from the root. Set removals are idempotent, so a
+# redelivered message never counts twice. The slice that observes the root becoming empty claims the job with
+# a conditional write; only that slice (or a redelivery of it) reports the job as finished.
+class CompletionTracker:
+    def __init__(self, backend, slices_per_shard=SLICES_PER_SHARD):
+        self.backend = backend
+        self.slices_per_shard = slices_per_shard
+
+    def shard_count(self, num_slices) -> int:
+        return max(1, -(-num_slices // self.slices_per_shard))
+
+    def shard_key(self, jobid, shard) -> str:
+        return f"{jobid}#{shard}"
+
+    # Creates the tracking items of a job, existing items are kept so a retried setup does not reset progress.
+    # Slices in done (already completed by an earlier attempt) are not tracked.
+    def start(self, jobid, num_slices, done: Iterable[int] = ()):
+        shards = self.shard_count(num_slices)
+        done = set(done)
+        pending: Dict[int, Set[int]] = {shard: set() for shard in range(shards)}
+        for i in range(num_slices):
+            if i not in done:
+                pending[i % shards].add(i)
+        for shard, slices in pending.items():
+            self.backend.put_if_absent(self.shard_key(jobid, shard), {'pending': slices})
+        pending_shards = {shard for shard, slices in pending.items() if slices}
+        self.backend.put_if_absent(jobid, {'pending_shards': pending_shards, 'shards': shards})
+
+    # Records the completion of a slice. Returns True only for the slice that completes the job.
+    def complete(self, jobid, slice_id, num_slices) -> bool:
+        shard = slice_id % self.shard_count(num_slices)
+        pending = self.backend.remove(self.shard_key(jobid, shard), 'pending', slice_id)
+        if pending is None or pending:
+            return False
+        pending_shards = self.backend.remove(jobid, 'pending_shards', shard)
+        if pending_shards is None or pending_shards:
+            return False
+        return self.backend.claim(jobid, 'finished_by', slice_id)
+
+    # Number of slices that have not completed yet (None if the job is not tracked)
+    def remaining(self, jobid) -> Optional[int]:
+        root = self.backend.get(jobid)
+        if root is None:
+            return None
+        count = 0
+        for shard in root.get('pending_shards', set()):
+            item = self.backend.get(self.shard_key(jobid, shard))
+            count += len(item.get('pending', set())) if item else 0
+        return count
+
+    def delete(self, jobid):
+        root = self.backend.get(jobid)
+        shards = root.get('shards', 0) if root else 0
+        self.backend.delete([jobid] + [self.shard_key(jobid, shard) for shard in range(shards)])
+
+    # Deletes the tracking items of a job and of its resumed attempts ("{jobid}/r{N}", see setupTei)
+    def delete_attempts(self, jobid):
+        self.delete(jobid)
+        self.backend.delete(self.backend.keys(f"{jobid}/r"))
+
+
+# Tracker storage in the DynamoDB batch table (partition key "jobid")
+class DynamoBackend:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+
+    def put_if_absent(self, key, item):
+        attributes = {'jobid': {'S': key}}
+        for name, value in item.items():
+            if isinstance(value, set):
+                # Empty sets can not be stored, a missing attribute is read back as an empty set
+                if value:
+                    attributes[name] = {'NS': [str(v) for v in value]}
+            else:
+                attributes[name] = {'N': str(value)}
+        try:
+            self.client.put_item(
+                TableName=self.table, Item=attributes, ConditionExpression='attribute_not_exists(jobid)')
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    # Removes value from the set attribute and returns what is left in the set (None if the item is missing)
+    def remove(self, key, attribute, value) -> Optional[Set[int]]:
+        try:
+            response = self.client.update_item(
+                TableName=self.table,
+                Key={'jobid': {'S': key}},
+                UpdateExpression='DELETE #attr :value',
+                ConditionExpression='attribute_exists(jobid)',
+                ExpressionAttributeNames={'#attr': attribute},
+                ExpressionAttributeValues={':value': {'NS': [str(value)]}},
+                ReturnValues='ALL_NEW',
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return None
+        return {int(v) for v in response['Attributes'].get(attribute, {}).get('NS', [])}
+
+    # Sets the attribute to value unless it is already set to another value, returns whether it succeeded
+    def claim(self, key, attribute, value) -> bool:
+        try:
+            self.client.update_item(
+                TableName=self.table,
+                Key={'jobid': {'S': key}},
+                UpdateExpression='SET #attr = :value',
+                ConditionExpression='attribute_exists(jobid) AND (attribute_not_exists(#attr) OR #attr = :value)',
+                ExpressionAttributeNames={'#attr': attribute},
+                ExpressionAttributeValues={':value': {'N': str(value)}},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def get(self, key) -> Optional[dict]:
+        response = self.client.get_item(TableName=self.table, Key={'jobid': {'S': key}}, ConsistentRead=True)
+        if 'Item' not in response:
+            return None
+        item: Dict[str, object] = {}
+        for name, value in response['Item'].items():
+            if 'NS' in value:
+                item[name] = {int(v) for v in value['NS']}
+            elif 'N' in value:
+                item[name] = int(value['N'])
+        return item
+
+    # Keys of the items that start with prefix, from a scan of the table
+    def keys(self, prefix) -> List[str]:
+        pages = self.client.get_paginator('scan').paginate(
+            TableName=self.table,
+            FilterExpression='begins_with(jobid, :prefix)',
+            ExpressionAttributeValues={':prefix': {'S': prefix}},
+            ProjectionExpression='jobid',
+        )
+        return [item['jobid']['S'] for page in pages for item in page.get('Items', [])]
+
+    def delete(self, keys: Iterable[str]):
+        requests: List[dict] = [{'DeleteRequest': {'Key': {'jobid': {'S': key}}}} for key in keys]
+        for i in range(0, len(requests), 25):
+            pending = {self.table: requests[i:i + 25]}
+            while pending:
+                pending = self.client.batch_write_item(RequestItems=pending).get('UnprocessedItems')
+
+
+# In-memory stand-in for DynamoBackend, used to run the tracker without AWS
+class LocalBackend:
+    def __init__(self):
+        self.items: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def put_if_absent(self, key, item):
+        with self.lock:
+            if key not in self.items:
+                self.items[key] = {name: set(value) if isinstance(value, set) else value
+                                   for name, value in item.items()}
+
+    def remove(self, key, attribute, value) -> Optional[Set[int]]:
+        with self.lock:
+            if key not in self.items:
+                return None
+            remaining = self.items[key].setdefault(attribute, set())
+            remaining.discard(value)
+            return set(remaining)
+
+    def claim(self, key, attribute, value) -> bool:
+        with self.lock:
+            if key not in self.items or self.items[key].get(attribute, value) != value:
+                return False
+            self.items[key][attribute] = value
+            return True
+
+    def get(self, key) -> Optional[dict]:
+        with self.lock:
+            item = self.items.get(key)
+            return {name: set(v) if isinstance(v, set) else v for name, v in item.items()} if item else None
+
+    def keys(self, prefix) -> List[str]:
+        with self.lock:
+            return [key for key in self.items if key.startswith(prefix)]
+
+    def delete(self, keys: Iterable[str]):
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
@@ -0,0 +1,59 @@
+# Task input of one two_electrons_integrals slice, built from the fan-out manifest written by setupTei. Used by the
+# worker to expand slice messages and by the local backend of the CLI.
+def slice_task(manifest, i) -> dict:
+    jobid = manifest['jobid']
+    begin, end = manifest['slices'][i]
+    commands = [
+        'two_electrons_integrals',
+        '--jobid', jobid,
+        '--xyz', manifest['xyz'],
+        '--basis_set', manifest['basis_set'],
+        '--begin', begin,
+        '--end', end,
+        '--bucket', manifest['bucket'],
+        '--output_object', shard_key(jobid, begin, end)
+    ]
+    return {
+        'n': manifest['n'],
+        'commands': commands,
+        's3_bucket_path': (
+            f"s3://{manifest['bucket']}/job_files/{jobid}/json_files/{jobid}_two_electrons_integrals_{i}.json"
+        ),
+        'numSlices': manifest['numSlices'],
+        'args_path': manifest['args_path'],
+        'batch_execution': manifest['batch_execution'],
+        'jobid': jobid,
+        'epsilon': manifest['epsilon'],
+        'slice': i,
+        'num_tasks': len(manifest['slices']),
+        'eri_prefix': jobid,
+        'cache_key': manifest.get('cache_key'),
+        'tracker_id': manifest.get('tracker_id', jobid),
+    }
+
+
+# Key of the ERI shard of the slice from begin to end (quartets such as "0,0,0,0")
+def shard_key(jobid, begin, end) -> str:
+    return f"{jobid}_{begin.replace(',', '_')}_{end.replace(',', '_')}.bin"
+
+
+# Location of a job's xyz input, staged in the job bucket by the info step
+def staged_xyz_key(jobid) -> str:
+    return f"job_files/{jobid}/input/{jobid}.xyz"
+
+
+# Key of the record of a job's ERI shards (names and stored sizes), written by the worker that completes the
+# two_electrons_integrals step so that fock_matrix tasks do not have to list the shards
+def shard_record_key(jobid) -> str:
+    return f"tei_args/{jobid}/shards.json"
+
+
+def shard_record(objects) -> dict:
+    return {'shards': [[obj['Key'].rsplit('/', 1)[-1], obj['Size']] for obj in objects]}
+
+
+# Shard objects ({'Key', 'Size'}) of a record, for shards stored next to eri_prefix (a job id, or the
+# result_cache/{key}/{jobid} prefix of cached shards)
+def shard_objects(eri_prefix, record) -> list:
+    directory = eri_prefix.rsplit('/', 1)[0] + '/' if '/' in eri_prefix else ''
+    return [{'Key': f"{directory}{name}", 'Size': size} for name, size in record['shards']]
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import time
+import urllib.request
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+# All cache entries live under this prefix of the job bucket, one "directory" per entry
+CACHE_PREFIX = 'result_cache'
+
+
+# Downloads the contents of an xyz URL, s3:// URLs (xyz files staged by the info step) are read with the s3 client
+def read_xyz(url, s3=None) -> str:
+    if url.startswith('s3://'):
+        parsed = urlparse(url, allow_fragments=False)
+        return s3.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip('/'))['Body'].read().decode()
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return response.read().decode()
+
+
+# Canonical form of an xyz file: the comment line is dropped and coordinates are normalised, so files that
+# describe the same geometry produce the same cache key
+def canonical_xyz(text) -> str:
+    lines = [line.split() for line in text.strip().splitlines()]
+    atoms = [
+        f"{fields[0].capitalize()} {float(fields[1]):.8f} {float(fields[2]):.8f} {float(fields[3]):.8f}"
+        for fields in lines[2:] if len(fields) >= 4
+    ]
+    return '\n'.join([str(len(atoms))] + atoms)
+
+
+# Cache key of a step result: the geometry, the basis set, the step and (for two_electrons_integrals) the range
+def cache_key(xyz_text, basis_set, step, index_range='') -> str:
+    parts = [canonical_xyz(xyz_text), basis_set.lower(), step, index_range]
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+# Content-addressed cache of step outputs in S3. An entry stores copies of the output objects of a step under
+# result_cache/{key}/ together with an entry.json that records the step, the objects, their total size and
+# when the entry was created and last used.
+class ResultCache:
+    def __init__(self, s3, bucket, threads=16):
+        self.s3 = s3
+        self.bucket = bucket
+        self.threads = threads
+
+    def entry_key(self, key) -> str:
+        return f"{CACHE_PREFIX}/{key}/entry.json"
+
+    def object_key(self, key, name) -> str:
+        return f"{CACHE_PREFIX}/{key}/{name}"
+
+    def lookup(self, key) -> Optional[dict]:
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.entry_key(key))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(obj['Body'].read())
+
+    def copy_all(self, copies: Dict[str, str]):
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            futures = [
+                executor.submit(self.s3.copy, {'Bucket': self.bucket, 'Key': source}, self.bucket, target)
+                for source, target in copies.items()
+            ]
+            for future in futures:
+                future.result()
+
+    # Copies the given objects ({name: source key}) into a new entry. The entry file is written last, so an
+    # entry is only visible once all of its objects are in place. sizes ({name: bytes}, e.g. from the listing of the
+    # objects) saves a request per object, the objects are looked up otherwise.
+    def store(self, key, step, objects: Dict[str, str], sizes: Optional[Dict[str, int]] = None, **details) -> dict:
+        self.copy_all({source: self.object_key(key, name) for name, source in objects.items()})
+        if sizes is None:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                sizes = dict(zip(objects, executor.map(
+                    lambda name: self.s3.head_object(
+                        Bucket=self.bucket, Key=self.object_key(key, name))['ContentLength'], objects)))
+        size = sum(sizes[name] for name in objects)
+        now = int(time.time())
+        entry = {
+            'key': key,
+            'step': step,
+            'objects': sorted(objects),
+            'bytes': size,
+            'created': now,
+            'last_used': now,
+            **details,
+        }
+        self.put_entry(entry)
+        return entry
+
+    def put_entry(self, entry):
+        self.s3.put_object(Bucket=self.bucket, Key=self.entry_key(entry['key']), Body=json.dumps(entry).encode())
+
+    # Copies the objects of an entry to their location in a job ({name: target key}) and marks it as used
+    def restore(self, entry, targets: Dict[str, str]):
+        self.copy_all({self.object_key(entry['key'], name): target for name, target in targets.items()})
+        self.touch(entry)
+
+    def touch(self, entry):
+        entry['last_used'] = int(time.time())
+        self.put_entry(entry)
+
+    def entries(self) -> List[dict]:
+        keys: List[str] = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{CACHE_PREFIX}/"):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'].endswith('/entry.json'))
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            return list(executor.map(
+                lambda k: json.loads(self.s3.get_object(Bucket=self.bucket, Key=k)['Body'].read()), keys))
+
+    # Deletes an entry, the entry file first so a partially deleted entry is never used
+    def remove(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.entry_key(key))
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{CACHE_PREFIX}/{key}/"):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects:
+                self.s3.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+
+    # Evicts entries, least recently used first, that are older than max_age seconds or do not fit in max_bytes.
+    # Returns the removed entries.
+    def prune(self, max_bytes=None, max_age=None) -> List[dict]:
+        entries = sorted(self.entries(), key=lambda entry: entry['last_used'])
+        total = sum(entry['bytes'] for entry in entries)
+        now = time.time()
+        removed = []
+        for entry in entries:
+            expired = max_age is not None and now - entry['last_used'] > max_age
+            if expired or (max_bytes is not None and total > max_bytes):
+                self.remove(entry['key'])
+                total -= entry['bytes']
+                removed.append(entry)
+        return removed
@@ -0,0 +1,138 @@
+# Predictive scaling of the worker services. The reactive step policy of the Fargate service only sees the queue
+# depth once CloudWatch has aggregated it, so the first minutes of an ERI fan-out run on the workers that happen to
+# be up. The setup Lambdas know the work of a job before it is queued: setupTei the number of slices it is about to
+# send, setupCalculations that the job has entered its Fock-SCF loop. They record it as the job's plan in the batch
+# table, and the scaleWorkers Lambda turns the plans, the depth of the queues and the task durations observed by
+# the workers into a desired count for every service (desired_slots and desired_counts, which only do arithmetic).
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from shared.bulk_queue import BACKLOG_NAMESPACE
+
+# Plans live in the batch table under this prefix, with a TTL attribute so the plans of failed jobs expire
+PLAN_PREFIX = 'plan#'
+PLAN_TTL = 3600
+# Phases of a job's plan: eri while its slices are sent and run, loop once it is in the Fock-SCF loop
+PHASES = ('eri', 'loop')
+
+# Seconds a worker slot spends on a task of a step, published by the workers every heartbeat
+DURATION_METRIC = 'TaskSeconds'
+# Used until the workers have published durations for the step
+DEFAULT_TASK_SECONDS = 60.0
+
+
+# Records that job is in phase, pending is the number of slices setupTei is about to send
+def put_plan(dynamo, table, jobid, phase, pending=0, ttl=PLAN_TTL):
+    dynamo.put_item(
+        TableName=table,
+        Item={
+            'jobid': {'S': f"{PLAN_PREFIX}{jobid}"},
+            'phase': {'S': phase},
+            'pending': {'N': str(pending)},
+            'expires': {'N': str(int(time.time()) + ttl)},
+        },
+    )
+
+
+def delete_plan(dynamo, table, jobid):
+    dynamo.delete_item(TableName=table, Key={'jobid': {'S': f"{PLAN_PREFIX}{jobid}"}})
+
+
+# Plans of the running jobs. DynamoDB removes expired items lazily, they are skipped here.
+def read_plans(dynamo, table) -> List[dict]:
+    plans = []
+    now = time.time()
+    pages = dynamo.get_paginator('scan').paginate(
+        TableName=table,
+        FilterExpression='begins_with(jobid, :prefix)',
+        ExpressionAttributeValues={':prefix': {'S': PLAN_PREFIX}},
+    )
+    for page in pages:
+        for item in page.get('Items', []):
+            if int(item['expires']['N']) < now:
+                continue
+            plans.append({
+                'jobid': item['jobid']['S'][len(PLAN_PREFIX):],
+                'phase': item['phase']['S'],
+                'pending': int(item['pending']['N']),
+            })
+    return plans
+
+
+# stats is step -> list of task durations (seconds) since the last call
+def publish_task_seconds(cloudwatch, stats: Dict[str, List[float]]):
+    data = [
+        {
+            'MetricName': DURATION_METRIC,
+            'Dimensions': [{'Name': 'Step', 'Value': step}],
+            'StatisticValues': {
+                'SampleCount': len(values), 'Sum': sum(values), 'Minimum': min(values), 'Maximum': max(values),
+            },
+            'Unit': 'Seconds',
+        }
+        for step, values in stats.items() if values
+    ]
+    # PutMetricData takes at most 1000 values per call
+    for i in range(0, len(data), 1000):
+        cloudwatch.put_metric_data(Namespace=BACKLOG_NAMESPACE, MetricData=data[i:i + 1000])
+
+
+# Mean duration of the tasks of step over the last window seconds, None when no worker ran one
+def read_task_seconds(cloudwatch, step, window=3600) -> Optional[float]:
+    end = time.time()
+    response = cloudwatch.get_metric_statistics(
+        Namespace=BACKLOG_NAMESPACE, MetricName=DURATION_METRIC, Dimensions=[{'Name': 'Step', 'Value': step}],
+        StartTime=end - window, EndTime=end, Period=window, Statistics=['SampleCount', 'Sum'])
+    count = sum(point['SampleCount'] for point in response['Datapoints'])
+    return sum(point['Sum'] for point in response['Datapoints']) / count if count else None
+
+
+# A worker service: its name, bounds of its desired count and the slots of every task (see WORKER_SLOTS)
+@dataclass
+class Service:
+    name: str
+    min_count: int
+    max_count: int
+    slots: int
+
+
+# Work known to the controller, in tasks
+@dataclass
+class Demand:
+    # Tasks of the task queue, waiting or running: info, the one-electron steps, the loop steps and sequential ERI
+    critical: int
+    # Slices that setupTei is about to send
+    planned: int
+    # Slices in the bulk queues, waiting or running
+    bulk: int
+    # Jobs in their Fock-SCF loop, every one keeps a slot between its tasks
+    loop_jobs: int
+
+
+# Slots needed for demand. Every critical task and every job in its loop gets a slot. The slices get the slots
+# that run them within drain_seconds given task_seconds per slice, never more than there are slices left, so the
+# capacity follows the remaining slices down as they drain. Slots that would only start (startup_seconds after
+# the scale out) once the current_slots have run every slice are not asked for.
+def desired_slots(demand: Demand, task_seconds, current_slots, drain_seconds=300.0, startup_seconds=90.0) -> int:
+    critical = max(demand.critical, demand.loop_jobs)
+    slices = demand.planned + demand.bulk
+    if not slices:
+        return critical
+    work = slices * task_seconds
+    bulk_slots = min(slices, math.ceil(work / drain_seconds))
+    available = current_slots - critical
+    if 0 < available < bulk_slots and work / available <= startup_seconds:
+        bulk_slots = available
+    return critical + bulk_slots
+
+
+# Desired count of every service for slots, filling the services in order (each within its bounds)
+def desired_counts(services: List[Service], slots) -> Dict[str, int]:
+    counts = {}
+    for service in services:
+        count = min(service.max_count, max(service.min_count, math.ceil(max(0, slots) / service.slots)))
+        counts[service.name] = count
+        slots -= count * service.slots
+    return counts
@@ -0,0 +1,40 @@
+# Loop bookkeeping shared by the updateLoopVariables Lambda and the fused SCF loop of the worker
+
+
+# Returns the loopData after an scf_step produced hartree_fock_energy (previous_energy is None on the first run).
+# With DIIS (see worker/diis.py), diis_error is the error norm of the iteration's Fock matrix and the loop is also
+# converged once it is at most diis_epsilon.
+def next_loop_data(loop_data, previous_energy, energy, diis_error=None, diis_epsilon=None):
+    # Previous value of hartree_diff is kept on the first loop execution
+    diff = loop_data['hartree_diff']
+    if previous_energy:
+        diff = abs(energy - previous_energy)
+    loop_data = {**loop_data, 'loopCount': loop_data['loopCount'] + 1, 'hartree_diff': diff}
+    if diis_error is not None:
+        loop_data['diis_error'] = diis_error
+        loop_data['converged'] = diis_epsilon is not None and diis_error <= float(diis_epsilon)
+    return loop_data
+
+
+# Same condition as the "Loop" Choice state of the state machine
+def loop_continues(loop_data, max_iter, epsilon) -> bool:
+    return (
+        loop_data['loopCount'] <= int(max_iter) and loop_data['hartree_diff'] > float(epsilon)
+        and not loop_data.get('converged', False)
+    )
+
+
+# Key of the Fock matrix that the scf_step of an iteration reads when the job uses DIIS: the extrapolation of the
+# iteration's fock_matrix output
+def diis_fock_key(jobid, index) -> str:
+    return f"job_files/{jobid}/bin_files/{jobid}_fock_matrix_diis_{index}.bin"
+
+
+# Key of the DIIS error matrix of an iteration
+def diis_error_key(jobid, index) -> str:
+    return f"job_files/{jobid}/bin_files/{jobid}_diis_error_{index}.bin"
+
+
+# Key of the DIIS history of a job: the iterations it combines and the inner products of their error matrices
+def diis_history_key(jobid) -> str:
+    return f"job_files/{jobid}/json_files/{jobid}_diis.json"
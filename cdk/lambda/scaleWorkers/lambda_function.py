@@ -0,0 +1,110 @@
+import json
+import boto3
+import os
+from typing import Dict
+
+from shared.bulk_queue import list_bulk_queues, queue_backlog
+from shared.scaling import (
+    DEFAULT_TASK_SECONDS, Demand, Service, desired_counts, desired_slots, read_plans, read_task_seconds
+)
+
+ecs = boto3.client('ecs')
+sqs = boto3.client('sqs')
+dynamo = boto3.client('dynamodb')
+cloudwatch = boto3.client('cloudwatch')
+autoscaling = boto3.client('application-autoscaling')
+
+queue_url = os.environ['TASK_QUEUE']
+batch_table = os.environ['BATCH_TABLE']
+cluster = os.environ['CLUSTER']
+# Services in the order they are filled: [{"name", "min", "max", "scalable"}]. A scalable service also has an
+# Application Auto Scaling target with the reactive queue depth policy, which owns its scale-in: the scaler only
+# raises its desired count, and raises the target's minimum so the policy only scales out beyond it. The minimum
+# holds while slices are planned or queued and goes back to "min" once they are done. The scaler sets the desired
+# count of the other services. The slots of a service's tasks are read from the WORKER_SLOTS variable of its task
+# definition.
+services = json.loads(os.environ['SERVICES'])
+# The slices queued are run within this time when the services' maximum counts allow it
+drain_seconds = float(os.environ.get('DRAIN_SECONDS', 300))
+# Time from a scale out to a new worker receiving tasks
+startup_seconds = float(os.environ.get('STARTUP_SECONDS', 90))
+# Task definition ARN -> slots of its tasks. Revisions of a task definition never change.
+task_slots: Dict[str, int] = {}
+
+
+def get_task_slots(task_definition) -> int:
+    if task_definition not in task_slots:
+        described = ecs.describe_task_definition(taskDefinition=task_definition)['taskDefinition']
+        environment = [
+            variable for container in described['containerDefinitions']
+            for variable in container.get('environment', []) if variable['name'] == 'WORKER_SLOTS'
+        ]
+        if not environment:
+            raise ValueError(f"Task definition {task_definition} does not set WORKER_SLOTS")
+        task_slots[task_definition] = int(environment[0]['value'])
+    return task_slots[task_definition]
+
+
+def resource_id(service) -> str:
+    return f"service/{cluster}/{service['name']}"
+
+
+# Minimum capacity of the scalable targets of the scalable services, by resource id
+def read_minimums() -> Dict[str, int]:
+    ids = [resource_id(service) for service in services if service.get('scalable')]
+    if not ids:
+        return {}
+    targets = autoscaling.describe_scalable_targets(ServiceNamespace='ecs', ResourceIds=ids)['ScalableTargets']
+    return {target['ResourceId']: target['MinCapacity'] for target in targets}
+
+
+# Sets the desired count of every worker service from the planned and queued work. Run every minute and by setupTei
+# right before it sends the slices of a job.
+def lambda_handler(event, context):
+    plans = read_plans(dynamo, batch_table)
+    demand = Demand(
+        critical=queue_backlog(sqs, [queue_url], in_flight=True),
+        planned=sum(plan['pending'] for plan in plans if plan['phase'] == 'eri'),
+        bulk=queue_backlog(sqs, list_bulk_queues(sqs), in_flight=True),
+        loop_jobs=sum(plan['phase'] == 'loop' for plan in plans),
+    )
+    task_seconds = read_task_seconds(cloudwatch, 'two_electrons_integrals') or DEFAULT_TASK_SECONDS
+    described = {
+        service['serviceName']: service
+        for service in ecs.describe_services(
+            cluster=cluster, services=[service['name'] for service in services])['services']
+    }
+    current = {name: service['desiredCount'] for name, service in described.items()}
+    targets = [
+        Service(service['name'], service['min'], service['max'],
+                get_task_slots(described[service['name']]['taskDefinition']))
+        for service in services
+    ]
+    current_slots = sum(current.get(service.name, 0) * service.slots for service in targets)
+    slots = desired_slots(demand, task_seconds, current_slots, drain_seconds, startup_seconds)
+    counts = desired_counts(targets, slots)
+    minimums = read_minimums()
+    for service in services:
+        count = counts[service['name']]
+        if service.get('scalable'):
+            minimum = minimums.get(resource_id(service), service['min'])
+            floor = max(count, minimum) if demand.planned + demand.bulk else service['min']
+            if floor != minimum:
+                autoscaling.register_scalable_target(
+                    ServiceNamespace='ecs',
+                    ResourceId=resource_id(service),
+                    ScalableDimension='ecs:service:DesiredCount',
+                    MinCapacity=floor,
+                )
+                print(f"Service {service['name']}: minimum {minimum} -> {floor} tasks")
+            count = max(count, current.get(service['name'], 0))
+        if count == current.get(service['name']):
+            continue
+        ecs.update_service(cluster=cluster, service=service['name'], desiredCount=count)
+        print(f"Service {service['name']}: {current.get(service['name'])} -> {count} tasks")
+    return {
+        'demand': demand.__dict__,
+        'task_seconds': task_seconds,
+        'slots': slots,
+        'counts': counts,
+    }
@@ -1,8 +1,15 @@
 import boto3
 import os
 
+from shared.result_cache import ResultCache, cache_key, read_xyz
+from shared.scaling import put_plan
+from shared.scf import diis_fock_key
+
 s3 = boto3.client('s3')
+dynamo = boto3.client('dynamodb')
 bucket_name = os.environ['ER_S3_BUCKET']
+batch_table = os.environ['BATCH_TABLE']
+result_cache = ResultCache(s3, bucket_name)
 
 
 # Takes the list of "commands" as input and returns the name of the basis_set
@@ -19,23 +26,81 @@ def get_xyz(cmds):
             return cmds[i+1]
 
 
+# Steps of the parallel state that only need the geometry and the basis set
+ONE_ELECTRON_STEPS = ('core_hamiltonian', 'overlap', 'initial_guess')
+
+
+def one_electron_commands(step, jobid, xyz, basis_set):
+    return [
+        step,
+        '--jobid', jobid,
+        '--xyz', xyz,
+        '--basis_set', basis_set,
+        '--bucket', bucket_name,
+        '--output_object', f"job_files/{jobid}/bin_files/{jobid}_{step}.bin"
+        ]
+
+
+# Returns the result cache key of a one-electron step and whether the step can be skipped. Outputs of a step that
+# was already run for the same geometry (None when the job does not use the result cache) and basis set are copied
+# from the result cache and the state machine skips the step. Otherwise the worker stores the outputs under the key.
+# Steps that a resumed job (see the CLI's resume command) already completed are skipped the same way.
+def lookup_step(event, step, jobid, geometry, basis_set):
+    key = None
+    cached = False
+    if geometry is not None:
+        key = cache_key(geometry, basis_set, step)
+        entry = result_cache.lookup(key)
+        if entry:
+            result_cache.restore(entry, {
+                'output.bin': f"job_files/{jobid}/bin_files/{jobid}_{step}.bin",
+                'output.json': f"job_files/{jobid}/json_files/{jobid}_{step}.json",
+            })
+            cached = True
+    if step in event.get('completed_steps', []):
+        cached = True
+    return key, cached
+
+
 def lambda_handler(event, context):
     jobid = event['jobid']
     basis_set = get_basis_set(event['commands'])
     xyz = get_xyz(event['commands'])
     # Gets the stepName introduced in the preceeding Pass state to know which step to setup for
     stepName = event['output']['stepName']
+    # Prefix of the two_electrons_integrals outputs, another job's (cached) outputs when setupTei found them
+    eri_prefix = event['eri_prefix'] if 'eri_prefix' in event else jobid
     commands = []
+    cached = False
+    key = None
+    steps = None
+    geometry = None
+    if stepName in ONE_ELECTRON_STEPS + ('one_electron',) and event.get('result_cache', 'true') == 'true':
+        geometry = read_xyz(xyz, s3)
     # core_hamiltonian, overlap, and initial_guess
-    if stepName == 'core_hamiltonian' or stepName == 'overlap' or stepName == 'initial_guess':
+    if stepName in ONE_ELECTRON_STEPS:
+        commands = one_electron_commands(stepName, jobid, xyz, basis_set)
+    # The three one-electron steps run by a single worker task, one after the other (see Worker.handle_steps)
+    elif stepName == 'one_electron':
         commands = [
             stepName,
             '--jobid', jobid,
             '--xyz', xyz,
             '--basis_set', basis_set,
-            '--bucket', bucket_name,
-            '--output_object', f"job_files/{jobid}/bin_files/{jobid}_{stepName}.bin"
+            '--bucket', bucket_name
             ]
+        steps = []
+        for step in ONE_ELECTRON_STEPS:
+            step_key, step_cached = lookup_step(event, step, jobid, geometry, basis_set)
+            if not step_cached:
+                steps.append({
+                    'commands': one_electron_commands(step, jobid, xyz, basis_set),
+                    's3_bucket_path': f"s3://{bucket_name}/job_files/{jobid}/json_files/{jobid}_{step}.json",
+                    'jobid': jobid,
+                    'cache_key': step_key,
+                })
+        # Every step was restored from the result cache or completed by an earlier execution
+        cached = not steps
 
     # fock_matrix
     elif stepName == 'fock_matrix':
@@ -47,7 +112,7 @@ def lambda_handler(event, context):
                 '--xyz', xyz,
                 '--basis_set', basis_set,
                 '--jobid', jobid,
-                '--eri_prefix', jobid,
+                '--eri_prefix', eri_prefix,
                 '--bucket', bucket_name,
                 '--density_url', f"s3://{bucket_name}/job_files/{jobid}/bin_files/{jobid}_{density_url_step}.bin",
                 '--output_object',
@@ -57,6 +122,11 @@ def lambda_handler(event, context):
 
     # scf_step
     elif stepName == 'scf_step':
+        index = int(event['loopData']['loopCount']) - 1
+        fock_matrix_key = f"job_files/{jobid}/bin_files/{jobid}_fock_matrix_{index}.bin"
+        # With DIIS the scf_step reads the extrapolation of the fock_matrix output (see worker/diis.py)
+        if event.get('diis', 'false') == 'true':
+            fock_matrix_key = diis_fock_key(jobid, index)
         commands = [
                 stepName,
                 '--xyz', xyz,
@@ -66,14 +136,20 @@ def lambda_handler(event, context):
                 '--output_object',
                 # Storing all scf_step outputs indexed starting at index 0
                 f"job_files/{jobid}/bin_files/{jobid}_scf_step_{int(event['loopData']['loopCount']) - 1}.bin",
-                '--fock_matrix_url',
-                (
-                    f"s3://{bucket_name}/job_files/{jobid}/bin_files/"
-                    f"{jobid}_fock_matrix_{int(event['loopData']['loopCount']) - 1}.bin"
-                ),
+                '--fock_matrix_url', f"s3://{bucket_name}/{fock_matrix_key}",
                 '--hamiltonian_url', f"s3://{bucket_name}/job_files/{jobid}/bin_files/{jobid}_core_hamiltonian.bin",
                 '--overlap_url', f"s3://{bucket_name}/job_files/{jobid}/bin_files/{jobid}_overlap.bin"
             ]
+    # Fused Fock-SCF loop, run by a single worker task (see worker/scf_loop.py)
+    elif stepName == 'scf_loop':
+        commands = [
+                stepName,
+                '--xyz', xyz,
+                '--basis_set', basis_set,
+                '--jobid', jobid,
+                '--eri_prefix', eri_prefix,
+                '--bucket', bucket_name
+            ]
     # Need to add index to scf and fock JSON outputs as well
     s3_bucket_path: str
     if stepName in ["scf_step", "fock_matrix"]:
@@ -83,6 +159,11 @@ def lambda_handler(event, context):
             )
     else:
         s3_bucket_path = f"s3://{bucket_name}/job_files/{jobid}/json_files/{jobid}_{stepName}.json"
+    if stepName in ONE_ELECTRON_STEPS:
+        key, cached = lookup_step(event, stepName, jobid, geometry, basis_set)
+    # A job in its loop keeps a worker slot between its tasks (see shared/scaling.py)
+    if stepName in ('fock_matrix', 'scf_loop'):
+        put_plan(dynamo, batch_table, jobid, 'loop')
     return {
         'commands': commands,
         's3_bucket_path': s3_bucket_path,
@@ -90,5 +171,12 @@ def lambda_handler(event, context):
         'max_iter': event['max_iter'],
         'hartree_fock_energy': event['hartree_fock_energy'] if 'hartree_fock_energy' in event else None,
         'loopData': event['loopData'] if 'loopData' in event else None,
-        'epsilon': event['epsilon']
+        'epsilon': event['epsilon'],
+        'fused_scf': event['fused_scf'] if 'fused_scf' in event else 'false',
+        'diis': event.get('diis', 'false'),
+        'diis_epsilon': event.get('diis_epsilon'),
+        'eri_prefix': eri_prefix,
+        'cached': cached,
+        'cache_key': key,
+        **({'steps': steps} if steps is not None else {})
     }
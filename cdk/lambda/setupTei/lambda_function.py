@@ -1,15 +1,55 @@
 import json
 import boto3
+import math
 import os
+import time
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 
-s3 = boto3.client('s3')
-sqs = boto3.client('sqs')
+from partitioner import format_quartet, partition
+from shared.bulk_queue import create_bulk_queue, publish_backlog
+from shared.completion import CompletionTracker, DynamoBackend
+from shared.manifest import shard_key
+from shared.result_cache import ResultCache, cache_key, read_xyz
+from shared.scaling import put_plan, read_task_seconds
+
+# Number of threads sending message batches concurrently during the fan-out
+FANOUT_THREADS = 16
+# Progress of the fan-out is saved after this many batches, or this many seconds, so a retried or continued
+# invocation can resume
+PROGRESS_INTERVAL = 20
+PROGRESS_SECONDS = 5
+# The fan-out stops this many seconds before the Lambda times out, saves its progress and continues in a new
+# invocation
+DEADLINE_MARGIN_SECONDS = 60
+# Most slices sent in one message (see slices_per_message)
+MAX_SLICES_PER_MESSAGE = 10
+
+client_config = Config(max_pool_connections=FANOUT_THREADS)
+s3 = boto3.client('s3', config=client_config)
+sqs = boto3.client('sqs', config=client_config)
 dynamo = boto3.client('dynamodb')
+sfn = boto3.client('stepfunctions')
+cloudwatch = boto3.client('cloudwatch')
+lambda_client = boto3.client('lambda')
 
 bucket_name = os.environ['ER_S3_BUCKET']
 queue_url = os.environ['TASK_QUEUE']
 batch_table = os.environ['BATCH_TABLE']
+deleted_job_table = os.environ['DELETED_JOB_TABLE']
+# Send the slices of every job to a queue of its own (see shared/bulk_queue.py) instead of the task queue
+fair_share = os.environ.get('FAIR_SHARE', 'true') == 'true'
+# Lambda that sets the desired counts of the worker services (see shared/scaling.py), not set to leave the scaling
+# to the queue depth policy
+scaler_function = os.environ.get('SCALER_FUNCTION')
+tracker = CompletionTracker(DynamoBackend(dynamo, batch_table))
+result_cache = ResultCache(s3, bucket_name)
+# Allowed cost difference between the most expensive ERI slice and the average slice
+max_imbalance = float(os.environ.get('MAX_SLICE_IMBALANCE', 0.05))
+# Seconds a worker spends on a slice message besides running the slice (receiving it, reporting the slice to the
+# tracker, uploading its output), slices shorter than this are sent several per message. 0 sends one per message.
+dispatch_seconds = float(os.environ.get('SLICE_DISPATCH_SECONDS', 2))
 
 
 # Takes the list of "commands" as input and returns the name of the basis_set
@@ -26,6 +66,148 @@ def get_xyz(cmds):
             return cmds[i+1]
 
 
+def get_json(key):
+    try:
+        obj = s3.get_object(Bucket=bucket_name, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(obj['Body'].read())
+
+
+def put_json(key, value):
+    s3.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(value).encode())
+
+
+# Number of slices sent in one message. A worker runs the slices of a message one after the other, so when the
+# slices take less time than dispatch_seconds (from the mean slice duration the workers publish, see
+# shared/scaling.py) enough of them are grouped for a message to take about dispatch_seconds to run.
+def slices_per_message() -> int:
+    if dispatch_seconds <= 0:
+        return 1
+    try:
+        task_seconds = read_task_seconds(cloudwatch, 'two_electrons_integrals')
+    except Exception as e:
+        print(f"Could not read the duration of the slices: {e}")
+        return 1
+    if not task_seconds or task_seconds >= dispatch_seconds:
+        return 1
+    return min(MAX_SLICES_PER_MESSAGE, math.ceil(dispatch_seconds / task_seconds))
+
+
+# Sends one batch of (up to 10) slice messages to queue, retrying entries that SQS reports as failed. groups are the
+# slices of every message.
+def send_batch(queue, jobid, manifest_url, groups):
+    entries = [
+        {
+            'Id': str(group[0]),
+            # Shared fields (xyz, basis_set, epsilon, token...) are read by the worker from the manifest
+            'MessageBody': json.dumps(
+                {'input': {'value': {
+                    'jobid': jobid, 'manifest': manifest_url,
+                    **({'slice': group[0]} if len(group) == 1 else {'slices': group}),
+                }}},
+                separators=(',', ':')),
+            'MessageAttributes': {'batch': {'DataType': 'String', 'StringValue': 'true'}},
+        }
+        for group in groups
+    ]
+    for _ in range(5):
+        response = sqs.send_message_batch(QueueUrl=queue, Entries=entries)
+        failed = {entry['Id'] for entry in response.get('Failed', [])}
+        if not failed:
+            return
+        entries = [entry for entry in entries if entry['Id'] in failed]
+    raise Exception(f"Could not send {len(entries)} messages for job {jobid}")
+
+
+# Tells a worker about the bulk queue of a job through the task queue once its slices are sent, so they are taken
+# before the workers list the bulk queues again
+def announce_bulk_queue(jobid, queue):
+    sqs.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps({'input': {'value': {'jobid': jobid, 'bulk_queue': queue}}}, separators=(',', ':')))
+
+
+# Records the slices about to be sent as the job's plan and lets the scaler start workers for them while they are
+# sent, rather than once the queue depth metric shows them
+def plan_slices(jobid, count):
+    put_plan(dynamo, batch_table, jobid, 'eri', count)
+    if scaler_function:
+        lambda_client.invoke(
+            FunctionName=scaler_function, InvocationType='Event', Payload=json.dumps({'jobid': jobid}))
+
+
+def is_job_deleted(jobid):
+    return 'Item' in dynamo.get_item(TableName=deleted_job_table, Key={'jobid': {'S': jobid}})
+
+
+# Sends one message per group of per_message slices (indices into the manifest's slices) in batches of 10 across a
+# thread pool. Batches already recorded in the progress object (from an earlier, interrupted invocation, whose
+# slices and grouping are kept, as the batches are offsets into them) are skipped. Progress is saved as batches are
+# sent, not only when the fan-out ends, since a Lambda that times out runs no more code. The fan-out stops when the
+# job is deleted while its messages are sent, and at deadline (a time.monotonic() value). Returns False when it
+# stopped at the deadline with batches left to send.
+def fan_out(queue, jobid, manifest_url, slices, progress_key, per_message=1, deadline=None) -> bool:
+    progress = get_json(progress_key) or {'sent': []}
+    sent = set(progress['sent'])
+    slices = progress.get('slices', slices)
+    per_message = progress.get('slices_per_message', per_message)
+    groups = [slices[i:i + per_message] for i in range(0, len(slices), per_message)]
+    batches = [b for b in range(0, len(groups), 10) if b not in sent]
+
+    def save():
+        put_json(progress_key, {'sent': sorted(sent), 'slices': slices, 'slices_per_message': per_message})
+
+    if 'slices' not in progress:
+        save()
+
+    saved_at = time.monotonic()
+    timed_out = False
+    with ThreadPoolExecutor(max_workers=FANOUT_THREADS) as executor:
+        futures = {
+            executor.submit(send_batch, queue, jobid, manifest_url, groups[b:b + 10]): b
+            for b in batches
+        }
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                sent.add(futures[future])
+                if done % PROGRESS_INTERVAL == 0 or time.monotonic() - saved_at >= PROGRESS_SECONDS:
+                    save()
+                    saved_at = time.monotonic()
+                    if is_job_deleted(jobid):
+                        print(f"Job {jobid} was deleted, stopped sending its messages")
+                        break
+                if deadline is not None and time.monotonic() >= deadline and done < len(futures):
+                    print(f"Stopped sending the messages of job {jobid} before the timeout, {len(sent)} batches sent")
+                    timed_out = True
+                    break
+        finally:
+            # Also when a batch failed: the batches sent by the other threads are recorded before the error is
+            # raised, so a retried invocation does not send them again
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            sent.update(b for future, b in futures.items()
+                        if not future.cancelled() and future.exception() is None)
+            save()
+    return not timed_out
+
+
+# Continues the fan-out of a job in a new invocation with the same event, so the task token stays the one in the
+# manifest the workers read
+def continue_fan_out(event, context):
+    lambda_client.invoke(FunctionName=context.function_name, InvocationType='Event', Payload=json.dumps(event))
+
+
+# Indices of the slices whose shard is already in the bucket (from an earlier attempt of the job)
+def existing_slices(jobid, slices):
+    keys = set()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=f"{jobid}_"):
+        keys.update(obj['Key'] for obj in page.get('Contents', []))
+    return {i for i in range(len(slices)) if shard_key(jobid, *slices[i]) in keys}
+
+
 def lambda_handler(event, context):
     payload = event['payload']
     file_location = urlparse(payload['s3_bucket_path'], allow_fragments=False).path.lstrip('/')
@@ -44,51 +226,94 @@ def lambda_handler(event, context):
     basis_set = get_basis_set(payload['commands'])
     if (objDict['success']):
         commands = []
+        key = None
+        if 'two_electrons_integrals' in payload.get('completed_steps', []):
+            # A resumed job whose shards are all in the bucket, under the prefix found by the resume command (the
+            # prefix of a result cache entry when the first run used one)
+            output = {**payload, 'eri_prefix': payload.get('eri_prefix', jobid)}
+            sfn.send_task_success(taskToken=event['task_token'], output=json.dumps(output))
+            return payload
+        if payload.get('result_cache', 'true') == 'true':
+            n = objDict['basis_set_instance_size']
+            key = cache_key(read_xyz(xyz, s3), basis_set, 'two_electrons_integrals', f"0,0,0,0-{n},0,0,0")
+            entry = result_cache.lookup(key)
+            if entry:
+                # The ERI shards of an earlier job with the same geometry and basis set are used in place, the
+                # fock_matrix steps read them through eri_prefix
+                result_cache.touch(entry)
+                sfn.send_task_success(
+                    taskToken=event['task_token'],
+                    output=json.dumps({**payload, 'eri_prefix': entry['eri_prefix'], 'cached': True}))
+                return payload
         if batch_execution == "true":
-            dynamo.put_item(
-                TableName=batch_table,
-                Item={
-                    'jobid': {'S': jobid},
-                    'remaining_tasks': {'N': str(objDict['basis_set_instance_size'])}
-                }
-            )
-            for i in range(objDict['basis_set_instance_size']):
-                commands = [
-                        'two_electrons_integrals',
-                        '--jobid', jobid,
-                        '--xyz', xyz,
-                        '--basis_set', basis_set,
-                        '--begin', f'{i},0,0,0',
-                        '--end', f"{i+1},0,0,0",
-                        '--bucket', bucket_name,
-                        '--output_object', f"{jobid}_{i}_0_0_0_{i+1}_0_0_0.bin"
+            # A resumed job (see the CLI's resume command) keeps the slices of its first run, so the shards that
+            # already exist are skipped. Each attempt has its own manifest (with the new task token) and tracker
+            # items, so messages left over from the failed attempt can not complete it.
+            attempt = payload.get('resume')
+            suffix = f"_r{attempt}" if attempt else ''
+            tracker_id = f"{jobid}/r{attempt}" if attempt else jobid
+            first_run = get_json(f"tei_args/{jobid}/manifest.json") if attempt else None
+            if first_run:
+                slices = first_run['slices']
+                numSlices = first_run['numSlices']
+            else:
+                # Slices of roughly equal estimated cost, numSlices of them (one per basis function by default)
+                slices = [
+                    [format_quartet(begin), format_quartet(end)]
+                    for begin, end in partition(objDict['basis_set_instance_size'], numSlices, max_imbalance)
                 ]
-                sqs.send_message(
-                    QueueUrl=queue_url,
-                    MessageBody=json.dumps({
-                        'input': {
-                            'value': {
-                                'n': objDict['basis_set_instance_size'],
-                                'commands': commands,
-                                's3_bucket_path': (
-                                    f"s3://{bucket_name}/job_files/{jobid}/json_files/"
-                                    f"{jobid}_two_electrons_integrals_{i}.json"
-                                    ),
-                                'numSlices': numSlices,
-                                'args_path': f"s3://{bucket_name}/tei_args/{jobid}",
-                                'batch_execution': batch_execution,
-                                'jobid': jobid,
-                                'epsilon': payload['epsilon'],
-                            }
-                        },
-                        'token': event['task_token']}),
-                    MessageAttributes={
-                        'batch': {
-                            'DataType': 'String',
-                            'StringValue': 'true'
-                        }
-                    }
-                )
+            num_tasks = len(slices)
+            # The slices left to send are found once. A continued or retried invocation keeps them, more shards
+            # written by the workers since then must not shift the batches already sent (see fan_out).
+            progress_key = f"tei_args/{jobid}/fanout{suffix}.json"
+            progress = get_json(progress_key) or {}
+            if 'slices' in progress:
+                pending = progress['slices']
+                done = set(range(num_tasks)) - set(pending)
+            else:
+                done = existing_slices(jobid, slices) if attempt else set()
+                pending = [i for i in range(num_tasks) if i not in done]
+            if not pending:
+                sfn.send_task_success(
+                    taskToken=event['task_token'], output=json.dumps({**payload, 'eri_prefix': jobid}))
+                return payload
+            # Existing tracking items are kept, so a retried invocation does not reset the workers' progress
+            tracker.start(tracker_id, num_tasks, done)
+            # Fields shared by every slice are stored once, the messages only carry the slice index
+            manifest_key = f"tei_args/{jobid}/manifest{suffix}.json"
+            put_json(manifest_key, {
+                'token': event['task_token'],
+                'n': objDict['basis_set_instance_size'],
+                'numSlices': numSlices,
+                'jobid': jobid,
+                'xyz': xyz,
+                'basis_set': basis_set,
+                'bucket': bucket_name,
+                'args_path': f"s3://{bucket_name}/tei_args/{jobid}",
+                'batch_execution': batch_execution,
+                'epsilon': payload['epsilon'],
+                'slices': slices,
+                'cache_key': key,
+                'tracker_id': tracker_id,
+            })
+            # The workers take the slices from the job's own queue in turn with the other jobs' slices
+            queue = create_bulk_queue(sqs, tracker_id) if fair_share else queue_url
+            plan_slices(jobid, len(pending))
+            per_message = slices_per_message()
+            deadline = None
+            if context is not None:
+                deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN_SECONDS
+            if not fan_out(queue, jobid, f"s3://{bucket_name}/{manifest_key}", pending, progress_key, per_message,
+                           deadline):
+                continue_fan_out(event, context)
+                return payload
+            # The sent slices are counted in the queue from now on
+            put_plan(dynamo, batch_table, jobid, 'eri')
+            if fair_share:
+                # Workers find the queue when they list the bulk queues, or right away through the announcement.
+                # They publish the backlog every minute, this lets the service scale out for the slices before then.
+                announce_bulk_queue(jobid, queue)
+                publish_backlog(cloudwatch, math.ceil(len(pending) / per_message))
 
         else:
             # Commands for Sequential
@@ -118,6 +343,8 @@ def lambda_handler(event, context):
                                 'batch_execution': batch_execution,
                                 'jobid': jobid,
                                 'epsilon': payload['epsilon'],
+                                'eri_prefix': jobid,
+                                'cache_key': key,
                             }
                         },
                         'token': event['task_token']}),
@@ -0,0 +1,98 @@
+from typing import List, Tuple
+
+Quartet = Tuple[int, int, int, int]
+
+# Largest relative difference between the most expensive slice and the average slice that partition() accepts
+# before it refines the slice boundaries to more indices
+DEFAULT_MAX_IMBALANCE = 0.05
+
+
+# Index of the basis function pair (a, b), b <= a, in the order (0,0), (1,0), (1,1), (2,0), ...
+def pair_index(a, b) -> int:
+    return a * (a + 1) // 2 + b
+
+
+# Number of quartets (a,b,c,d) lexicographically before the given quartet that have to be computed. With
+# symmetry=8 only the canonical quartets (b <= a, d <= c, pair (c,d) <= pair (a,b)) are counted, every other
+# quartet is a permutation of one of them. With symmetry=1 every quartet is counted.
+def quartets_before(n, quartet: Quartet, symmetry=8) -> int:
+    i, j, k, l = quartet
+    if symmetry == 1:
+        return ((i * n + j) * n + k) * n + l
+    if symmetry != 8:
+        raise ValueError(f"Unsupported symmetry {symmetry}, use 1 or 8")
+    if i >= n:
+        return total_cost(n, symmetry)
+    # The first pair (a,b) with pair index p is followed by p + 1 canonical (c,d) pairs
+    start = pair_index(i, 0)
+    first_pairs = start + min(j, i + 1)
+    count = first_pairs * (first_pairs + 1) // 2
+    if j <= i:
+        q = pair_index(i, j)
+        count += min(q + 1, pair_index(k, 0)) if k < n else q + 1
+        if k < n and pair_index(k, 0) <= q:
+            count += max(0, min(l, k + 1, q - pair_index(k, 0) + 1))
+    return count
+
+
+def total_cost(n, symmetry=8) -> int:
+    if symmetry == 1:
+        return n ** 4
+    pairs = n * (n + 1) // 2
+    return pairs * (pairs + 1) // 2
+
+
+# Quartet at position index of the lexicographic order over the first granularity indices (rest set to 0)
+def to_quartet(n, index, granularity) -> Quartet:
+    digits = [0, 0, 0, 0]
+    for position in reversed(range(granularity)):
+        index, digits[position] = divmod(index, n)
+    digits[0] += index * n
+    return (digits[0], digits[1], digits[2], digits[3])
+
+
+# Splits [0, total) at the requested cost targets. Boundaries only use the first granularity indices.
+def find_boundaries(n, num_parts, granularity, symmetry) -> List[Quartet]:
+    total = total_cost(n, symmetry)
+    positions = n ** granularity
+    boundaries = [(0, 0, 0, 0)]
+    for part in range(1, num_parts):
+        target = total * part / num_parts
+        # Smallest boundary that has at least target quartets before it
+        low, high = 0, positions
+        while low < high:
+            middle = (low + high) // 2
+            if quartets_before(n, to_quartet(n, middle, granularity), symmetry) >= target:
+                high = middle
+            else:
+                low = middle + 1
+        boundary = to_quartet(n, low, granularity)
+        if boundary != boundaries[-1] and boundary[0] < n:
+            boundaries.append(boundary)
+    boundaries.append((n, 0, 0, 0))
+    return boundaries
+
+
+def imbalance(n, slices: List[Tuple[Quartet, Quartet]], symmetry=8) -> float:
+    costs = [quartets_before(n, end, symmetry) - quartets_before(n, begin, symmetry) for begin, end in slices]
+    return max(costs) / (total_cost(n, symmetry) / len(slices)) - 1
+
+
+# Splits the two_electrons_integrals index space of a basis set of size n into at most num_parts contiguous
+# [begin, end) ranges of roughly equal cost. Slice boundaries start on the first two indices and are refined to
+# three and four indices when the imbalance between slices is larger than max_imbalance.
+def partition(n, num_parts, max_imbalance=DEFAULT_MAX_IMBALANCE, symmetry=8) -> List[Tuple[Quartet, Quartet]]:
+    if n < 1 or num_parts < 1:
+        raise ValueError("The basis set size and the number of parts must be positive")
+    num_parts = min(num_parts, total_cost(n, symmetry))
+    for granularity in range(2, 5):
+        boundaries = find_boundaries(n, num_parts, granularity, symmetry)
+        slices = list(zip(boundaries[:-1], boundaries[1:]))
+        if imbalance(n, slices, symmetry) <= max_imbalance:
+            break
+    return slices
+
+
+# Formats a quartet the way the integrals --begin and --end arguments expect it
+def format_quartet(quartet: Quartet) -> str:
+    return ','.join(str(index) for index in quartet)
@@ -2,8 +2,13 @@ import json
 import boto3
 import os
 
+from shared.scaling import delete_plan
+from shared.scf import loop_continues, next_loop_data
+
 s3 = boto3.client('s3')
+dynamo = boto3.client('dynamodb')
 bucket_name = os.environ['ER_S3_BUCKET']
+batch_table = os.environ['BATCH_TABLE']
 
 
 def lambda_handler(event, context):
@@ -16,13 +21,20 @@ def lambda_handler(event, context):
         )
     scf_output = json.loads(scf_output_json['Body'].read())
     hartree_fock_energy = scf_output['hartree_fock_energy']
-    # Previous value of hartree_diff (used in case of first loop execution else overwritten in the next if block)
-    diff = event['loopData']['hartree_diff']
-    if (event['hartree_fock_energy']):
-        diff = abs(hartree_fock_energy - event['hartree_fock_energy'])
+    # With DIIS the fock_matrix output has the error norm of the iteration (see worker/diis.py)
+    diis_error = None
+    if event.get('diis', 'false') == 'true':
+        fock_output_json = s3.get_object(
+                Bucket=bucket_name,
+                Key=f"job_files/{jobid}/json_files/{jobid}_fock_matrix_{loopData['loopCount'] - 1}.json"
+            )
+        diis_error = json.loads(fock_output_json['Body'].read()).get('diis_error')
     # Update loopData with new values
-    loopData['loopCount'] = loopData['loopCount'] + 1
-    loopData['hartree_diff'] = diff
+    loopData = next_loop_data(
+        loopData, event['hartree_fock_energy'], hartree_fock_energy, diis_error, event.get('diis_epsilon'))
+    # The job does not need a worker slot once its loop ends
+    if not loop_continues(loopData, event['max_iter'], event['epsilon']):
+        delete_plan(dynamo, batch_table, jobid)
     return {
         'jobid': jobid,
         's3_bucket_path': event['s3_bucket_path'],
@@ -30,5 +42,8 @@ def lambda_handler(event, context):
         'commands': event['commands'],
         'hartree_fock_energy': hartree_fock_energy,
         'loopData': loopData,
-        'epsilon': event['epsilon']
+        'epsilon': event['epsilon'],
+        'diis': event.get('diis', 'false'),
+        'diis_epsilon': event.get('diis_epsilon'),
+        'eri_prefix': event['eri_prefix'] if 'eri_prefix' in event else jobid
     }
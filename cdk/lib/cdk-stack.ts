@@ -15,6 +15,9 @@ import { ManagedPolicy } from "aws-cdk-lib/aws-iam";
 import * as logs from "aws-cdk-lib/aws-logs";
 import { BaseVpc } from "./base-vpc";
 import * as autoscaling from "aws-cdk-lib/aws-autoscaling";
+import * as cloudwatch from "aws-cdk-lib/aws-cloudwatch";
+import * as events from "aws-cdk-lib/aws-events";
+import * as targets from "aws-cdk-lib/aws-events-targets";
 
 export class IntegralsStack extends Stack {
   constructor(scope: Construct, id: string, props?: StackProps) {
@@ -29,16 +32,20 @@ export class IntegralsStack extends Stack {
      * id: CDK Id of the resource
      * codePath: Path to the lambda_function code
      * name: Name of the Lambda function
+     * timeout, memorySize: Limits of the function, 20 seconds and 256 MB by default
      */
-    const cdkLambdaFunction = (id: string, codePath: string, name: string): lambda.Function => {
+    const cdkLambdaFunction = (
+      id: string, codePath: string, name: string, timeout = cdk.Duration.seconds(20), memorySize = 256
+    ): lambda.Function => {
       const func = new lambda.Function(this, id, {
         runtime: lambda.Runtime.PYTHON_3_9,
         handler: "lambda_function.lambda_handler",
         code: lambda.Code.fromAsset(codePath),
         role: setupLambdaRole,
+        layers: [sharedLayer],
         functionName: name,
-        timeout: cdk.Duration.seconds(20),
-        memorySize: 256,
+        timeout,
+        memorySize,
         environment: {
           ER_S3_BUCKET: bucketName.valueAsString,
           TASK_QUEUE: taskQueue.queueUrl,
@@ -47,8 +54,8 @@ export class IntegralsStack extends Stack {
         }
       });
       taskQueue.grantSendMessages(func);
-      batchTable.grantWriteData(func);
-      deletedJobTable.grantWriteData(func);
+      batchTable.grantReadWriteData(func);
+      deletedJobTable.grantReadWriteData(func);
       func.addPermission(`${name}permission`, {
         principal: new iam.ServicePrincipal("states.amazonaws.com"),
         action: "lambda:InvokeFunction",
@@ -86,6 +93,20 @@ export class IntegralsStack extends Stack {
       });
     };
 
+    /**
+     * CDK Helper Function - Returns a Choice step that skips the given ECS step when the preceding setupCalculations
+     * step restored its outputs from the result cache (cached is true)
+     * id: CDK Id of the resource
+     * ecsStep: The step that runs the calculation
+     */
+    const cdkSkipIfCached = (id: string, ecsStep: tasks.SqsSendMessage): sfn.Choice => {
+      return new sfn.Choice(this, id)
+        .when(
+          sfn.Condition.and(sfn.Condition.isPresent("$.cached"), sfn.Condition.booleanEquals("$.cached", true)),
+          new sfn.Pass(this, `${id}Cached`))
+        .otherwise(ecsStep);
+    };
+
     /**
      * Stack code
      */
@@ -119,12 +140,16 @@ export class IntegralsStack extends Stack {
     const batchTable = new dynamodb.Table(this, 'BatchTable', {
       partitionKey: { name: 'jobid', type: dynamodb.AttributeType.STRING },
       tableName: 'IntegralsBatchTable',
+      // Used by the workers' job affinity entries
+      timeToLiveAttribute: 'expires',
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     });
 
     const deletedJobTable = new dynamodb.Table(this, 'deletedJobTable', {
       partitionKey: { name: 'jobid', type: dynamodb.AttributeType.STRING },
       tableName: 'IntegralsDeletedJobTable',
+      // Set by the deleteJob Lambda, so the table the workers scan only holds recently aborted jobs
+      timeToLiveAttribute: 'expires',
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     });
 
@@ -194,17 +219,51 @@ export class IntegralsStack extends Stack {
               effect: iam.Effect.ALLOW,
             }),
             new iam.PolicyStatement({
-              actions: ["sqs:DeleteMessage", "sqs:ReceiveMessage"],
+              actions: ["sqs:DeleteMessage", "sqs:ReceiveMessage", "sqs:ChangeMessageVisibility", "sqs:SendMessage"],
               resources: [taskQueue.queueArn],
               effect: iam.Effect.ALLOW,
             }),
+            // Per-worker queues used for fock_matrix job affinity
+            new iam.PolicyStatement({
+              actions: [
+                "sqs:CreateQueue",
+                "sqs:DeleteQueue",
+                "sqs:SendMessage",
+                "sqs:ReceiveMessage",
+                "sqs:DeleteMessage",
+                "sqs:ChangeMessageVisibility",
+              ],
+              resources: [`arn:aws:sqs:${cdk.Stack.of(this).region}:${cdk.Stack.of(this).account}:integrals-affinity-*`],
+              effect: iam.Effect.ALLOW,
+            }),
+            // Per-job queues of the ERI slices, created by setupTei and deleted by the worker that completes the job
+            new iam.PolicyStatement({
+              actions: [
+                "sqs:ReceiveMessage",
+                "sqs:DeleteMessage",
+                "sqs:ChangeMessageVisibility",
+                "sqs:GetQueueAttributes",
+                "sqs:DeleteQueue",
+              ],
+              resources: [`arn:aws:sqs:${cdk.Stack.of(this).region}:${cdk.Stack.of(this).account}:integrals-bulk-*`],
+              effect: iam.Effect.ALLOW,
+            }),
+            new iam.PolicyStatement({
+              actions: ["sqs:ListQueues", "cloudwatch:PutMetricData"],
+              resources: ["*"],
+              effect: iam.Effect.ALLOW,
+            }),
             new iam.PolicyStatement({
-              actions: ["dynamodb:Query"],
+              actions: ["dynamodb:Query", "dynamodb:Scan"],
               resources: [deletedJobTable.tableArn],
               effect: iam.Effect.ALLOW,
             }),
             new iam.PolicyStatement({
-              actions: ["dynamodb:DeleteItem", "dynamodb:UpdateItem"],
+              actions: [
+                "dynamodb:GetItem", "dynamodb:PutItem", "dynamodb:UpdateItem", "dynamodb:BatchWriteItem",
+                // Sweep of the expired job affinity entries
+                "dynamodb:Scan", "dynamodb:DeleteItem",
+              ],
               resources: [batchTable.tableArn],
               effect: iam.Effect.ALLOW,
             }),
@@ -213,6 +272,11 @@ export class IntegralsStack extends Stack {
       },
     });
 
+    // Concurrent integrals executions of every Fargate and EC2 task (WORKER_SLOTS of the worker), one per vCPU and
+    // 4 GiB of memory. The scaleWorkers Lambda reads them from the task definitions.
+    const fargateSlots = 2;
+    const ec2Slots = 5;
+
     // Task definition for all ECS tasks. Change the cpu and memoryMiB to change the resource availability of each Fargate task
     const ecsTask = new ecs.TaskDefinition(this, "ecsTask", {
       compatibility: ecs.Compatibility.FARGATE,
@@ -264,9 +328,22 @@ export class IntegralsStack extends Stack {
       maxCapacity: 20,
     });
 
-    // Scaling policy to scale up when Queue length is greater than 10
+    // Scaling policy to scale up when Queue length is greater than 10. The ERI slices waiting in the per-job queues
+    // are counted through the metric published by setupTei and the workers (see shared/bulk_queue.py). The
+    // scaleWorkers Lambda (below) raises the minimum capacity ahead of the queue, this policy scales beyond it and
+    // scales the service in.
     scaling.scaleOnMetric("QueueLengthScaling", {
-      metric: taskQueue.metricApproximateNumberOfMessagesVisible(),
+      metric: new cloudwatch.MathExpression({
+        expression: "visible + FILL(backlog, 0)",
+        usingMetrics: {
+          visible: taskQueue.metricApproximateNumberOfMessagesVisible(),
+          backlog: new cloudwatch.Metric({
+            namespace: "Integrals",
+            metricName: "BulkMessagesVisible",
+            statistic: "Maximum",
+          }),
+        },
+      }),
       adjustmentType: autoscaling.AdjustmentType.CHANGE_IN_CAPACITY,
       scalingSteps: [
         { upper: 10, change: -1 },
@@ -285,6 +362,7 @@ export class IntegralsStack extends Stack {
         "TASK_QUEUE": taskQueue.queueUrl,
         "BATCH_TABLE": batchTable.tableName,
         "DELETED_JOB_TABLE": deletedJobTable.tableName,
+        "WORKER_SLOTS": String(fargateSlots),
       }
     });
 
@@ -296,6 +374,7 @@ export class IntegralsStack extends Stack {
         "TASK_QUEUE": taskQueue.queueUrl,
         "BATCH_TABLE": batchTable.tableName,
         "DELETED_JOB_TABLE": deletedJobTable.tableName,
+        "WORKER_SLOTS": String(ec2Slots),
       },
       memoryLimitMiB: 20480,
     });
@@ -321,8 +400,37 @@ export class IntegralsStack extends Stack {
 
     setupLambdaRole.addToPolicy(basicLambdaExecution);
 
-    // Lambda function to setup the two_electrons_integrals step
-    const setupTeiLambda = cdkLambdaFunction("setupTEILambda", "./lambda/setupTei/", "setupTei");
+    // setupTei reports the two_electrons_integrals step as done right away when its outputs are in the result cache
+    setupLambdaRole.addToPolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: ["states:SendTaskSuccess"],
+      resources: ["*"],
+    }));
+
+    // setupTei sends the ERI slices of a job to a queue of the job's own, deleteJob deletes the queues of a job
+    setupLambdaRole.addToPolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: ["sqs:CreateQueue", "sqs:SendMessage", "sqs:DeleteQueue"],
+      resources: [`arn:aws:sqs:${cdk.Stack.of(this).region}:${cdk.Stack.of(this).account}:integrals-bulk-*`],
+    }));
+    setupLambdaRole.addToPolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: ["sqs:ListQueues", "cloudwatch:PutMetricData"],
+      resources: ["*"],
+    }));
+
+    // Lambda layer with the Python modules shared by the Lambda functions and the ECS worker (lambda/layer/python)
+    const sharedLayer = new lambda.LayerVersion(this, "sharedLayer", {
+      code: lambda.Code.fromAsset("./lambda/layer/"),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_9],
+      description: "Modules shared by the integrals Lambda functions and workers",
+    });
+
+    // Lambda function to setup the two_electrons_integrals step. It lists the shards of resumed jobs and sends the
+    // slices of large jobs from 16 threads, and continues in a new invocation before it times out (see fan_out).
+    const setupTeiLambda = cdkLambdaFunction(
+      "setupTEILambda", "./lambda/setupTei/", "setupTei", cdk.Duration.minutes(15), 1024
+    );
 
     // One Lambda function that sets up all other calculations
     const setupCalculationsLambda = cdkLambdaFunction(
@@ -345,6 +453,49 @@ export class IntegralsStack extends Stack {
       "deleteJob"
     );
 
+    // Lambda function that sets the desired counts of the worker services from the planned work of the running jobs
+    // (see shared/scaling.py). Runs every minute and is invoked by setupTei before it sends the slices of a job. The
+    // Fargate service is filled first, the EC2 service (one c5n.2xlarge task) takes what is left.
+    const scaleWorkersLambda = cdkLambdaFunction(
+      "scaleWorkersLambda", "./lambda/scaleWorkers/", "scaleWorkers", cdk.Duration.seconds(60), 512
+    );
+    scaleWorkersLambda.addEnvironment("CLUSTER", cluster.clusterName);
+    scaleWorkersLambda.addEnvironment("SERVICES", JSON.stringify([
+      { name: ecsService.serviceName, min: 0, max: 20, scalable: true },
+      { name: ec2Service.serviceName, min: 0, max: 1 },
+    ]));
+    new events.Rule(this, "scaleWorkersSchedule", {
+      schedule: events.Schedule.rate(Duration.minutes(1)),
+      targets: [new targets.LambdaFunction(scaleWorkersLambda)],
+    });
+    setupTeiLambda.addEnvironment("SCALER_FUNCTION", scaleWorkersLambda.functionName);
+    setupLambdaRole.addToPolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: ["lambda:InvokeFunction"],
+      resources: [
+        scaleWorkersLambda.functionArn,
+        // setupTei continues a long fan-out in a new invocation of itself
+        `arn:aws:lambda:${cdk.Stack.of(this).region}:${cdk.Stack.of(this).account}:function:setupTei`,
+      ],
+    }));
+    setupLambdaRole.addToPolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: ["ecs:DescribeServices", "ecs:UpdateService"],
+      resources: [ecsService.serviceArn, ec2Service.serviceArn],
+    }));
+    setupLambdaRole.addToPolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      actions: [
+        "application-autoscaling:RegisterScalableTarget",
+        "application-autoscaling:DescribeScalableTargets",
+        // Slots of the worker services' tasks
+        "ecs:DescribeTaskDefinition",
+        "cloudwatch:GetMetricStatistics",
+        "sqs:GetQueueAttributes",
+      ],
+      resources: ["*"],
+    }));
+
     // Creating LambdaInvoke steps for all Lambda functions
     const setupTeiStep = new tasks.LambdaInvoke(this, "setupTeiStep", {
       lambdaFunction: setupTeiLambda,
@@ -356,20 +507,18 @@ export class IntegralsStack extends Stack {
       integrationPattern: sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
     })
 
-    const setupCoreHamiltonianStep = cdkLambdaInvokeSfn("setupCoreHamiltonianStep", setupCalculationsLambda);
-    const setupOverlapMatrixStep = cdkLambdaInvokeSfn("setupOverlapMatrixStep", setupCalculationsLambda);
-    const setupInitialGuessStep = cdkLambdaInvokeSfn("setupInitialGuessStep", setupCalculationsLambda);
+    const setupOneElectronStep = cdkLambdaInvokeSfn("setupOneElectronStep", setupCalculationsLambda);
     const setupFockMatrixStep = cdkLambdaInvokeSfn("setupFockMatrixStep", setupCalculationsLambda);
     const setupScfStep = cdkLambdaInvokeSfn("setupScfStep", setupCalculationsLambda);
     const updateLoopVariables = cdkLambdaInvokeSfn("updateLoopVariables", updateLoopVariablesLambda);
+    const setupScfLoopStep = cdkLambdaInvokeSfn("setupScfLoopStep", setupCalculationsLambda);
 
     // Creating Pass steps that add a stepName to the input. This stepName is the the name of the step for which the next calculation should be setup
     // by the setupCalculationsLambda
-    const modifyInputsCoreHamiltonian = cdkModifyInputs("modifyInputsCoreHamiltonian", "core_hamiltonian");
-    const modifyInputsOverlap = cdkModifyInputs("modifyInputsOverlap", "overlap");
-    const modifyInputsInitialGuess = cdkModifyInputs("modifyInputsInitialGuess", "initial_guess");
+    const modifyInputsOneElectron = cdkModifyInputs("modifyInputsOneElectron", "one_electron");
     const modifyInputsFockMatrix = cdkModifyInputs("modifyInputsFockMatrix", "fock_matrix");
     const modifyInputsScf = cdkModifyInputs("modifyInputsScf", "scf_step");
+    const modifyInputsScfLoop = cdkModifyInputs("modifyInputsScfLoop", "scf_loop");
 
     // A Pass step to give initial values to loop variables, variable stored in loopData
     const initializeLoopVariables = new sfn.Pass(this, "initializeLoopVariables", {
@@ -380,32 +529,38 @@ export class IntegralsStack extends Stack {
       resultPath: "$.loopData",
     });
 
-    // Core Hamiltonian parallel step
-    const coreHamiltonianStep = this.submitEcsTask("coreHamiltonianStep", taskQueue);
-
-    // Overlap Matrix parallel step
-    const overlapMatrixStep = this.submitEcsTask("overlapMatrixStep", taskQueue);
-
-    // Initial Guess parallel step
-    const initialGuessStep = this.submitEcsTask("initialGuessStep", taskQueue);
+    // Core Hamiltonian, Overlap Matrix and Initial Guess parallel step, one worker task runs the three of them
+    const oneElectronStep = this.submitEcsTask("oneElectronStep", taskQueue);
 
     // Sequential way to run two_electrons_integrals step
     const integralsTwoElectronsIntegralsSeqStep = this.submitEcsTask("IntegralsTEI", taskQueue);
 
+    // The Fock matrix and SCF tasks of an iteration fail the execution instead of waiting forever for a task that
+    // was lost with its worker (forwarded fock_matrix tasks are only kept one hour by the affinity queues)
+    const iterationTimeout = Duration.hours(1);
+
     // Fock Matrix step
-    const fockMatrixStep = this.submitEcsTask("fockMatrixStep", taskQueue);
+    const fockMatrixStep = this.submitEcsTask("fockMatrixStep", taskQueue, iterationTimeout);
 
     // Scf Step
-    const scfStep = this.submitEcsTask("scfStep", taskQueue);
+    const scfStep = this.submitEcsTask("scfStep", taskQueue, iterationTimeout);
+
+    // Fused Fock-SCF loop step, a single worker task runs every iteration of the loop
+    const scfLoopStep = this.submitEcsTask("scfLoopStep", taskQueue);
 
 
     const logGroup = new logs.LogGroup(this, "LogGroup");
 
 
-    // Condition to determine whether the Fock-SCF loop will continue
+    // Condition to determine whether the Fock-SCF loop will continue, a job with DIIS also stops once the error of
+    // its Fock matrix is below diis_epsilon (loopData.converged)
     const loopCondition = sfn.Condition.and(
       sfn.Condition.numberLessThanEqualsJsonPath("$.loopData.loopCount", "$.max_iter"),
-      sfn.Condition.numberGreaterThanJsonPath("$.loopData.hartree_diff", "$.epsilon")
+      sfn.Condition.numberGreaterThanJsonPath("$.loopData.hartree_diff", "$.epsilon"),
+      sfn.Condition.or(
+        sfn.Condition.isNotPresent("$.loopData.converged"),
+        sfn.Condition.booleanEquals("$.loopData.converged", false)
+      )
     );
 
     // Fock-SCF loop
@@ -421,38 +576,61 @@ export class IntegralsStack extends Stack {
       .next(updateLoopVariables)
       .next(fockScfLoop);
 
+    const success = new sfn.Succeed(this, "Success");
+
     // Check condition
-    fockScfLoop.when(loopCondition, loopBody).otherwise(new sfn.Succeed(this, "Success"));
-
-    const stepFuncDefinition = integralsInfoStep
-      .next(
-        // take outputs from the first parallel step and pass to next
-        new sfn.Parallel(this, "parallelExec", {
-          resultSelector: {
-            "commands.$": "$[0].commands",
-            "s3_bucket_path.$": "$[0].s3_bucket_path",
-            "jobid.$": "$[0].jobid",
-            "max_iter.$": "$[0].max_iter",
-            "epsilon.$": "$[0].epsilon",
-          },
-        })
-          // Core_hamiltonian, Overlap, Initial_guess and two_electrons_integrals can be run in parallel
-          .branch(
-            modifyInputsCoreHamiltonian
-              .next(setupCoreHamiltonianStep)
-              .next(coreHamiltonianStep))
-          .branch(
-            modifyInputsOverlap
-              .next(setupOverlapMatrixStep)
-              .next(overlapMatrixStep))
-          .branch(
-            modifyInputsInitialGuess
-              .next(setupInitialGuessStep)
-              .next(initialGuessStep))
-          .branch(setupTeiStep)
-      )
-      .next(initializeLoopVariables)
-      .next(fockScfLoop);
+    fockScfLoop.when(loopCondition, loopBody).otherwise(success);
+
+    // Runs the loop in the state machine, or in one worker task when the job was started with fused_scf set to true
+    const loopMode = new sfn.Choice(this, "LoopMode");
+    loopMode
+      .when(
+        sfn.Condition.and(
+          sfn.Condition.isPresent("$.fused_scf"),
+          sfn.Condition.stringEquals("$.fused_scf", "true")
+        ),
+        modifyInputsScfLoop.next(setupScfLoopStep).next(scfLoopStep).next(success))
+      .otherwise(fockScfLoop);
+
+    // take outputs from the first parallel step and pass to next
+    const parallelExec = new sfn.Parallel(this, "parallelExec", {
+      resultSelector: {
+        "commands.$": "$[0].commands",
+        "s3_bucket_path.$": "$[0].s3_bucket_path",
+        "jobid.$": "$[0].jobid",
+        "max_iter.$": "$[0].max_iter",
+        "epsilon.$": "$[0].epsilon",
+        "fused_scf.$": "$[0].fused_scf",
+        "diis.$": "$[0].diis",
+        "diis_epsilon.$": "$[0].diis_epsilon",
+        "eri_prefix.$": "$[1].eri_prefix",
+      },
+    })
+      // The one-electron steps (core_hamiltonian, overlap and initial_guess) and two_electrons_integrals can be run in
+      // parallel
+      .branch(
+        modifyInputsOneElectron
+          .next(setupOneElectronStep)
+          .next(cdkSkipIfCached("oneElectronCached", oneElectronStep)))
+      .branch(setupTeiStep);
+    parallelExec.next(initializeLoopVariables).next(loopMode);
+
+    // A job restarted by the CLI's resume command starts after the phases it already completed: at the parallel
+    // step (skipping the steps listed in completed_steps) or directly at the loop with the saved loopData
+    const stepFuncDefinition = new sfn.Choice(this, "ResumeFrom")
+      .when(
+        sfn.Condition.and(
+          sfn.Condition.isPresent("$.resume_from"),
+          sfn.Condition.stringEquals("$.resume_from", "loop")
+        ),
+        loopMode)
+      .when(
+        sfn.Condition.and(
+          sfn.Condition.isPresent("$.resume_from"),
+          sfn.Condition.stringEquals("$.resume_from", "parallel")
+        ),
+        parallelExec)
+      .otherwise(integralsInfoStep.next(parallelExec));
 
     // State Machine Role
     const stateMachineRole = new iam.Role(this, "SMRole", {
@@ -565,8 +743,9 @@ export class IntegralsStack extends Stack {
     });
   }
 
-  private submitEcsTask(id: string, taskQueue: sqs.Queue) {
+  private submitEcsTask(id: string, taskQueue: sqs.Queue, timeout?: Duration) {
     return new tasks.SqsSendMessage(this, id, {
+      timeout,
       queue: taskQueue,
       messageBody: sfn.TaskInput.fromObject({
         token: sfn.JsonPath.taskToken,
@@ -0,0 +1,224 @@
+import csv
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import cli.helpers as helpers
+
+# Columns of a batch manifest row and their defaults (the defaults of execute-state-machine), xyz and basis_set
+# are required
+MANIFEST_DEFAULTS = {
+    'num_parts': None,
+    'max_iter': 30,
+    'epsilon': 0.000000001,
+    'batch_execution': 'false',
+    'fused_scf': 'false',
+    'result_cache': 'true',
+    'diis': 'false',
+    'diis_epsilon': None,
+}
+# Error codes of start_execution that are retried with backoff
+THROTTLING_ERRORS = ('ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailable')
+
+
+class ManifestError(Exception):
+    pass
+
+
+# Reads a batch manifest, a CSV file with a header row or a JSON list of objects. Empty CSV cells take the default.
+def read_manifest(path) -> List[dict]:
+    with open(path, newline='') as f:
+        if path.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    manifest = []
+    for i, row in enumerate(rows):
+        row = {key.strip(): value for key, value in row.items() if value not in (None, '')}
+        missing = [key for key in ('xyz', 'basis_set') if key not in row]
+        if missing:
+            raise ManifestError(f"Row {i} of {path} has no {' or '.join(missing)}")
+        unknown = set(row) - set(MANIFEST_DEFAULTS) - {'xyz', 'basis_set'}
+        if unknown:
+            raise ManifestError(f"Row {i} of {path} has unknown columns {', '.join(sorted(unknown))}")
+        row = {**MANIFEST_DEFAULTS, **row}
+        # The loop condition of the state machine compares numbers
+        try:
+            row['max_iter'] = int(row['max_iter'])
+            row['epsilon'] = float(row['epsilon'])
+            if row['diis_epsilon'] is not None:
+                row['diis_epsilon'] = float(row['diis_epsilon'])
+        except ValueError as e:
+            raise ManifestError(f"Row {i} of {path}: {e}")
+        manifest.append(row)
+    return manifest
+
+
+# Local record of a batch: the job id of every manifest row (by row index), written after every change so an
+# interrupted submission can be continued. A row is recorded with its job id before its execution is started.
+class BatchState:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, dict] = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.jobs = json.load(f)['jobs']
+
+    def save(self):
+        with open(f"{self.path}.part", 'w') as f:
+            json.dump({'jobs': self.jobs}, f, indent=1)
+        os.replace(f"{self.path}.part", self.path)
+
+    def update(self, index, **fields):
+        with self.lock:
+            self.jobs.setdefault(str(index), {}).update(fields)
+            self.save()
+
+    def get(self, index) -> Optional[dict]:
+        with self.lock:
+            return self.jobs.get(str(index))
+
+    def jobids(self) -> set:
+        with self.lock:
+            return {job['jobid'] for job in self.jobs.values()}
+
+
+# Allows at most rate calls per second on average, with bursts of up to burst calls
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Starts the executions of a manifest's rows concurrently. At most max_active jobs of the batch run at a time,
+# start_execution calls are rate limited and throttled calls are retried with exponential backoff.
+class BatchSubmitter:
+    def __init__(self, bucket, aws_resources, state: BatchState, max_active, rate, threads, poll_interval=15):
+        self.bucket = bucket
+        self.aws_resources = aws_resources
+        self.state = state
+        self.max_active = max_active
+        self.limiter = RateLimiter(rate, max(1, int(rate)))
+        self.threads = threads
+        self.poll_interval = poll_interval
+        # jobid -> time its execution was started by this submitter, written by the submitting threads
+        self.started: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    # Job ids of the batch's executions that are still running, from one paginated listing of running executions
+    def running_jobs(self) -> set:
+        names = {execution['name'] for execution in helpers.list_execs(self.aws_resources, statuses=['RUNNING'])}
+        return {job_name(name) for name in names} & self.state.jobids()
+
+    def start(self, index, row):
+        job = self.state.get(index)
+        if job and job.get('submitted_at'):
+            return
+        # The job id is recorded first, a row interrupted between the two steps is started again under it
+        jobid = job['jobid'] if job else str(uuid.uuid4())
+        if not job:
+            self.state.update(index, jobid=jobid, xyz=row['xyz'], basis_set=row['basis_set'])
+        job_input = helpers.job_input(
+            self.bucket, jobid, row['xyz'], row['basis_set'], row['num_parts'], row['max_iter'],
+            row['batch_execution'], row['epsilon'], row['fused_scf'], row['result_cache'], row['diis'],
+            row['diis_epsilon'])
+        delay = 1.0
+        while True:
+            self.limiter.acquire()
+            try:
+                helpers.exec_state_machine(input=job_input, aws_resources=self.aws_resources, name=jobid)
+                break
+            # botocore's ClientError, taken from the client so that the module does not import botocore
+            except helpers.sfn.exceptions.ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ExecutionAlreadyExists':
+                    break
+                if code not in THROTTLING_ERRORS:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+        with self.lock:
+            self.started[jobid] = time.monotonic()
+        self.state.update(index, submitted_at=datetime.now(timezone.utc).isoformat())
+        print(f"Row {index}: job {jobid} started")
+
+    # Starts the rows that were not submitted yet. Before every start, waits until fewer than max_active jobs of the
+    # batch are running or being started. Running jobs are listed every poll_interval seconds, jobs started since
+    # the last listing are counted as running.
+    def submit(self, rows: List[dict]):
+        pending = [(i, row) for i, row in enumerate(rows) if not (self.state.get(i) or {}).get('submitted_at')]
+        print(f"{len(rows)} rows, {len(rows) - len(pending)} already submitted")
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            futures: List[Future] = []
+            listed_at, running = time.monotonic(), self.running_jobs()
+
+            def active():
+                with self.lock:
+                    started = {jobid for jobid, at in self.started.items() if at >= listed_at}
+                return len(running | started) + sum(not future.done() for future in futures)
+            for index, row in pending:
+                while active() >= self.max_active:
+                    time.sleep(self.poll_interval)
+                    listed_at, running = time.monotonic(), self.running_jobs()
+                futures.append(executor.submit(self.start, index, row))
+            for future in futures:
+                future.result()
+
+
+# Name of the job an execution belongs to, resumed executions are named {jobid}-r{N}
+def job_name(execution_name) -> str:
+    jobid, separator, attempt = execution_name.rpartition('-r')
+    return jobid if separator and attempt.isdigit() else execution_name
+
+
+# Jobs whose latest execution (their last resume) finished with one of statuses before cutoff. A job with a newer or
+# running attempt is left out, its files are still in use. executions are listed latest first (see helpers.list_execs).
+def finished_jobs(executions, statuses, cutoff) -> List[str]:
+    latest: Dict[str, dict] = {}
+    for execution in executions:
+        latest.setdefault(job_name(execution['name']), execution)
+    return [
+        jobid for jobid, execution in latest.items()
+        if execution['status'] in statuses and execution.get('stopDate') and execution['stopDate'] < cutoff
+    ]
+
+
+# Status of every job of a batch from one paginated listing of the executions started since the batch's first
+# submission. The latest execution of a job (its last resume) gives its status. Returns (row, job, status) tuples.
+def batch_status(aws_resources, state: BatchState) -> List[tuple]:
+    submitted = [datetime.fromisoformat(job['submitted_at']) for job in state.jobs.values() if job.get('submitted_at')]
+    latest: Dict[str, dict] = {}
+    if submitted:
+        jobids = state.jobids()
+        # Executions are listed latest first, the first one seen for a job is its latest
+        for execution in helpers.list_execs(aws_resources, since=min(submitted) - timedelta(minutes=5)):
+            jobid = job_name(execution['name'])
+            if jobid in jobids and jobid not in latest:
+                latest[jobid] = execution
+    rows = []
+    for index, job in sorted(state.jobs.items(), key=lambda item: int(item[0])):
+        execution = latest.get(job['jobid'])
+        status = execution['status'] if execution else ('NOT_FOUND' if job.get('submitted_at') else 'NOT_SUBMITTED')
+        rows.append((int(index), job, status))
+    return rows
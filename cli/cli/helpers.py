@@ -1,16 +1,43 @@
 import boto3
+import fnmatch
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List
 import os
+import sys
+import time
 
+from shared import binfile
+from shared.manifest import shard_record_key, staged_xyz_key
+from shared.scf import loop_continues, next_loop_data
 
-ecs = boto3.client('ecs')
-s3 = boto3.client('s3')
-sts = boto3.client('sts')
-ec2 = boto3.client('ec2')
-sfn = boto3.client('stepfunctions')
-lambda_client = boto3.client('lambda')
+
+# Creates the boto3 client on first use, so commands only pay for the clients of the services they use
+class LazyClient:
+    def __init__(self, service):
+        self.service = service
+        self.client = None
+
+    def __getattr__(self, name):
+        if self.client is None:
+            self.client = boto3.client(self.service)
+        return getattr(self.client, name)
+
+
+ecs = LazyClient('ecs')
+s3 = LazyClient('s3')
+sts = LazyClient('sts')
+ec2 = LazyClient('ec2')
+sfn = LazyClient('stepfunctions')
+lambda_client = LazyClient('lambda')
+dynamo = LazyClient('dynamodb')
+
+# Resolved resources are cached per profile and region for this many seconds
+RESOURCE_CACHE_TTL = int(os.environ.get('INTEGRALS_CLI_CACHE_TTL', 24 * 3600))
+RESOURCE_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'integrals-cli')
 
 
 # Class to keep track of AWS resources
@@ -25,27 +52,76 @@ class ResourceConfig:
     delete_job_lambda_arn: str
 
 
+def resource_cache_path() -> str:
+    session = boto3.Session()
+    return os.path.join(RESOURCE_CACHE_DIR, f"resources-{session.profile_name}-{session.region_name}.json")
+
+
+def read_resource_cache() -> dict:
+    try:
+        with open(resource_cache_path()) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if time.time() - cached.get('resolved_at', 0) > RESOURCE_CACHE_TTL:
+        return {}
+    return cached
+
+
+def write_resource_cache(cached):
+    os.makedirs(RESOURCE_CACHE_DIR, exist_ok=True)
+    temp = f"{resource_cache_path()}.{os.getpid()}"
+    with open(temp, 'w') as f:
+        json.dump(cached, f)
+    os.replace(temp, resource_cache_path())
+
+
+# Removes the cached resources, the next command resolves them again
+def clear_resource_cache():
+    try:
+        os.remove(resource_cache_path())
+    except FileNotFoundError:
+        pass
+
+
+# Subnets of the stack's VPC, looked up the first time a command launches a task and then cached on disk with the
+# account id (see RESOURCE_CACHE_TTL)
+def resolve_subnets() -> List[str]:
+    cached = read_resource_cache()
+    if 'subnets' not in cached:
+        # Get VPC id by VPC name
+        vpcs = ec2.describe_vpcs(Filters=[
+            {
+                'Name': 'tag:Name',
+                'Values': ['IntegralsVpc']
+            }
+        ])
+        vpcId = vpcs['Vpcs'][0]['VpcId']
+        # Get Subnets from VPC Id
+        subnets = ec2.describe_subnets(Filters=[
+            {
+                'Name': 'vpc-id',
+                'Values': [vpcId]
+            }
+        ])
+        cached = {'resolved_at': time.time(), **cached}
+        cached['subnets'] = [subnets['Subnets'][0]['SubnetId'], subnets['Subnets'][1]['SubnetId']]
+        write_resource_cache(cached)
+    return cached['subnets']
+
+
+# Resolves the ARNs of the stack's resources. The account id is cached on disk (see RESOURCE_CACHE_TTL), the subnets
+# are the cached ones if any and are otherwise looked up by run_ecs_task (see resolve_subnets).
 def resolve_resource_config(bucket_name='') -> ResourceConfig:
     # Setting up ARNs and Ids of different resources used
     region = boto3.Session().region_name
-    account_id = sts.get_caller_identity()['Account']
-    # Get VPC id by VPC name
-    vpcs = ec2.describe_vpcs(Filters=[
-        {
-            'Name': 'tag:Name',
-            'Values': ['IntegralsVpc']
-        }
-    ])
-    vpcId = vpcs['Vpcs'][0]['VpcId']
-    # Get Subnets from VPC Id
-    subnets = ec2.describe_subnets(Filters=[
-        {
-            'Name': 'vpc-id',
-            'Values': [vpcId]
-        }
-    ])
+    cached = read_resource_cache()
+    if 'account_id' not in cached:
+        cached = {**cached, 'account_id': sts.get_caller_identity()['Account'], 'resolved_at': time.time()}
+        write_resource_cache(cached)
+    account_id = cached['account_id']
     return ResourceConfig(
-        [subnets['Subnets'][0]['SubnetId'], subnets['Subnets'][1]['SubnetId']],
+        cached.get('subnets', []),
         f"arn:aws:ecs:{region}:{account_id}:cluster/Integrals-CDK-Cluster",
         f"arn:aws:ecs:{region}:{account_id}:task-definition/IntegralsTaskDefinition",
         f's3://{bucket_name}/',
@@ -66,7 +142,7 @@ def run_ecs_task(command, s3_path, aws_resources):
         launchType='FARGATE',
         networkConfiguration={
             'awsvpcConfiguration': {
-                'subnets': aws_resources.subnets,
+                'subnets': aws_resources.subnets or resolve_subnets(),
                 'assignPublicIp': 'ENABLED'
             }
         },
@@ -104,6 +180,24 @@ def wait_for_task(arn, aws_resources):
     waiter.wait(cluster=aws_resources.cluster_arn, tasks=[arn])
 
 
+# Input of the execution of a job, see execute-state-machine for the parameters
+def job_input(bucket_name, jobid, xyz, basis_set, num_parts, max_iter, batch_execution, epsilon, fused_scf,
+              result_cache, diis='false', diis_epsilon=None) -> dict:
+    return {
+        "commands": ["info", "--xyz", xyz, "--basis_set", basis_set],
+        "s3_bucket_path": f's3://{bucket_name}/job_files/{jobid}/json_files/{jobid}_info.json',
+        "num_batch_jobs": num_parts,
+        "jobid": jobid,
+        "batch_execution": batch_execution,
+        "max_iter": max_iter,
+        "epsilon": epsilon,
+        "fused_scf": fused_scf,
+        "result_cache": result_cache,
+        "diis": diis,
+        "diis_epsilon": diis_epsilon
+    }
+
+
 # State machine execution
 def exec_state_machine(input, aws_resources, name):
     response = sfn.start_execution(
@@ -116,23 +210,56 @@ def exec_state_machine(input, aws_resources, name):
 
 # Get State Machine Execution Status (latest to oldest)
 def get_exec_status(jobid, aws_resources):
-    # TODO Look into nextToken in case it is required
     execution_arn = f"{aws_resources.exec_arn}:{jobid}"
     status = sfn.describe_execution(executionArn=execution_arn)['status']
-    exec_history = sfn.get_execution_history(
-        executionArn=execution_arn,
-        reverseOrder=True,
-        includeExecutionData=True
-    )
+    # Latest events first, following nextToken only until the latest TaskStateEntered event (the current step)
+    events = []
+    paginator = sfn.get_paginator('get_execution_history')
+    pages = paginator.paginate(
+        executionArn=execution_arn, reverseOrder=True, includeExecutionData=True, PaginationConfig={'PageSize': 100})
+    for page in pages:
+        events.extend(page['events'])
+        if status != 'RUNNING' or any(event['type'] == 'TaskStateEntered' for event in page['events']):
+            break
     return {
         'status': status,
-        'history': exec_history
+        'history': {'events': events}
     }
 
 
-def list_execs(aws_resources):
-    executions = sfn.list_executions(stateMachineArn=aws_resources.sfn_arn)['executions']
-    return executions
+# Returns the events of an execution newer than last_event_id, oldest first. The history is read latest first and
+# only down to last_event_id, so polling a long execution does not download its whole history again.
+def get_new_exec_events(jobid, aws_resources, last_event_id=0):
+    execution_arn = f"{aws_resources.exec_arn}:{jobid}"
+    events = []
+    paginator = sfn.get_paginator('get_execution_history')
+    pages = paginator.paginate(
+        executionArn=execution_arn, reverseOrder=True, includeExecutionData=True, PaginationConfig={'PageSize': 100})
+    for page in pages:
+        events.extend(event for event in page['events'] if event['id'] > last_event_id)
+        if any(event['id'] <= last_event_id for event in page['events']):
+            break
+    return events[::-1]
+
+
+# Lists executions (latest first) with the given statuses that started between since and until (datetimes)
+def list_execs(aws_resources, statuses=None, since=None, until=None):
+    executions = []
+    paginator = sfn.get_paginator('list_executions')
+    for status in statuses or [None]:
+        args = {'stateMachineArn': aws_resources.sfn_arn}
+        if status:
+            args['statusFilter'] = status
+        for page in paginator.paginate(**args):
+            page_executions = page['executions']
+            executions.extend(
+                e for e in page_executions
+                if (since is None or e['startDate'] >= since) and (until is None or e['startDate'] <= until)
+            )
+            # Executions are listed latest first, the remaining pages started before since
+            if since is not None and page_executions and page_executions[-1]['startDate'] < since:
+                break
+    return sorted(executions, key=lambda e: e['startDate'], reverse=True)
 
 
 # Abort state machine execution
@@ -150,62 +277,364 @@ def get_json_from_bucket(bucket_name, key):
     return json.loads(obj['Body'].read())
 
 
-# Deletes all files with associated with the jobid
-def delete_files_from_bucket(bucket_name, jobid):
-    objects_tei = s3.list_objects_v2(Bucket=bucket_name, Prefix=jobid)
-    objects_other = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"job_files/{jobid}")
-    objects_args = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"tei_args/{jobid}")
-    if 'Contents' in objects_tei:
-        for obj in objects_tei['Contents']:
-            print(f"Deleting {obj['Key']}")
-            s3.delete_object(Bucket=bucket_name, Key=obj['Key'])
-    if 'Contents' in objects_other:
-        for obj in objects_other['Contents']:
-            print(f"Deleting {obj['Key']}")
-            s3.delete_object(Bucket=bucket_name, Key=obj['Key'])
-    if 'Contents' in objects_args:
-        for obj in objects_args['Contents']:
-            print(f"Deleting {obj['Key']}")
-            s3.delete_object(Bucket=bucket_name, Key=obj['Key'])
-
-
-# Downloads all files associated with the jobid to the target directory (without / at the end)
-def download_files_from_bucket(bucket_name, jobid, target):
-    directory_name = jobid
-    # Create directories
-    path_to_root = os.path.join(target, directory_name)
-    if not os.path.isdir(path_to_root):
-        os.mkdir(path_to_root)
-    path_to_json = os.path.join(path_to_root, 'json_files')
-    path_to_bin = os.path.join(path_to_root, 'bin_files')
-    if not os.path.isdir(path_to_json):
-        os.mkdir(path_to_json)
-    if not os.path.isdir(path_to_bin):
-        os.mkdir(path_to_bin)
-    objects_tei = s3.list_objects_v2(Bucket=bucket_name, Prefix=jobid)
-    if 'Contents' in objects_tei:
-        for obj in objects_tei['Contents']:
-            print(f"Downloading: {obj['Key']}")
-            s3.download_file(
-                bucket_name, obj['Key'],
-                os.path.join(path_to_root, obj['Key'][get_start_point(obj['Key'], '/'):]))
-    objects_other_bin = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"job_files/{jobid}/bin_files")
-    if 'Contents' in objects_other_bin:
-        for obj in objects_other_bin['Contents']:
-            print(f"Downloading: {obj['Key']}")
-            s3.download_file(
-                bucket_name, obj['Key'],
-                os.path.join(path_to_bin, obj['Key'][get_start_point(obj['Key'], '/'):]))
-    objects_other_json = s3.list_objects_v2(Bucket=bucket_name, Prefix=f"job_files/{jobid}/json_files")
-    if 'Contents' in objects_other_json:
-        for obj in objects_other_json['Contents']:
-            print(f"Downloading: {obj['Key']}")
-            s3.download_file(
-                bucket_name, obj['Key'],
-                os.path.join(path_to_json, obj['Key'][get_start_point(obj['Key'], '/'):]))
+# Same as get_json_from_bucket, None when the object does not exist
+def find_json_in_bucket(bucket_name, key):
+    try:
+        return get_json_from_bucket(bucket_name, key)
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
+# Deletes all files associated with the jobid. The prefixes are listed and deleted concurrently, in batches of up
+# to 1000 keys per delete_objects call. Returns the number of deleted objects and the (key, error) pairs of the
+# objects that could not be deleted.
+def delete_files_from_bucket(bucket_name, jobid, threads=8):
+    prefixes = [f"{jobid}_", f"job_files/{jobid}/", f"tei_args/{jobid}/"]
+
+    def delete_batch(keys):
+        response = s3.delete_objects(
+            Bucket=bucket_name, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        return [(error['Key'], f"{error['Code']}: {error['Message']}") for error in response.get('Errors', [])]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        keys = [obj['Key'] for objects in executor.map(lambda p: list_objects(bucket_name, p), prefixes)
+                for obj in objects]
+        batches = [keys[i:i + 1000] for i in range(0, len(keys), 1000)]
+        errors = [error for batch_errors in executor.map(delete_batch, batches) for error in batch_errors]
+    print(f"Deleted {len(keys) - len(errors)} files of job {jobid}")
+    return len(keys) - len(errors), errors
+
+
+# Lists all objects under prefix, following continuation tokens past the 1000 keys of a single response
+def list_objects(bucket_name, prefix):
+    objects = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+    return objects
+
+
+# Returns the objects of a job as (object, path relative to the job directory). ERI shards go to the root of the
+# job directory, the other files to bin_files, json_files, input and profile.
+def list_job_files(bucket_name, jobid):
+    prefixes = {
+        f"{jobid}_": '',
+        f"job_files/{jobid}/bin_files/": 'bin_files',
+        f"job_files/{jobid}/json_files/": 'json_files',
+        f"job_files/{jobid}/input/": 'input',
+        f"job_files/{jobid}/profile/": 'profile',
+    }
+    with ThreadPoolExecutor(max_workers=len(prefixes)) as executor:
+        listings = executor.map(lambda prefix: list_objects(bucket_name, prefix), prefixes)
+        return [
+            (obj, os.path.join(directory, obj['Key'][get_start_point(obj['Key'], '/'):]))
+            for directory, objects in zip(prefixes.values(), listings) for obj in objects
+        ]
+
+
+# Whether a path relative to the job directory passes the include/exclude glob patterns (e.g. "json_files/*",
+# "*scf_step*"). With no include patterns every file is included.
+def is_selected(path, include, exclude):
+    if include and not any(fnmatch.fnmatch(path, pattern) for pattern in include):
+        return False
+    return not any(fnmatch.fnmatch(path, pattern) for pattern in exclude)
+
+
+# Whether the local file at path is the object, judged by the ETag recorded when the file was downloaded (the ETag of
+# a multipart upload is not the MD5 of the file, and compressed objects are stored decompressed), else by its size
+# and MD5.
+def is_downloaded(path, obj, etags):
+    if not os.path.isfile(path):
+        return False
+    etag = obj['ETag'].strip('"')
+    if etags.get(path) == etag:
+        return True
+    if os.path.getsize(path) != obj['Size']:
+        return False
+    if '-' in etag:
+        return False
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest() == etag
+
+
+# Downloads all files associated with the jobid to the target directory (without / at the end). Files already
+# downloaded are skipped, so an interrupted download can be resumed by running it again.
+def download_files_from_bucket(bucket_name, jobid, target, include=(), exclude=(), threads=16):
+    path_to_root = os.path.join(target, jobid)
+    for directory in ('json_files', 'bin_files', 'input', 'profile'):
+        os.makedirs(os.path.join(path_to_root, directory), exist_ok=True)
+    # ETags of the files downloaded so far, kept next to the files
+    etags_path = os.path.join(path_to_root, '.etags.json')
+    etags = {}
+    if os.path.isfile(etags_path):
+        with open(etags_path) as f:
+            etags = json.load(f)
+    files = [
+        (obj, os.path.join(path_to_root, path)) for obj, path in list_job_files(bucket_name, jobid)
+        if is_selected(path, include, exclude)
+    ]
+    pending = [(obj, path) for obj, path in files if not is_downloaded(path, obj, etags)]
+    print(f"{len(files)} files selected, {len(files) - len(pending)} already downloaded")
+
+    # Compressed .bin objects are decompressed while they are downloaded
+    def download(obj, path):
+        binfile.download(s3, bucket_name, obj['Key'], path)
+        return obj['ETag'].strip('"')
+
+    start = time.time()
+    downloaded = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(download, obj, path): (obj, path) for obj, path in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            obj, path = futures[future]
+            try:
+                etags[path] = future.result()
+                downloaded += obj['Size']
+            except Exception as e:
+                errors.append((obj['Key'], e))
+            if done % 100 == 0 or done == len(futures):
+                with open(etags_path, 'w') as f:
+                    json.dump(etags, f)
+                elapsed = max(time.time() - start, 1e-6)
+                print(f"{done}/{len(futures)} files, {downloaded / 1024 ** 2:.1f} MiB, "
+                      f"{downloaded / 1024 ** 2 / elapsed:.1f} MiB/s")
+    for key, error in errors:
+        print(f"Could not download {key}: {error}")
 
 
 def get_start_point(str, substr):
     if substr not in str:
         return 0
     return str.rindex(substr) + 1
+
+
+# Phases of a task record, in the order they happen
+PROFILE_PHASES = ('queue', 'fetch', 'compute', 'upload', 'signal')
+# Steps run at the same time by the parallel state of the state machine
+PARALLEL_STEPS = ('one_electron', 'core_hamiltonian', 'overlap', 'initial_guess', 'two_electrons_integrals')
+
+
+# Returns the task records the workers wrote under job_files/{jobid}/profile/
+def read_job_profile(bucket_name, jobid) -> List[dict]:
+    objects = list_objects(bucket_name, f"job_files/{jobid}/profile/")
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        bodies = executor.map(lambda obj: s3.get_object(Bucket=bucket_name, Key=obj['Key'])['Body'].read(), objects)
+        return [json.loads(line) for body in bodies for line in body.decode().splitlines() if line]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# Count, mean/p50/p95/max of each phase and of the time from enqueue to completion, bytes moved and peak RSS
+def summarize_records(records) -> dict:
+    summary = {
+        'count': len(records),
+        'read': sum(record['read'] for record in records),
+        'written': sum(record['written'] for record in records),
+        'rss_kb': max(record['rss_kb'] for record in records),
+    }
+    for phase in PROFILE_PHASES + ('total',):
+        values = [record['end'] - record['sent'] if phase == 'total' else record[phase] for record in records]
+        summary[phase] = {
+            'mean': sum(values) / len(values),
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'max': max(values),
+        }
+    return summary
+
+
+# Start (first enqueue) and end (last completion) of a group of records
+def span(records):
+    return min(record['sent'] for record in records), max(record['end'] for record in records)
+
+
+# Aggregates the task records of a job. Forwarded records (tasks passed to the worker holding the ERI shards) are
+# only counted, their time is part of the record of the worker that ran them.
+def profile_job(records, straggler_factor=1.5, slowest=5) -> dict:
+    run = [record for record in records if record['status'] != 'forwarded']
+    steps: Dict[str, List[dict]] = {}
+    for record in run:
+        steps.setdefault(record['step'], []).append(record)
+
+    iterations: Dict[int, Dict[str, dict]] = {}
+    for step in ('fock_matrix', 'scf_step'):
+        for record in steps.get(step, []):
+            iterations.setdefault(record['index'], {})[step] = record
+
+    # Critical path: the stages of the state machine run one after the other. The time between the end of a stage
+    # and the first enqueue of the next one is spent in the Lambdas and state transitions.
+    stages = []
+    if 'info' in steps:
+        stages.append({'stage': 'info', 'span': span(steps['info']), 'dominant': 'info'})
+    branches = {step: span(steps[step]) for step in PARALLEL_STEPS if step in steps}
+    if branches:
+        dominant = max(branches, key=lambda step: branches[step][1])
+        stages.append({
+            'stage': 'parallel',
+            'span': (min(start for start, _ in branches.values()), branches[dominant][1]),
+            'dominant': dominant,
+        })
+    if 'scf_loop' in steps:
+        stages.append({'stage': 'scf_loop', 'span': span(steps['scf_loop']), 'dominant': 'scf_loop'})
+    for index in sorted(iterations):
+        tasks = iterations[index]
+        dominant = max(tasks, key=lambda step: tasks[step]['end'] - tasks[step]['sent'])
+        stages.append({'stage': f"iteration {index}", 'span': span(list(tasks.values())), 'dominant': dominant})
+    previous_end = None
+    for stage in stages:
+        start, end = stage['span']
+        stage['duration'] = end - start
+        stage['gap'] = max(0.0, start - previous_end) if previous_end is not None else 0.0
+        previous_end = end
+
+    # Stragglers: ERI slices that took straggler_factor times the median slice or more, else the slowest ones
+    slices = sorted(steps.get('two_electrons_integrals', []), key=lambda record: record['end'] - record['start'])
+    median = percentile([record['end'] - record['start'] for record in slices], 0.5) if slices else None
+    stragglers = []
+    if slices:
+        stragglers = [record for record in slices if record['end'] - record['start'] >= straggler_factor * median]
+        stragglers = (stragglers or slices[-slowest:])[::-1]
+
+    return {
+        'tasks': len(run),
+        'forwarded': len(records) - len(run),
+        'steps': {step: summarize_records(step_records) for step, step_records in steps.items()},
+        'iterations': {
+            index: {step: record['end'] - record['sent'] for step, record in tasks.items()}
+            for index, tasks in sorted(iterations.items())
+        },
+        'critical_path': stages,
+        'wall': stages[-1]['span'][1] - stages[0]['span'][0] if stages else 0.0,
+        'stragglers': stragglers,
+        'slice_median': median,
+    }
+
+
+# Name of the deleted jobs table the deleteJob Lambda writes to when a job is aborted
+DELETED_JOB_TABLE = 'IntegralsDeletedJobTable'
+# Steps of the parallel state that a resumed job can skip
+ONE_ELECTRON_STEPS = ('core_hamiltonian', 'overlap', 'initial_guess')
+
+
+# Executions of a job, oldest first: the execution named after the job id followed by the ones started by resume
+# ({jobid}-r1, {jobid}-r2...)
+def list_job_execs(jobid, aws_resources):
+    executions = []
+    while True:
+        name = jobid if not executions else f"{jobid}-r{len(executions)}"
+        try:
+            executions.append(sfn.describe_execution(executionArn=f"{aws_resources.exec_arn}:{name}"))
+        except sfn.exceptions.ExecutionDoesNotExist:
+            return executions
+
+
+# Prefix of the ERI shards the loop of an earlier execution read (another job's when they came from the result
+# cache), from the input of a resumed execution or the output of the parallel state. None if no execution got there.
+def find_eri_prefix(executions):
+    for execution in reversed(executions):
+        execution_input = json.loads(execution['input'])
+        if execution_input.get('eri_prefix'):
+            return execution_input['eri_prefix']
+        paginator = sfn.get_paginator('get_execution_history')
+        for page in paginator.paginate(executionArn=execution['executionArn'], includeExecutionData=True):
+            for event in page['events']:
+                details = event.get('stateExitedEventDetails', {})
+                if event['type'] == 'ParallelStateExited' and details.get('name') == 'parallelExec':
+                    return json.loads(details['output'])['eri_prefix']
+    return None
+
+
+# Whether a step wrote a successful JSON output and its .bin output
+def is_step_complete(bucket_name, jobid, step, objects):
+    output = find_json_in_bucket(bucket_name, f"job_files/{jobid}/json_files/{jobid}_{step}.json")
+    return bool(output and output.get('success') is True and f"{jobid}_{step}.bin" in objects)
+
+
+# Finds what a failed or aborted job completed from its outputs in the bucket, and where it can continue: at the
+# info step when the info output is missing, at the parallel state skipping the completed steps, or in the loop
+# after the last iteration whose scf_step outputs are both in the bucket. loopData and hartree_fock_energy are
+# replayed from the energies of the completed iterations, as updateLoopVariables computed them.
+def plan_resume(bucket_name, jobid, job_input, eri_prefix):
+    plan = {'resume_from': 'info', 'completed_steps': [], 'iterations': 0}
+    info = find_json_in_bucket(bucket_name, f"job_files/{jobid}/json_files/{jobid}_info.json")
+    if not info or info.get('success') is not True:
+        return plan
+    objects = {obj['Key'].rsplit('/', 1)[-1] for obj in list_objects(bucket_name, f"job_files/{jobid}/bin_files/")}
+    completed = [step for step in ONE_ELECTRON_STEPS if is_step_complete(bucket_name, jobid, step, objects)]
+    if eri_prefix is None and find_json_in_bucket(bucket_name, shard_record_key(jobid)):
+        eri_prefix = jobid
+    if eri_prefix is not None:
+        completed.append('two_electrons_integrals')
+    plan.update(resume_from='parallel', completed_steps=completed, eri_prefix=eri_prefix)
+    if len(completed) < 4:
+        return plan
+
+    loop_data = {'loopCount': 1, 'hartree_diff': sys.float_info.max}
+    energy = None
+    while True:
+        step = f"scf_step_{loop_data['loopCount'] - 1}"
+        if not is_step_complete(bucket_name, jobid, step, objects):
+            break
+        output = get_json_from_bucket(bucket_name, f"job_files/{jobid}/json_files/{jobid}_{step}.json")
+        diis_error = None
+        if job_input.get('diis', 'false') == 'true':
+            fock = find_json_in_bucket(
+                bucket_name, f"job_files/{jobid}/json_files/{jobid}_fock_matrix_{loop_data['loopCount'] - 1}.json")
+            diis_error = fock.get('diis_error') if fock else None
+        loop_data = next_loop_data(
+            loop_data, energy, output['hartree_fock_energy'], diis_error, job_input.get('diis_epsilon'))
+        energy = output['hartree_fock_energy']
+    plan.update(
+        resume_from='loop', iterations=loop_data['loopCount'] - 1, loopData=loop_data, hartree_fock_energy=energy,
+        finished=not loop_continues(loop_data, job_input['max_iter'], job_input['epsilon']))
+    return plan
+
+
+# Commands of the job with --xyz pointing at the copy the info step staged, when there is one. Resumed steps then read
+# the geometry the completed steps used instead of fetching the original URL again.
+def staged_commands(bucket_name, jobid, commands):
+    key = staged_xyz_key(jobid)
+    if not any(obj['Key'] == key for obj in list_objects(bucket_name, key)):
+        return commands
+    return [f"s3://{bucket_name}/{key}" if i > 0 and commands[i - 1] == '--xyz' else arg
+            for i, arg in enumerate(commands)]
+
+
+# Input of the execution that continues a job from plan (see plan_resume). attempt numbers the resumed executions.
+def resume_input(bucket_name, job_input, plan, attempt):
+    if plan['resume_from'] == 'info':
+        return job_input
+    job_input = {**job_input, 'commands': staged_commands(bucket_name, job_input['jobid'], job_input['commands'])}
+    if plan['resume_from'] == 'parallel':
+        resumed = {
+            **job_input, 'resume_from': 'parallel', 'completed_steps': plan['completed_steps'], 'resume': attempt,
+        }
+        if plan['eri_prefix'] is not None:
+            # Where the shards of the completed two_electrons_integrals step are, they are not always the job's own
+            resumed['eri_prefix'] = plan['eri_prefix']
+        return resumed
+    return {
+        'commands': job_input['commands'],
+        's3_bucket_path': job_input['s3_bucket_path'],
+        'jobid': job_input['jobid'],
+        'max_iter': job_input['max_iter'],
+        'epsilon': job_input['epsilon'],
+        'fused_scf': job_input.get('fused_scf', 'false'),
+        'diis': job_input.get('diis', 'false'),
+        'diis_epsilon': job_input.get('diis_epsilon'),
+        'eri_prefix': plan['eri_prefix'],
+        'loopData': plan['loopData'],
+        'hartree_fock_energy': plan['hartree_fock_energy'],
+        'resume_from': 'loop',
+    }
+
+
+# Removes the job from the deleted jobs table, so the workers run the tasks of an aborted job again
+def undelete_job(jobid):
+    dynamo.delete_item(TableName=DELETED_JOB_TABLE, Key={'jobid': {'S': jobid}})
@@ -0,0 +1,247 @@
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+# Root of the repository, the Lambda handlers and the shared layer are loaded from the cdk directory
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LAMBDA_DIR = os.path.join(REPO_ROOT, 'cdk', 'lambda')
+# Shared Lambda layer, also used by the worker (shared/binfile.py is used by the CLI downloads)
+LAYER_DIR = os.path.join(LAMBDA_DIR, 'layer', 'python')
+# Bucket name the Lambda handlers see, its objects are files under <workdir>/<LOCAL_BUCKET>/
+LOCAL_BUCKET = 'local'
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+# The Lambda handlers are not installed with the CLI, the local runner needs a checkout of the repository
+class CheckoutError(Exception):
+    pass
+
+
+# Minimal stand-in for the S3 client calls made by the Lambda handlers, backed by a directory
+class LocalS3:
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket, key) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    # Key of an s3://<LOCAL_BUCKET>/ URL
+    def key(self, url) -> str:
+        return url[len(f"s3://{LOCAL_BUCKET}/"):]
+
+    def get_object(self, Bucket, Key):
+        try:
+            with open(self.path(Bucket, Key), 'rb') as f:
+                return {'Body': io.BytesIO(f.read())}
+        except FileNotFoundError:
+            raise NoSuchKey(Key)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': os.path.getsize(self.path(Bucket, Key))}
+
+    def copy(self, source, bucket, key):
+        os.makedirs(os.path.dirname(self.path(bucket, key)), exist_ok=True)
+        shutil.copyfile(self.path(source['Bucket'], source['Key']), self.path(bucket, key))
+
+
+# Collects the messages the Lambda handlers send to the task queue
+class LocalQueue:
+    def __init__(self):
+        self.messages: List[dict] = []
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.messages.append(json.loads(MessageBody))
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.messages.extend(json.loads(entry['MessageBody']) for entry in Entries)
+        return {}
+
+
+# Stand-in for the deleted jobs table, local jobs are never deleted. The plans written to the batch table for the
+# scaleWorkers Lambda (shared/scaling.py) are dropped, there is no service to scale.
+class LocalDeletedJobs:
+    def get_item(self, TableName, Key):
+        return {}
+
+    def put_item(self, TableName, Item):
+        pass
+
+    def delete_item(self, TableName, Key):
+        pass
+
+
+# Loads a Lambda handler module with its AWS clients replaced by the local stand-ins
+def load_lambda(name, s3, queue):
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'ca-central-1')
+    os.environ['ER_S3_BUCKET'] = LOCAL_BUCKET
+    os.environ.setdefault('TASK_QUEUE', 'local')
+    os.environ.setdefault('BATCH_TABLE', 'local')
+    os.environ.setdefault('DELETED_JOB_TABLE', 'local')
+    for path in (LAYER_DIR, os.path.join(LAMBDA_DIR, name)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    from shared.completion import CompletionTracker, LocalBackend
+    from shared.result_cache import ResultCache
+
+    spec = importlib.util.spec_from_file_location(f"local_{name}", os.path.join(LAMBDA_DIR, name, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.s3 = s3
+    if hasattr(module, 'sqs'):
+        module.sqs = queue
+    if hasattr(module, 'dynamo'):
+        module.dynamo = LocalDeletedJobs()
+    if hasattr(module, 'tracker'):
+        module.tracker = CompletionTracker(LocalBackend())
+    if hasattr(module, 'result_cache'):
+        module.result_cache = ResultCache(s3, LOCAL_BUCKET)
+    # Every task is run by the local runner, the slices of a job are not put in a queue of their own or grouped
+    if hasattr(module, 'fair_share'):
+        module.fair_share = False
+    if hasattr(module, 'dispatch_seconds'):
+        module.dispatch_seconds = 0
+    return module
+
+
+# Runs the state machine of cdk-stack.ts on this machine: the Lambda handlers are called directly, the integrals
+# binary runs in a pool of local processes and the job bucket is a directory
+class LocalRunner:
+    def __init__(self, workdir, integrals_path, processes):
+        if not os.path.isdir(LAMBDA_DIR):
+            raise CheckoutError(
+                f"The Lambda handlers are not in {LAMBDA_DIR}, run-local must be run from a checkout of the repository "
+                "(pip install -e cli)")
+        self.workdir = os.path.abspath(workdir)
+        self.integrals_path = integrals_path
+        self.processes = processes
+        os.makedirs(os.path.join(self.workdir, LOCAL_BUCKET), exist_ok=True)
+        self.s3 = LocalS3(self.workdir)
+        self.queue = LocalQueue()
+        self.setup_calculations = load_lambda('setupCalculations', self.s3, self.queue)
+        self.setup_tei = load_lambda('setupTei', self.s3, self.queue)
+        self.update_loop_variables = load_lambda('updateLoopVariables', self.s3, self.queue)
+
+    # Rewrites the S3 locations of a command (output objects, s3:// URLs and the ERI prefix) to file:// URLs
+    def localize(self, commands) -> List[str]:
+        local = commands[:1]
+        i = 1
+        while i < len(commands):
+            flag = commands[i]
+            value = commands[i + 1] if i + 1 < len(commands) else None
+            if flag == '--output_object':
+                os.makedirs(os.path.dirname(self.s3.path(LOCAL_BUCKET, value)), exist_ok=True)
+                local += ['--output_url', f"file://{self.s3.path(LOCAL_BUCKET, value)}"]
+            elif flag == '--eri_prefix':
+                local += [flag, f"file://{self.s3.path(LOCAL_BUCKET, value)}"]
+            elif flag.startswith('--') and value and value.startswith(f"s3://{LOCAL_BUCKET}/"):
+                local += [flag, f"file://{self.s3.path(LOCAL_BUCKET, self.s3.key(value))}"]
+            else:
+                local += [flag] if value is None else [flag, value]
+            i += 2 if value is not None else 1
+        return local
+
+    # Runs one task (commands and s3_bucket_path as sent to the task queue) and returns its JSON output
+    def run_task(self, value) -> dict:
+        cmds = self.localize(value['commands'])
+        result = subprocess.run([self.integrals_path] + cmds, stdout=subprocess.PIPE, cwd=self.workdir)
+        output = result.stdout.decode()
+        if not output:
+            raise Exception(f"NO OUTPUT FILE GENERATED for {value['commands'][0]}")
+        self.s3.put_object(Bucket=LOCAL_BUCKET, Key=self.s3.key(value['s3_bucket_path']), Body=output.encode())
+        parsed = json.loads(output)
+        if parsed.get('success') is not True:
+            raise Exception(f"{value['commands'][0]} failed: {json.dumps(parsed.get('error'))}")
+        return parsed
+
+    def run_tasks(self, values) -> List[dict]:
+        with ThreadPoolExecutor(max_workers=self.processes) as executor:
+            return list(executor.map(self.run_task, values))
+
+    # Expands the messages setupTei sent (manifest slices or one sequential task) into task inputs
+    def tei_tasks(self) -> List[dict]:
+        from shared.manifest import slice_task
+
+        tasks = []
+        manifests: Dict[str, dict] = {}
+        for message in self.queue.messages:
+            value = message['input']['value']
+            if 'manifest' not in value:
+                tasks.append(value)
+                continue
+            url = value['manifest']
+            if url not in manifests:
+                obj = self.s3.get_object(Bucket=LOCAL_BUCKET, Key=self.s3.key(url))
+                manifests[url] = json.loads(obj['Body'].read())
+            slices = value['slices'] if 'slices' in value else [value['slice']]
+            tasks += [slice_task(manifests[url], i) for i in slices]
+        self.queue.messages.clear()
+        return tasks
+
+    def setup(self, state, step_name) -> dict:
+        return self.setup_calculations.lambda_handler({**state, 'output': {'stepName': step_name}}, None)
+
+    def run(self, xyz, basis_set, num_parts, max_iter, batch_execution, epsilon, log=print) -> dict:
+        from shared.scf import loop_continues
+
+        jobid = str(uuid.uuid4())
+        if os.path.exists(xyz):
+            xyz = f"file://{os.path.abspath(xyz)}"
+        state = {
+            "commands": ["info", "--xyz", xyz, "--basis_set", basis_set],
+            "s3_bucket_path": f"s3://{LOCAL_BUCKET}/job_files/{jobid}/json_files/{jobid}_info.json",
+            "num_batch_jobs": num_parts,
+            "jobid": jobid,
+            "batch_execution": batch_execution,
+            "max_iter": max_iter,
+            "epsilon": epsilon,
+            "fused_scf": "false",
+            "result_cache": "false",
+        }
+        log(f"Job {jobid}: info")
+        self.run_task(state)
+
+        # Parallel step: the one-electron steps and the ERI fan-out run in the same pool
+        log(f"Job {jobid}: core_hamiltonian, overlap, initial_guess and two_electrons_integrals")
+        one_electron = self.setup(state, 'one_electron')
+        self.setup_tei.lambda_handler({'payload': state, 'task_token': 'local'}, None)
+        tei = self.tei_tasks()
+        self.run_tasks(one_electron['steps'] + tei)
+        state = {
+            'commands': one_electron['commands'],
+            's3_bucket_path': one_electron['s3_bucket_path'],
+            'jobid': jobid,
+            'max_iter': max_iter,
+            'epsilon': epsilon,
+            'fused_scf': 'false',
+            'eri_prefix': jobid,
+            'loopData': {'loopCount': 1, 'hartree_diff': sys.float_info.max},
+        }
+
+        # Fock-SCF loop
+        while loop_continues(state['loopData'], state['max_iter'], state['epsilon']):
+            for step in ('fock_matrix', 'scf_step'):
+                state = self.setup(state, step)
+                self.run_task(state)
+            state = self.update_loop_variables.lambda_handler(state, None)
+            log(f"Job {jobid}: iteration {state['loopData']['loopCount'] - 1}, "
+                f"hartree_fock_energy {state['hartree_fock_energy']}, hartree_diff {state['loopData']['hartree_diff']}")
+        return state
@@ -1,12 +1,23 @@
 import click
 import uuid
+import cli.batch as batch
 import cli.helpers as helpers
+from cli.local import LOCAL_BUCKET, CheckoutError, LocalRunner
+from shared.result_cache import ResultCache
 import json
+import os
+from datetime import datetime, timedelta, timezone
+from time import sleep
+from typing import Dict
 
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    '--refresh', is_flag=True,
+    help="Resolve the AWS resources again instead of using the cached ones (e.g. after redeploying the stack)")
+def cli(refresh):
+    if refresh:
+        helpers.clear_resource_cache()
 
 
 @cli.command(help="Execute a calculation on the AWS Step Functions")
@@ -20,31 +31,90 @@ def cli():
 @click.option(
     '--epsilon', help="The difference between the previous and current hartree_fock_energy to mark the end of the loop",
     default=0.000000001)
-def execute_state_machine(xyz, basis_set, bucket, num_parts, max_iter, batch_execution, epsilon):
+@click.option(
+    '--fused_scf', help="Enter true to run the whole Fock-SCF loop in one worker task else false (defaults to false)",
+    default="false")
+@click.option(
+    '--result_cache',
+    help="Enter false to recompute steps already run for the same geometry and basis set (defaults to true)",
+    default="true")
+@click.option(
+    '--diis', help="Enter true to extrapolate the Fock matrix of every iteration with DIIS (defaults to false)",
+    default="false")
+@click.option(
+    '--diis_epsilon', type=float, default=None,
+    help="With DIIS, the loop also ends once the RMS of the Fock matrix error is at most this value")
+def execute_state_machine(xyz, basis_set, bucket, num_parts, max_iter, batch_execution, epsilon, fused_scf,
+                          result_cache, diis, diis_epsilon):
     click.echo("Getting resources...")
     aws_resources = helpers.resolve_resource_config(bucket)
     click.echo("Starting state machine execution...")
     job_id = str(uuid.uuid4())
-    inputDict = {
-        "commands": ["info", "--xyz", xyz, "--basis_set", basis_set],
-        "s3_bucket_path": f's3://{bucket}/job_files/{job_id}/json_files/{job_id}_info.json',
-        "num_batch_jobs": num_parts,
-        "jobid": job_id,
-        "batch_execution": batch_execution,
-        "max_iter": max_iter,
-        "epsilon": epsilon
-    }
+    inputDict = helpers.job_input(
+        bucket, job_id, xyz, basis_set, num_parts, max_iter, batch_execution, epsilon, fused_scf, result_cache,
+        diis, diis_epsilon)
     helpers.exec_state_machine(input=inputDict, aws_resources=aws_resources, name=job_id)
     print("Job started successfully!")
     print(f"Job Id: {job_id}")
 
 
+@cli.command(help="Start the jobs of a CSV or JSON manifest, a few at a time")
+@click.option(
+    '--manifest', required=True,
+    help="CSV file (with a header row) or JSON list with the columns xyz, basis_set and optionally max_iter, epsilon, "
+         "num_parts, batch_execution, fused_scf, result_cache, diis and diis_epsilon")
+@click.option('--bucket', help="Bucket for job metadata", required=True)
+@click.option(
+    '--state_file', default=None,
+    help="File recording the job id of every row (defaults to <manifest>.state.json), run again to continue")
+@click.option('--max_active', help="Maximum number of jobs of the batch running at the same time", default=20)
+@click.option('--rate', help="Maximum number of executions started per second", default=2.0)
+@click.option('--threads', help="Number of executions started concurrently", default=4)
+@click.option('--interval', help="Seconds between two checks of the running jobs while --max_active are running",
+              default=15.0)
+def submit_batch(manifest, bucket, state_file, max_active, rate, threads, interval):
+    try:
+        rows = batch.read_manifest(manifest)
+    except batch.ManifestError as e:
+        raise click.UsageError(str(e))
+    click.echo("Getting resources...")
+    aws_resources = helpers.resolve_resource_config(bucket)
+    state = batch.BatchState(state_file or f"{manifest}.state.json")
+    submitter = batch.BatchSubmitter(bucket, aws_resources, state, max_active, rate, threads, interval)
+    submitter.submit(rows)
+    print(f"Job ids are recorded in {state.path}")
+    print("Done!")
+
+
+@cli.command(help="Summarize the status of the jobs of a batch started with submit-batch")
+@click.option('--state_file', help="State file written by submit-batch", required=True)
+@click.option('--bucket', help="Bucket for job metadata", required=True)
+@click.option('--verbose', is_flag=True, help="Print the status of every row")
+def get_batch_status(state_file, bucket, verbose):
+    click.echo("Getting resources...")
+    aws_resources = helpers.resolve_resource_config(bucket)
+    rows = batch.batch_status(aws_resources, batch.BatchState(state_file))
+    counts: Dict[str, int] = {}
+    for index, job, status in rows:
+        counts[status] = counts.get(status, 0) + 1
+        if verbose:
+            print(f"{index:>5} {job['jobid']} {status:<13} {job['basis_set']} {job['xyz']}")
+    print(f"{len(rows)} jobs: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    print("Done!")
+
+
 @cli.command(help="Get status of a recent job using the job id")
 @click.option('--jobid', help="Id of the job to check status of", required=True)
 @click.option('--bucket', help="Bucket for job metadata", required=True)
-def get_status(jobid, bucket):
+@click.option(
+    '--follow', is_flag=True, help="Keep printing steps and loop iterations as they happen until the job ends")
+@click.option('--interval', help="Seconds between two polls with --follow", default=5)
+def get_status(jobid, bucket, follow, interval):
     click.echo("Getting resources...")
     aws_resources = helpers.resolve_resource_config(bucket)
+    if follow:
+        follow_status(jobid, aws_resources, interval)
+        return
     response = helpers.get_exec_status(jobid=jobid, aws_resources=aws_resources)
     status = response['status']
     print(f"Currect Execution Status: {status}")
@@ -89,12 +159,58 @@ def get_status(jobid, bucket):
         print(f"Job was aborted at: {time}")
 
 
-@cli.command(help="Get a list of all recent jobs' ids")
+# States whose output holds the loopData of the iterations completed so far
+LOOP_STATES = ('updateLoopVariables', 'scfLoopStep')
+
+
+# Prints the events of an execution as they arrive: steps starting, loop iterations and how the execution ended
+def follow_status(jobid, aws_resources, interval):
+    last_event_id = 0
+    while True:
+        for event in helpers.get_new_exec_events(jobid, aws_resources, last_event_id):
+            last_event_id = event['id']
+            time = event['timestamp'].strftime("%m/%d/%Y %H:%M:%S")
+            if event['type'] == 'TaskStateEntered':
+                print(f"{time} {event['stateEnteredEventDetails']['name']} step started")
+            elif event['type'] == 'TaskStateExited' and event['stateExitedEventDetails']['name'] in LOOP_STATES:
+                try:
+                    output = json.loads(event['stateExitedEventDetails'].get('output') or '{}')
+                except ValueError:
+                    continue
+                loop_data = output.get('loopData') if isinstance(output, dict) else None
+                if loop_data and output.get('hartree_fock_energy') is not None:
+                    print(f"{time} Iteration {int(loop_data['loopCount']) - 1}: "
+                          f"hartree_fock_energy {output['hartree_fock_energy']}, "
+                          f"hartree_diff {loop_data['hartree_diff']}")
+            elif event['type'] == 'ExecutionSucceeded':
+                job_output = json.loads(event['executionSucceededEventDetails']['output'])
+                print(f"{time} Execution completed successfully")
+                print(f"Final value of hartree_fock_energy: {job_output['hartree_fock_energy']}")
+                return
+            elif event['type'] == 'ExecutionFailed':
+                print(f"{time} Execution failed")
+                print(f"Cause: {event['executionFailedEventDetails'].get('cause')}")
+                return
+            elif event['type'] in ('ExecutionAborted', 'ExecutionTimedOut'):
+                print(f"{time} Job was {'aborted' if event['type'] == 'ExecutionAborted' else 'timed out'}")
+                return
+        sleep(interval)
+
+
+@cli.command(help="Get a list of recent jobs' ids, optionally filtered by status and start time")
 @click.option('--bucket', help="Bucket for job metadata", required=True)
-def get_execution_list(bucket):
+@click.option(
+    '--status', multiple=True, help="Only list jobs with this status, e.g. RUNNING or FAILED (repeatable)")
+@click.option('--since', type=click.DateTime(), help="Only list jobs started at or after this (local) time")
+@click.option('--until', type=click.DateTime(), help="Only list jobs started at or before this (local) time")
+def get_execution_list(bucket, status, since, until):
     click.echo("Getting resources...")
     aws_resources = helpers.resolve_resource_config(bucket)
-    executions = helpers.list_execs(aws_resources=aws_resources)
+    executions = helpers.list_execs(
+        aws_resources=aws_resources,
+        statuses=[s.upper() for s in status],
+        since=since.astimezone() if since else None,
+        until=until.astimezone() if until else None)
     for exec in executions:
         print(f"{exec['executionArn'].split(':')[-1]} - {exec['status']}")
 
@@ -108,22 +224,187 @@ def abort_execution(jobid):
     print(f"Job {jobid} aborted!")
 
 
-@cli.command(help="Delete all files related to a job from S3")
-@click.option('--jobid', help="Id of the job files to delete", required=True)
+@cli.command(help="Restart a failed or aborted job from its last completed step and loop iteration")
+@click.option('--jobid', help="Id of the job to resume", required=True)
 @click.option('--bucket', help="Bucket for job metadata", required=True)
-def delete_job_files(jobid, bucket):
-    helpers.delete_files_from_bucket(bucket_name=bucket, jobid=jobid)
+def resume(jobid, bucket):
+    click.echo("Getting resources...")
+    aws_resources = helpers.resolve_resource_config(bucket)
+    executions = helpers.list_job_execs(jobid, aws_resources)
+    if not executions:
+        raise click.UsageError(f"No execution found for job {jobid}")
+    if executions[-1]['status'] in ('RUNNING', 'SUCCEEDED'):
+        raise click.UsageError(f"The latest execution of job {jobid} ({executions[-1]['name']}) is "
+                               f"{executions[-1]['status'].lower()}")
+    job_input = json.loads(executions[0]['input'])
+    plan = helpers.plan_resume(bucket, jobid, job_input, helpers.find_eri_prefix(executions))
+    if plan.get('finished'):
+        print(f"Job {jobid} completed all {plan['iterations']} iterations of its loop, there is nothing to resume")
+        return
+    if plan['resume_from'] == 'info':
+        print("The info step did not complete, the whole job runs again")
+    elif plan['resume_from'] == 'parallel':
+        print(f"Completed steps: {', '.join(plan['completed_steps']) or 'none'}")
+    else:
+        print(f"Completed iterations: {plan['iterations']}, hartree_fock_energy {plan['hartree_fock_energy']}")
+    # The workers skip the tasks of aborted jobs
+    helpers.undelete_job(jobid)
+    name = f"{jobid}-r{len(executions)}"
+    helpers.exec_state_machine(
+        input=helpers.resume_input(bucket, job_input, plan, len(executions)), aws_resources=aws_resources, name=name)
+    print(f"Job resumed from the {plan['resume_from']} step, follow it with get-status --jobid {name}")
     print("Done!")
 
 
+@cli.command(help="Delete all files related to a job, or to all jobs finished before --older_than days, from S3")
+@click.option('--jobid', help="Id of the job files to delete")
+@click.option('--bucket', help="Bucket for job metadata", required=True)
+@click.option(
+    '--older_than', help="Delete the files of all jobs that finished more than this many days ago", type=float)
+@click.option(
+    '--status', multiple=True, default=['SUCCEEDED', 'FAILED', 'ABORTED', 'TIMED_OUT'],
+    help="With --older_than, only delete jobs with this final status (repeatable, defaults to all finished jobs)")
+def delete_job_files(jobid, bucket, older_than, status):
+    if (jobid is None) == (older_than is None):
+        raise click.UsageError("Pass either --jobid or --older_than")
+    if jobid is not None:
+        jobids = [jobid]
+    else:
+        click.echo("Getting resources...")
+        aws_resources = helpers.resolve_resource_config(bucket)
+        # Every execution is listed, a job's resumes decide whether it is finished
+        cutoff = datetime.now(timezone.utc) - timedelta(days=older_than)
+        jobids = batch.finished_jobs(helpers.list_execs(aws_resources), [s.upper() for s in status], cutoff)
+        print(f"Deleting the files of {len(jobids)} jobs")
+    errors = []
+    for id in jobids:
+        errors.extend(helpers.delete_files_from_bucket(bucket_name=bucket, jobid=id)[1])
+    for key, error in errors:
+        print(f"Could not delete {key}: {error}")
+    print("Done!" if not errors else f"Done, {len(errors)} files could not be deleted")
+
+
 @cli.command(help="Download all files related to a job from S3")
 @click.option('--jobid', help="Id of the job files to download", required=True)
 @click.option('--bucket', help="Bucket for job metadata", required=True)
 @click.option('--target', help="Target directory", required=True)
-def download_job_files(jobid, bucket, target):
-    helpers.download_files_from_bucket(bucket_name=bucket, jobid=jobid, target=target)
+@click.option(
+    '--include', multiple=True,
+    help="Only download files matching this pattern, e.g. 'json_files/*' (relative to the job directory, repeatable)")
+@click.option('--exclude', multiple=True, help="Skip files matching this pattern, e.g. '*.bin' (repeatable)")
+@click.option('--threads', help="Number of concurrent downloads", default=16)
+def download_job_files(jobid, bucket, target, include, exclude, threads):
+    helpers.download_files_from_bucket(
+        bucket_name=bucket, jobid=jobid, target=target, include=include, exclude=exclude, threads=threads)
     print("Done!")
 
 
+@cli.command(help="Gather the outputs of jobs into one compressed .npz file per job")
+@click.option('--jobid', multiple=True, help="Id of a job to gather (repeatable)")
+@click.option('--state_file', help="State file written by submit-batch, gathers every job of the batch")
+@click.option('--bucket', help="Bucket for job metadata", required=True)
+@click.option('--target', help="Target directory", default=".")
+@click.option('--matrices', is_flag=True, help="Also store the final matrices of every job")
+@click.option('--threads', help="Number of concurrent downloads", default=32)
+def get_results(jobid, state_file, bucket, target, matrices, threads):
+    # Imported here so that the other commands do not load numpy
+    import cli.results as results
+
+    jobids = list(jobid)
+    if state_file:
+        jobids += sorted(batch.BatchState(state_file).jobids() - set(jobids))
+    if not jobids:
+        raise click.UsageError("Specify --jobid or --state_file")
+    errors = 0
+    for job, path, error in results.gather_results(bucket, jobids, target, matrices, threads):
+        if error:
+            errors += 1
+            print(f"Could not gather job {job}: {error}")
+        else:
+            print(f"{job}: {path}")
+    print("Done!" if not errors else f"Done, {errors} jobs could not be gathered")
+
+
+@cli.command(help="Break down where the time of a job went, from the timings recorded by the workers")
+@click.option('--jobid', help="Id of the job to profile", required=True)
+@click.option('--bucket', help="Bucket for job metadata", required=True)
+def get_job_profile(jobid, bucket):
+    records = helpers.read_job_profile(bucket_name=bucket, jobid=jobid)
+    if not records:
+        print(f"No task profiles found for job {jobid}")
+        return
+    profile = helpers.profile_job(records)
+    print(f"{profile['tasks']} tasks ({profile['forwarded']} forwarded), wall time {profile['wall']:.1f}s")
+
+    print("\nPer step (seconds, mean/p95/max):")
+    header = " ".join(f"{phase:>20}" for phase in helpers.PROFILE_PHASES + ('total',))
+    print(f"{'step':<24} {'count':>5} {header} {'read MiB':>9} {'written MiB':>11} {'peak RSS MiB':>12}")
+    for step, summary in profile['steps'].items():
+        phases = " ".join(
+            f"{summary[phase]['mean']:>6.2f}/{summary[phase]['p95']:>6.2f}/{summary[phase]['max']:>6.2f}"
+            for phase in helpers.PROFILE_PHASES + ('total',))
+        print(f"{step:<24} {summary['count']:>5} {phases} {summary['read'] / 1024 ** 2:>9.1f} "
+              f"{summary['written'] / 1024 ** 2:>11.1f} {summary['rss_kb'] / 1024:>12.1f}")
+
+    if profile['iterations']:
+        print("\nPer iteration (seconds from enqueue to completion):")
+        for index, steps in profile['iterations'].items():
+            print(f"{index:>4}: " + ", ".join(f"{step} {duration:.2f}" for step, duration in steps.items()))
+
+    print("\nCritical path (gap = time in Lambdas and state transitions before the stage):")
+    for stage in profile['critical_path']:
+        print(f"{stage['stage']:<16} {stage['duration']:>8.2f}s  gap {stage['gap']:>6.2f}s  "
+              f"bound by {stage['dominant']}")
+
+    if profile['stragglers']:
+        print(f"\nSlowest two_electrons_integrals slices (median {profile['slice_median']:.2f}s):")
+        for record in profile['stragglers']:
+            print(f"slice {record['index']:>5} on {record['worker']}: {record['end'] - record['start']:.2f}s "
+                  f"(fetch {record['fetch']:.2f}s, compute {record['compute']:.2f}s, upload {record['upload']:.2f}s)")
+    print("Done!")
+
+
+@cli.command(help="List the result cache entries, or prune them with --max_gb or --older_than_days")
+@click.option('--bucket', help="Bucket for job metadata", required=True)
+@click.option('--max_gb', help="Remove the least recently used entries above this total size (GB)", type=float)
+@click.option('--older_than_days', help="Remove entries not used for this many days", type=float)
+def result_cache(bucket, max_gb, older_than_days):
+    cache = ResultCache(helpers.s3, bucket)
+    if max_gb is None and older_than_days is None:
+        entries = cache.entries()
+        for entry in entries:
+            time = datetime.fromtimestamp(entry['last_used']).strftime("%m/%d/%Y %H:%M:%S")
+            print(f"{entry['key']} - {entry['step']} - {entry['bytes'] / 1024 ** 2:.1f} MiB - last used {time}")
+        print(f"{len(entries)} entries, {sum(entry['bytes'] for entry in entries) / 1024 ** 3:.2f} GB")
+        return
+    removed = cache.prune(
+        max_bytes=int(max_gb * 1024 ** 3) if max_gb is not None else None,
+        max_age=older_than_days * 24 * 3600 if older_than_days is not None else None)
+    for entry in removed:
+        print(f"Removed {entry['key']} ({entry['step']})")
+    print("Done!")
+
+
+@cli.command(help="Run a calculation on this machine, with a directory in place of the S3 bucket")
+@click.option('--xyz', help="URL or path of the xyz file", required=True)
+@click.option('--basis_set', help="Basis set to be used", required=True)
+@click.option('--workdir', help="Directory for the job files", default="local_jobs")
+@click.option('--integrals', help="Path of the integrals binary", default="integrals")
+@click.option('--processes', help="Number of integrals processes run at once", default=os.cpu_count() or 1)
+@click.option('--num_parts', help="Number of parts to divide the two_electrons_integrals step into", default=None)
+@click.option('--max_iter', help="Maximum number of iterations in the fock-scf loop", default=30)
+@click.option(
+    '--epsilon', help="The difference between the previous and current hartree_fock_energy to mark the end of the loop",
+    default=0.000000001)
+def run_local(xyz, basis_set, workdir, integrals, processes, num_parts, max_iter, epsilon):
+    try:
+        runner = LocalRunner(workdir, integrals, processes)
+    except CheckoutError as e:
+        raise click.UsageError(str(e))
+    state = runner.run(xyz, basis_set, num_parts, max_iter, "true", epsilon)
+    print(f"Job {state['jobid']} completed, files in {os.path.join(runner.workdir, LOCAL_BUCKET)}")
+    print(f"Final value of hartree_fock_energy: {state['hartree_fock_energy']}")
+
+
 if __name__ == '__main__':
     cli()
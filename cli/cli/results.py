@@ -0,0 +1,121 @@
+import json
+import math
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+from shared import binfile
+
+import cli.helpers as helpers
+
+# Steps of the Fock-SCF loop, whose outputs are indexed by iteration ({jobid}_scf_step_{N}.json)
+LOOP_STEPS = ('fock_matrix', 'scf_step')
+LOOP_OUTPUT = re.compile(r'^(fock_matrix|scf_step)_(\d+)$')
+# Matrices saved with matrices=True: array name -> bin_files object of the job, {last} is the last iteration
+MATRICES = {
+    'overlap': 'overlap',
+    'core_hamiltonian': 'core_hamiltonian',
+    'initial_guess': 'initial_guess',
+    'fock_matrix': 'fock_matrix_{last}',
+    'density': 'scf_step_{last}',
+}
+
+
+def read_json(bucket_name, key) -> dict:
+    return json.loads(helpers.s3.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+
+
+# A .bin object as an array of doubles, square when its size is, None when the object does not exist
+def read_matrix(bucket_name, key) -> Optional[numpy.ndarray]:
+    try:
+        body = helpers.s3.get_object(Bucket=bucket_name, Key=key)['Body']
+    except helpers.s3.exceptions.NoSuchKey:
+        return None
+    data = numpy.frombuffer(b''.join(binfile.decode(body.read)), dtype='<f8')
+    n = math.isqrt(data.size)
+    return data.reshape(n, n) if n * n == data.size else data
+
+
+# Arrays of a job's results from its JSON outputs (name -> output, e.g. "info" or "scf_step_3"):
+#
+#   iteration, hartree_fock_energy, hartree_diff, diis_error  one value per completed loop iteration (NaN when
+#                                                             missing, hartree_diff of the first iteration is NaN)
+#   metadata                                                  JSON of the outputs of the other steps and of the loop
+#                                                             steps by iteration
+def job_arrays(jobid, outputs: Dict[str, dict]) -> Dict[str, numpy.ndarray]:
+    steps = {}
+    loop: Dict[str, Dict[int, dict]] = {step: {} for step in LOOP_STEPS}
+    for name, output in outputs.items():
+        match = LOOP_OUTPUT.match(name)
+        if match:
+            loop[match.group(1)][int(match.group(2))] = output
+        else:
+            steps[name] = output
+    count = max(loop['scf_step'], default=-1) + 1
+    energy = numpy.array([loop['scf_step'].get(i, {}).get('hartree_fock_energy', math.nan) for i in range(count)],
+                         dtype=float)
+    diff = numpy.full(count, math.nan)
+    diff[1:] = numpy.abs(numpy.diff(energy))
+    diis_error = numpy.array(
+        [loop['fock_matrix'].get(i, {}).get('diis_error') for i in range(count)], dtype=float)
+    metadata = {
+        'jobid': jobid,
+        'steps': steps,
+        **{step: [outputs.get(i) for i in range(count)] for step, outputs in loop.items()},
+    }
+    return {
+        'iteration': numpy.arange(count),
+        'hartree_fock_energy': energy,
+        'hartree_diff': diff,
+        'diis_error': diis_error,
+        'metadata': numpy.array(json.dumps(metadata)),
+    }
+
+
+def write_npz(path, arrays):
+    with open(f"{path}.part", 'wb') as f:
+        numpy.savez_compressed(f, **arrays)
+    os.replace(f"{path}.part", path)
+
+
+# Gathers the results of every job into {target}/{jobid}.npz: the arrays of job_arrays and, with matrices, the
+# final matrices of MATRICES. The JSON outputs of all jobs are read from one pool of threads, so a sweep of many
+# jobs costs one listing per job and one GET per output. Returns (jobid, path or None, error or None) per job.
+def gather_results(bucket_name, jobids, target, matrices=False,
+                   threads=32) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    os.makedirs(target, exist_ok=True)
+    results: List[Tuple[str, Optional[str], Optional[str]]] = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        listings = executor.map(
+            lambda jobid: helpers.list_objects(bucket_name, f"job_files/{jobid}/json_files/{jobid}_"), jobids)
+        jobs = []
+        for jobid, objects in zip(jobids, listings):
+            prefix_length = len(f"job_files/{jobid}/json_files/{jobid}_")
+            names = [obj['Key'][prefix_length:-len('.json')] for obj in objects if obj['Key'].endswith('.json')]
+            futures = {
+                name: executor.submit(read_json, bucket_name, f"job_files/{jobid}/json_files/{jobid}_{name}.json")
+                for name in names
+            }
+            jobs.append((jobid, futures))
+        for jobid, futures in jobs:
+            try:
+                outputs = {name: future.result() for name, future in futures.items()}
+                if not outputs:
+                    raise Exception("no outputs found")
+                arrays = job_arrays(jobid, outputs)
+                if matrices:
+                    last = len(arrays['iteration']) - 1
+                    keys = {
+                        name: f"job_files/{jobid}/bin_files/{jobid}_{step.format(last=last)}.bin"
+                        for name, step in MATRICES.items() if last >= 0 or '{last}' not in step
+                    }
+                    loaded = zip(keys, executor.map(lambda key: read_matrix(bucket_name, key), keys.values()))
+                    arrays.update({name: matrix for name, matrix in loaded if matrix is not None})
+                path = os.path.join(target, f"{jobid}.npz")
+                write_npz(path, arrays)
+                results.append((jobid, path, None))
+            except Exception as e:
+                results.append((jobid, None, str(e)))
+    return results
@@ -3,12 +3,16 @@ from distutils.core import setup
 setup(
     name='cli',
     version='0.1',
-    packages=['cli'],
+    # shared is the Lambda layer's package (cdk/lambda/layer/python), used by the CLI for the formats of the job files
+    packages=['cli', 'shared'],
+    package_dir={'shared': '../cdk/lambda/layer/python/shared'},
     install_requires=[
         'click',
         'boto3',
         'botocore',
         'uuid',
+        'zstandard',
+        'numpy',
     ],
     extras_require={
         'dev': [
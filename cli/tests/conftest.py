@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Besides the CLI, the tests cover the worker, the Lambdas and the local stand-ins of benchmarks/, which are not
+# installed packages: they are imported from the repo checkout
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
@@ -0,0 +1,135 @@
+import json
+import time
+
+import pytest
+from benchmarks.standins import LocalDynamo, LocalSqs
+from worker.affinity import REGISTRY_PREFIX, SWEEP_SECONDS, WORKER_PREFIX, AffinityRouter
+from worker.worker import WorkerConfig
+
+TASK_QUEUE = 'https://sqs.local/000000000000/task-queue'
+
+
+@pytest.fixture
+def sqs():
+    return LocalSqs()
+
+
+@pytest.fixture
+def dynamo():
+    return LocalDynamo()
+
+
+def router(sqs, dynamo, name):
+    config = WorkerConfig(task_queue=TASK_QUEUE, batch_table='batch', deleted_job_table='deleted')
+    result = AffinityRouter(sqs, dynamo, config)
+    result.start(name)
+    return result
+
+
+def expire(dynamo, key):
+    dynamo.table('batch')[key]['expires'] = {'N': str(int(time.time()) - 1)}
+
+
+# Expires the liveness item of a worker, as when it stops refreshing it
+def stop(dynamo, worker):
+    expire(dynamo, f"{WORKER_PREFIX}{worker.queue_url}")
+    for jobid in worker.jobs:
+        expire(dynamo, f"{REGISTRY_PREFIX}{jobid}")
+
+
+def bodies(sqs, queue_url):
+    return sorted(json.loads(message['Body'])['slice'] for message in sqs.queues.get(queue_url, []))
+
+
+def test_sweep_requeues_the_messages_forwarded_to_a_stopped_owner(sqs, dynamo):
+    crashed, live, sweeper = (router(sqs, dynamo, name) for name in ('crashed', 'live', 'sweeper'))
+    crashed.register('a')
+    crashed.register('b')
+    live.register('c')
+    for i in range(3):
+        crashed.forward({'Body': json.dumps({'slice': i})}, crashed.queue_url)
+    live.forward({'Body': json.dumps({'slice': 9})}, live.queue_url)
+    stop(dynamo, crashed)
+
+    # No sweep before SWEEP_SECONDS
+    sweeper.sweep()
+    assert bodies(sqs, crashed.queue_url) == [0, 1, 2]
+
+    sweeper.swept_at -= SWEEP_SECONDS
+    sweeper.sweep()
+    assert bodies(sqs, TASK_QUEUE) == [0, 1, 2]
+    assert all('forwarded' not in message['MessageAttributes'] for message in sqs.queues[TASK_QUEUE])
+    assert crashed.queue_url not in sqs.queues
+    assert set(dynamo.table('batch')) == {
+        f"{REGISTRY_PREFIX}c", f"{WORKER_PREFIX}{live.queue_url}", f"{WORKER_PREFIX}{sweeper.queue_url}"}
+    assert bodies(sqs, live.queue_url) == [9]
+
+
+def test_sweep_keeps_its_own_queue_and_refreshed_entries(sqs, dynamo):
+    sweeper = router(sqs, dynamo, 'sweeper')
+    sweeper.register('a')
+    sweeper.forward({'Body': json.dumps({'slice': 0})}, sweeper.queue_url)
+    stop(dynamo, sweeper)
+    sweeper.swept_at -= SWEEP_SECONDS
+    sweeper.sweep()
+    assert bodies(sqs, sweeper.queue_url) == [0]
+    assert bodies(sqs, TASK_QUEUE) == []
+
+    # An entry refreshed between the scan and the delete is kept
+    other = router(sqs, dynamo, 'other')
+    other.register('b')
+    stale = dict(dynamo.table('batch')[f"{REGISTRY_PREFIX}b"], expires={'N': '0'})
+    sweeper.delete_expired(stale)
+    assert f"{REGISTRY_PREFIX}b" in dynamo.table('batch')
+
+
+def test_lookup_of_a_job_of_a_stopped_owner_reclaims_and_deletes_it(sqs, dynamo):
+    crashed, worker = router(sqs, dynamo, 'crashed'), router(sqs, dynamo, 'worker')
+    crashed.register('a')
+    crashed.forward({'Body': json.dumps({'slice': 0})}, crashed.queue_url)
+    assert worker.owner('a') == crashed.queue_url
+    stop(dynamo, crashed)
+    assert worker.owner('a') is None
+    assert bodies(sqs, TASK_QUEUE) == [0]
+    assert set(dynamo.table('batch')) == {f"{WORKER_PREFIX}{worker.queue_url}"}
+
+
+def test_evicted_job_does_not_reclaim_the_queue_of_its_live_owner(sqs, dynamo):
+    owner, worker, sweeper = (router(sqs, dynamo, name) for name in ('owner', 'worker', 'sweeper'))
+    owner.register('a')
+    owner.register('b')
+    owner.forward({'Body': json.dumps({'slice': 0})}, owner.queue_url)
+    # The owner evicts a from its cache and keeps b
+    owner.unregister('a')
+    assert f"{REGISTRY_PREFIX}a" not in dynamo.table('batch')
+    assert worker.owner('a') is None
+    assert worker.owner('b') == owner.queue_url
+
+    # A job entry left behind after a failed delete expires while its worker lives on
+    owner.put_item(f"{REGISTRY_PREFIX}c")
+    expire(dynamo, f"{REGISTRY_PREFIX}c")
+    assert worker.owner('c') is None
+    owner.put_item(f"{REGISTRY_PREFIX}c")
+    expire(dynamo, f"{REGISTRY_PREFIX}c")
+    sweeper.swept_at -= SWEEP_SECONDS
+    sweeper.sweep()
+    assert f"{REGISTRY_PREFIX}c" not in dynamo.table('batch')
+    assert bodies(sqs, owner.queue_url) == [0]
+    assert bodies(sqs, TASK_QUEUE) == []
+    assert worker.owner('b') == owner.queue_url
+
+    # A worker does not delete the entry of a job registered by another worker since
+    worker.register('b')
+    owner.unregister('b')
+    assert worker.owner('b') is None and owner.owner('b') == worker.queue_url
+
+
+def test_close_hands_back_the_queue_and_deletes_the_entries(sqs, dynamo):
+    owner, worker = router(sqs, dynamo, 'owner'), router(sqs, dynamo, 'worker')
+    owner.register('a')
+    owner.forward({'Body': json.dumps({'slice': 0})}, owner.queue_url)
+    owner.close()
+    assert bodies(sqs, TASK_QUEUE) == [0]
+    assert owner.queue_url not in sqs.queues
+    assert worker.owner('a') is None
+    assert set(dynamo.table('batch')) == {f"{WORKER_PREFIX}{worker.queue_url}"}
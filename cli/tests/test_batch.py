@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from botocore.exceptions import ClientError
+from click.testing import CliRunner
+
+import cli.batch as batch
+import cli.helpers as helpers
+from cli.main import cli
+
+NOW = datetime.now(timezone.utc)
+
+
+def execution(name, status, days_ago, duration_days=0.1):
+    started = NOW - timedelta(days=days_ago)
+    result = {'name': name, 'status': status, 'startDate': started}
+    if status != 'RUNNING':
+        result['stopDate'] = started + timedelta(days=duration_days)
+    return result
+
+
+def test_delete_job_files_older_than_skips_jobs_with_a_newer_or_running_attempt(monkeypatch):
+    executions = [
+        execution('running-r1', 'RUNNING', 1),
+        execution('resumed-r2', 'SUCCEEDED', 20),
+        execution('recent-r1', 'SUCCEEDED', 2),
+        execution('resumed-r1', 'FAILED', 25),
+        execution('recent', 'FAILED', 30),
+        execution('running', 'FAILED', 30),
+        execution('resumed', 'ABORTED', 30),
+        execution('old', 'SUCCEEDED', 40),
+        execution('failed', 'FAILED', 40),
+    ]
+    deleted = []
+    monkeypatch.setattr(helpers, 'resolve_resource_config', lambda bucket: None)
+    monkeypatch.setattr(helpers, 'list_execs', lambda aws_resources: executions)
+    monkeypatch.setattr(
+        helpers, 'delete_files_from_bucket', lambda bucket_name, jobid: deleted.append(jobid) or ([], []))
+
+    result = CliRunner().invoke(cli, ['delete-job-files', '--bucket', 'bucket', '--older_than', '10'])
+    assert result.exit_code == 0, result.output
+    # The files of a resumed job are deleted once, under the job's id
+    assert sorted(deleted) == ['failed', 'old', 'resumed']
+
+    deleted.clear()
+    result = CliRunner().invoke(
+        cli, ['delete-job-files', '--bucket', 'bucket', '--older_than', '10', '--status', 'failed'])
+    assert result.exit_code == 0, result.output
+    assert deleted == ['failed']
+
+
+class FakeSfn:
+    class exceptions:
+        ClientError = ClientError
+
+    # errors are the error codes of the next start_execution calls
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.started = []
+
+    def start_execution(self, input, stateMachineArn, name):
+        if self.errors:
+            raise ClientError({'Error': {'Code': self.errors.pop(0), 'Message': ''}}, 'StartExecution')
+        self.started.append(name)
+        return {}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(batch.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def submitter(tmp_path, **kwargs) -> batch.BatchSubmitter:
+    resources = helpers.ResourceConfig([], '', '', '', 'sfn', 'exec', '')
+    args = {'max_active': 10, 'rate': 1000, 'threads': 1, **kwargs}
+    return batch.BatchSubmitter('bucket', resources, batch.BatchState(str(tmp_path / 'state.json')), **args)
+
+
+ROW = {'xyz': 'https://example.com/h2o.xyz', 'basis_set': 'sto-3g', **batch.MANIFEST_DEFAULTS}
+
+
+def test_start_retries_throttled_calls_with_backoff(tmp_path, monkeypatch, sleeps):
+    sfn = FakeSfn(['ThrottlingException'] * 7)
+    monkeypatch.setattr(helpers, 'sfn', sfn)
+    submitter(tmp_path).start(0, ROW)
+    assert sleeps == [1, 2, 4, 8, 16, 30, 30]
+    job = batch.BatchState(str(tmp_path / 'state.json')).get(0)
+    assert sfn.started == [job['jobid']] and job['submitted_at']
+
+
+def test_start_keeps_the_job_of_an_execution_that_exists(tmp_path, monkeypatch, sleeps):
+    monkeypatch.setattr(helpers, 'sfn', FakeSfn(['ExecutionAlreadyExists']))
+    submitter(tmp_path).start(0, ROW)
+    assert batch.BatchState(str(tmp_path / 'state.json')).get(0)['submitted_at']
+    assert sleeps == []
+
+
+def test_start_records_the_job_before_a_failed_call(tmp_path, monkeypatch, sleeps):
+    sfn = FakeSfn(['AccessDeniedException'])
+    monkeypatch.setattr(helpers, 'sfn', sfn)
+    with pytest.raises(ClientError):
+        submitter(tmp_path).start(0, ROW)
+    job = batch.BatchState(str(tmp_path / 'state.json')).get(0)
+    assert 'submitted_at' not in job
+    # Submitting the batch again starts the row under the same job id
+    submitter(tmp_path).start(0, ROW)
+    assert sfn.started == [job['jobid']]
+
+
+def test_submit_runs_at_most_max_active_jobs(tmp_path, monkeypatch, sleeps):
+    sfn = FakeSfn()
+    finished = set()
+    peak = []
+
+    def start_execution(input, stateMachineArn, name):
+        peak.append(len(sfn.started) - len(finished) + 1)
+        sfn.started.append(name)
+
+    # Every listing of the running executions finds that the oldest job finished
+    def list_execs(aws_resources, statuses=None, since=None, until=None):
+        running = [name for name in sfn.started if name not in finished]
+        if running:
+            finished.add(running[0])
+        return [{'name': name, 'status': 'RUNNING'} for name in running[1:]]
+
+    monkeypatch.setattr(sfn, 'start_execution', start_execution)
+    monkeypatch.setattr(helpers, 'sfn', sfn)
+    monkeypatch.setattr(helpers, 'list_execs', list_execs)
+    submitter(tmp_path, max_active=3, poll_interval=0).submit([ROW] * 10)
+    assert len(sfn.started) == 10 and max(peak) <= 3
+
+
+def test_batch_status_reports_the_latest_attempt_of_every_job(tmp_path, monkeypatch):
+    state = batch.BatchState(str(tmp_path / 'state.json'))
+    submitted = [NOW - timedelta(hours=2), NOW - timedelta(hours=1), NOW]
+    for index, jobid in enumerate(['a', 'b', 'c']):
+        state.update(index, jobid=jobid, submitted_at=submitted[index].isoformat())
+    state.update(3, jobid='d')
+    listed = []
+
+    def list_execs(aws_resources, statuses=None, since=None, until=None):
+        listed.append(since)
+        # Latest first, with another batch's job
+        return [
+            execution('a-r2', 'RUNNING', 0), execution('other', 'SUCCEEDED', 0), execution('a-r1', 'FAILED', 0.01),
+            execution('b', 'SUCCEEDED', 0.02), execution('a', 'ABORTED', 0.03),
+        ]
+
+    monkeypatch.setattr(helpers, 'list_execs', list_execs)
+    rows = batch.batch_status(None, state)
+    assert [(index, job['jobid'], status) for index, job, status in rows] == [
+        (0, 'a', 'RUNNING'), (1, 'b', 'SUCCEEDED'), (2, 'c', 'NOT_FOUND'), (3, 'd', 'NOT_SUBMITTED')]
+    # One listing, from shortly before the first submission
+    assert listed == [submitted[0] - timedelta(minutes=5)]
@@ -0,0 +1,108 @@
+import io
+import struct
+
+import pytest
+from benchmarks.standins import LocalS3, LocalSession
+from shared import binfile
+from worker.worker import Worker, WorkerConfig
+
+# Doubles of a smooth matrix and a trailing partial element
+DATA = b''.join(struct.pack('<d', 1.0 / (1 + i)) for i in range(5000)) + b'\x01\x02\x03'
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    # Several frames per object
+    monkeypatch.setattr(binfile, 'FRAME_BYTES', 4096)
+    return LocalS3(str(tmp_path / 's3'))
+
+
+def round_trip(s3, tmp_path, codec, data=DATA) -> bytes:
+    source = tmp_path / 'source.bin'
+    source.write_bytes(data)
+    sent = binfile.upload(s3, str(source), 'bucket', 'job/matrix.bin', codec)
+    assert sent == len(s3.get_object(Bucket='bucket', Key='job/matrix.bin')['Body'].read())
+    target = tmp_path / 'target.bin'
+    assert binfile.download(s3, 'bucket', 'job/matrix.bin', str(target)) == sent
+    assert not (tmp_path / 'target.bin.part').exists()
+    return target.read_bytes()
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'zlib'])
+def test_compressed_objects_round_trip(s3, tmp_path, codec):
+    assert round_trip(s3, tmp_path, codec) == DATA
+    stored = s3.get_object(Bucket='bucket', Key='job/matrix.bin')['Body'].read()
+    assert stored.startswith(binfile.MAGIC) and len(stored) < len(DATA)
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'zlib'])
+def test_empty_objects_round_trip(s3, tmp_path, codec):
+    assert round_trip(s3, tmp_path, codec, b'') == b''
+
+
+def test_zlib_is_used_without_zstandard(s3, tmp_path, monkeypatch):
+    zstd_object = b''.join(binfile.encode(io.BytesIO(DATA), 'zstd'))
+    monkeypatch.setattr(binfile, 'zstandard', None)
+    assert binfile.default_codec() == 'zlib'
+    assert round_trip(s3, tmp_path, binfile.default_codec()) == DATA
+    with pytest.raises(binfile.BinFormatError, match='zstandard'):
+        binfile.upload(s3, str(tmp_path / 'source.bin'), 'bucket', 'job/other.bin', 'zstd')
+    # Objects written with zstd elsewhere can not be read, the error says why
+    with pytest.raises(binfile.BinFormatError, match='zstandard'):
+        list(binfile.decode(io.BytesIO(zstd_object).read))
+
+
+@pytest.mark.parametrize('data', [DATA, b'\x89BIN', b''], ids=['matrix', 'short', 'empty'])
+def test_raw_objects_are_read_unchanged(s3, tmp_path, data):
+    # Objects uploaded before compression existed, or with BIN_CODEC unset
+    assert round_trip(s3, tmp_path, None, data) == data
+
+
+# A network stream returns fewer bytes than asked for
+def trickle(data, most):
+    stream = io.BytesIO(data)
+    return lambda size: stream.read(min(size, most))
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'zlib', None])
+@pytest.mark.parametrize('most', [1, 7, 1000])
+def test_partial_reads_are_decoded(codec, most):
+    stored = DATA if codec is None else b''.join(binfile.encode(io.BytesIO(DATA), codec))
+    assert b''.join(binfile.decode(trickle(stored, most))) == DATA
+
+
+def test_truncated_objects_are_rejected(s3, tmp_path):
+    stored = b''.join(binfile.encode(io.BytesIO(DATA), 'zlib'))
+    with pytest.raises(binfile.BinFormatError, match='Truncated'):
+        list(binfile.decode(io.BytesIO(stored[:-20]).read))
+    s3.put_object(Bucket='bucket', Key='job/matrix.bin', Body=stored[:-20])
+    with pytest.raises(binfile.BinFormatError):
+        binfile.download(s3, 'bucket', 'job/matrix.bin', str(tmp_path / 'target.bin'))
+    # A failed download leaves no file behind that would pass for the object
+    assert not (tmp_path / 'target.bin').exists()
+
+
+def bin_worker(tmp_path, **config) -> Worker:
+    session = LocalSession(sqs=None, s3=LocalS3(str(tmp_path / 's3')), stepfunctions=None, dynamodb=None, ecs=None,
+                           cloudwatch=None)
+    return Worker(WorkerConfig(task_queue='tasks', batch_table='batch', deleted_job_table='deleted',
+                               work_dir=str(tmp_path), eri_cache_bytes=0, affinity=False, **config), session=session)
+
+
+ONE_ELECTRON = ['overlap', '--jobid', 'job', '--bucket', 'bucket', '--output_object', 'job/job_overlap.bin']
+
+
+def test_output_objects_are_left_to_the_binary_by_default(tmp_path):
+    # INTEGRALS.md documents --output_object only for these subcommands, the binary uploads it
+    worker = bin_worker(tmp_path)
+    for command in ['two_electron_integrals', 'core_hamiltonian', 'overlap', 'initial_guess']:
+        commands = [command] + ONE_ELECTRON[1:]
+        assert worker.localize_bins(commands, str(tmp_path / 'bin')) == (commands, [])
+
+
+def test_output_url_commands_are_uploaded_by_the_worker(tmp_path):
+    worker = bin_worker(tmp_path, output_url_commands=('overlap',))
+    path = str(tmp_path / 'bin' / 'job_overlap.bin')
+    local, outputs = worker.localize_bins(ONE_ELECTRON, str(tmp_path / 'bin'))
+    assert local == ONE_ELECTRON[:-2] + ['--output_url', f"file://{path}"]
+    assert outputs == [(path, 'bucket', 'job/job_overlap.bin')]
@@ -0,0 +1,64 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from benchmarks.standins import LocalDynamo
+from shared.completion import CompletionTracker, DynamoBackend, LocalBackend
+
+
+@pytest.fixture(params=['local', 'dynamo'])
+def tracker(request):
+    backend = LocalBackend() if request.param == 'local' else DynamoBackend(LocalDynamo(), 'batch')
+    return CompletionTracker(backend, slices_per_shard=8)
+
+
+def test_concurrent_duplicate_completions_finish_the_job_once(tracker):
+    num_slices = 200
+    tracker.start('job', num_slices)
+    # Every slice is completed three times (a redelivered message), in random order from many threads
+    completions = [i for i in range(num_slices) for _ in range(3)]
+    random.Random(0).shuffle(completions)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(lambda i: tracker.complete('job', i, num_slices), completions))
+    finishers = {i for i, finished in zip(completions, results) if finished}
+    # Only the slice that completed the job (and its redeliveries) reports it
+    assert len(finishers) == 1
+    assert tracker.remaining('job') == 0
+    finisher = finishers.pop()
+    assert tracker.complete('job', finisher, num_slices)
+    assert not tracker.complete('job', (finisher + 1) % num_slices, num_slices)
+
+
+def test_redelivered_slice_does_not_complete_the_job(tracker):
+    tracker.start('job', 3)
+    assert not tracker.complete('job', 0, 3)
+    assert not tracker.complete('job', 0, 3)
+    assert not tracker.complete('job', 1, 3)
+    assert tracker.remaining('job') == 1
+    assert tracker.complete('job', 2, 3)
+
+
+def test_restart_keeps_progress_and_skips_done_slices(tracker):
+    tracker.start('job', 20)
+    for i in range(5):
+        tracker.complete('job', i, 20)
+    # A retried setup does not reset what the workers completed
+    tracker.start('job', 20)
+    assert tracker.remaining('job') == 15
+    tracker.start('job/r1', 20, done=range(18))
+    assert tracker.remaining('job/r1') == 2
+    assert not tracker.complete('job/r1', 18, 20)
+    assert tracker.complete('job/r1', 19, 20)
+
+
+def test_untracked_job_is_never_completed(tracker):
+    assert not tracker.complete('job', 0, 1)
+    assert tracker.remaining('job') is None
+
+
+def test_delete_attempts_deletes_the_job_and_its_resumed_attempts(tracker):
+    for jobid in ('job', 'job/r1', 'job/r3', 'job2', 'job2/r1'):
+        tracker.start(jobid, 30)
+    tracker.delete_attempts('job')
+    assert [tracker.remaining(jobid) for jobid in ('job', 'job/r1', 'job/r3')] == [None, None, None]
+    assert tracker.remaining('job2') == 30 and tracker.remaining('job2/r1') == 30
@@ -0,0 +1,111 @@
+import signal
+import subprocess
+import sys
+
+import pytest
+from benchmarks.standins import LocalDynamo
+from worker.deleted_jobs import DeletedJobs
+
+TABLE = 'deleted'
+
+
+class FailingScan(LocalDynamo):
+    def paginate(self, TableName, **kwargs):
+        raise ConnectionError(TableName)
+
+
+def delete(dynamo, jobid):
+    dynamo.put_item(TableName=TABLE, Item={'jobid': {'S': jobid}})
+
+
+# An integrals process, ignoring SIGTERM if stubborn. Returns once the process is running.
+def integrals(stubborn=False):
+    ignore = 'signal.signal(signal.SIGTERM, signal.SIG_IGN); ' if stubborn else ''
+    process = subprocess.Popen(
+        [sys.executable, '-c', f"import signal, time; {ignore}print('ready', flush=True); time.sleep(60)"],
+        stdout=subprocess.PIPE)
+    process.stdout.readline()
+    return process
+
+
+@pytest.fixture
+def processes():
+    started = []
+    yield started
+    for process in started:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+
+def test_refresh_kills_the_processes_of_newly_deleted_jobs(processes):
+    dynamo = LocalDynamo()
+    deleted = DeletedJobs(dynamo, TABLE, kill_grace_seconds=0.2)
+    processes += [integrals(), integrals(stubborn=True), integrals()]
+    deleted.register('a', processes[0])
+    deleted.register('a', processes[1])
+    deleted.register('b', processes[2])
+    deleted.refresh()
+    assert all(process.poll() is None for process in processes)
+
+    delete(dynamo, 'a')
+    deleted.refresh()
+    assert processes[0].wait(timeout=5) == -signal.SIGTERM
+    # SIGKILL once the grace period is over
+    assert processes[1].wait(timeout=5) == -signal.SIGKILL
+    assert processes[2].poll() is None
+
+
+def test_processes_of_a_deleted_job_are_killed_when_registered(processes):
+    dynamo = LocalDynamo()
+    delete(dynamo, 'a')
+    deleted = DeletedJobs(dynamo, TABLE)
+    deleted.refresh()
+    processes.append(integrals())
+    deleted.register('a', processes[0])
+    assert processes[0].wait(timeout=5) == -signal.SIGTERM
+    deleted.unregister('a', processes[0])
+    assert deleted.processes == {}
+
+
+def test_jobs_are_droppable_once_their_failure_is_reported(monkeypatch):
+    dynamo = LocalDynamo()
+    delete(dynamo, 'a')
+    deleted = DeletedJobs(dynamo, TABLE, refresh_seconds=5)
+    # Not before the set was read
+    assert deleted.report('a')
+    assert not deleted.droppable('a')
+    deleted.refresh()
+    assert deleted.droppable('a')
+    assert not deleted.report('a')
+    assert not deleted.droppable('b') and deleted.report('b') and not deleted.droppable('b')
+
+    # Nor once the set is stale: the job could have been resumed since
+    monkeypatch.setattr(deleted, 'refreshed_at', deleted.refreshed_at - 15)
+    assert not deleted.droppable('a')
+
+    # A resumed job is removed from the table, its failure is reported again if it is deleted again
+    dynamo.delete_item(TableName=TABLE, Key={'jobid': {'S': 'a'}})
+    deleted.refresh()
+    assert not deleted.droppable('a')
+    delete(dynamo, 'a')
+    deleted.refresh()
+    assert not deleted.droppable('a') and deleted.report('a') and deleted.droppable('a')
+
+
+def test_the_table_is_queried_while_the_set_is_stale(monkeypatch):
+    dynamo = LocalDynamo()
+    delete(dynamo, 'a')
+    deleted = DeletedJobs(dynamo, TABLE, refresh_seconds=5)
+    deleted.refresh()
+    delete(dynamo, 'b')
+    assert deleted.cached('b') is False and not deleted.contains('b')
+
+    # The scans fail: the last set is kept until it is stale, then the table is queried
+    deleted.dynamo = FailingScan()
+    deleted.dynamo.tables = dynamo.tables
+    deleted.refresh()
+    assert deleted.contains('a') and not deleted.contains('b')
+    monkeypatch.setattr(deleted, 'refreshed_at', deleted.refreshed_at - 15)
+    assert deleted.cached('b') is None
+    assert deleted.contains('a') and deleted.contains('b') and not deleted.contains('c')
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+
+import numpy
+import pytest
+from benchmarks.standins import LocalS3
+from shared import binfile
+from shared.scf import diis_error_key, diis_fock_key, diis_history_key
+from worker.diis import DIIS_HISTORY, DiisHistory, DiisStage, run_diis_step, write_matrix
+
+BUCKET = 'bucket'
+JOBID = 'job'
+N = 4
+
+
+# The S3 calls of the worker that DiisStage makes
+class FakeWorker:
+    def __init__(self, root):
+        self.s3 = LocalS3(root)
+
+    def download_bin(self, bucket, key, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        binfile.download(self.s3, bucket, key, path)
+
+    def upload_bin(self, path, bucket, key):
+        binfile.upload(self.s3, path, bucket, key)
+
+
+def symmetric(rng, shift=0.0):
+    matrix = rng.standard_normal((N, N))
+    return matrix + matrix.T + shift * numpy.eye(N)
+
+
+# Runs the DIIS stage of every iteration in order, each with a stage of its own as the fock_matrix tasks do
+def run_iterations(tmp_path, worker, indices):
+    rng = numpy.random.default_rng(0)
+    overlap_path = str(tmp_path / 'overlap.bin')
+    write_matrix(overlap_path, symmetric(rng, shift=2 * N))
+    matrices = {}
+    for index in indices:
+        # A redelivered iteration is built from the same density and gives the same Fock matrix
+        if index not in matrices:
+            matrices[index] = (symmetric(rng), symmetric(rng))
+        directory = tmp_path / f"task_{len(os.listdir(tmp_path))}"
+        directory.mkdir()
+        write_matrix(str(directory / 'fock.bin'), matrices[index][0])
+        # The output of the iteration's fock_matrix task
+        fock_key = f"job_files/{JOBID}/bin_files/{JOBID}_fock_matrix_{index}.bin"
+        worker.upload_bin(str(directory / 'fock.bin'), BUCKET, fock_key)
+        write_matrix(str(directory / 'density.bin'), matrices[index][1])
+        stage = DiisStage(worker, BUCKET, JOBID, str(directory / 'diis'), overlap_path)
+        stage.step(index, str(directory / 'fock.bin'), str(directory / 'density.bin'), str(directory / 'out.bin'))
+
+
+def history(worker) -> dict:
+    return json.loads(worker.s3.get_object(Bucket=BUCKET, Key=diis_history_key(JOBID))['Body'].read())
+
+
+def stored_errors(worker, iterations):
+    return [i for i in iterations if os.path.exists(worker.s3.path(BUCKET, diis_error_key(JOBID, i)))]
+
+
+def test_add_returns_only_iterations_that_left_the_history():
+    history = DiisHistory(size=3)
+    errors = {i: numpy.eye(2) * (i + 1) for i in range(5)}
+    assert history.add(0, errors[0], errors.get) == []
+    assert history.add(1, errors[1], errors.get) == []
+    assert history.add(2, errors[2], errors.get) == []
+    # Redelivered: the iteration replaces itself and nothing is dropped
+    assert history.add(2, errors[2], errors.get) == []
+    assert history.iterations == [0, 1, 2]
+    assert history.add(3, errors[3], errors.get) == [0]
+    # Resumed at an earlier iteration: the later ones are dropped, the iteration itself is kept
+    assert history.add(2, errors[2], errors.get) == [3]
+    assert history.iterations == [1, 2]
+
+
+def test_redelivered_iteration_keeps_the_history(tmp_path, caplog):
+    worker = FakeWorker(str(tmp_path / 's3'))
+    with caplog.at_level(logging.WARNING):
+        run_iterations(tmp_path, worker, [0, 1, 2, 2, 3])
+    assert history(worker)['iterations'] == [0, 1, 2, 3]
+    assert stored_errors(worker, range(4)) == [0, 1, 2, 3]
+    assert 'incomplete' not in caplog.text
+
+
+def test_error_matrices_of_dropped_iterations_are_deleted(tmp_path):
+    worker = FakeWorker(str(tmp_path / 's3'))
+    count = DIIS_HISTORY + 2
+    run_iterations(tmp_path, worker, range(count))
+    assert history(worker)['iterations'] == list(range(2, count))
+    assert stored_errors(worker, range(count)) == list(range(2, count))
+
+
+def test_incomplete_history_starts_over_and_deletes_what_is_left(tmp_path):
+    worker = FakeWorker(str(tmp_path / 's3'))
+    run_iterations(tmp_path, worker, range(3))
+    os.remove(worker.s3.path(BUCKET, diis_error_key(JOBID, 1)))
+    run_iterations(tmp_path, worker, [3])
+    assert history(worker)['iterations'] == [3]
+    assert stored_errors(worker, range(4)) == [3]
+
+
+def history_of(errors) -> DiisHistory:
+    history = DiisHistory()
+    for i, error in enumerate(errors):
+        history.add(i, error, errors.__getitem__)
+    return history
+
+
+def test_collinear_error_matrices_drop_the_oldest_iterations():
+    error = numpy.arange(N * N, dtype=float).reshape(N, N)
+    # The DIIS equations of equal error matrices are singular, the newest iteration is used alone
+    assert history_of([error, error]).coefficients().tolist() == [0, 1]
+    assert history_of([2 * error, error, error]).coefficients().tolist() == [0, 0, 1]
+    # Zero error matrices (a converged loop) can not be scaled
+    assert history_of([error * 0, error * 0]).coefficients().tolist() == [0, 1]
+    # Collinear errors that are not equal still combine to a zero error
+    coefficients = history_of([error, 2 * error, 3 * error]).coefficients()
+    assert sum(c * (i + 1) for i, c in enumerate(coefficients)) == pytest.approx(0, abs=1e-9)
+    assert sum(coefficients) == pytest.approx(1)
+
+
+def test_unsolvable_equations_fall_back_to_the_fock_matrix(tmp_path, monkeypatch, caplog):
+    worker = FakeWorker(str(tmp_path / 's3'))
+    rng = numpy.random.default_rng(0)
+    bin_files = f"job_files/{JOBID}/bin_files/{JOBID}"
+    for name, matrix in (('overlap', symmetric(rng, shift=2 * N)), ('fock_matrix_0', symmetric(rng)),
+                         ('initial_guess', symmetric(rng))):
+        write_matrix(str(tmp_path / 'matrix.bin'), matrix)
+        worker.upload_bin(str(tmp_path / 'matrix.bin'), BUCKET, f"{bin_files}_{name}.bin")
+
+    def singular(*args):
+        raise numpy.linalg.LinAlgError("Singular matrix")
+
+    monkeypatch.setattr(DiisHistory, 'extrapolate', singular)
+    with caplog.at_level(logging.WARNING):
+        assert run_diis_step(worker, BUCKET, JOBID, 0, f"{bin_files}_fock_matrix_0.bin",
+                             f"s3://{BUCKET}/{bin_files}_initial_guess.bin", str(tmp_path / 'slot')) is None
+    assert 'can not be solved' in caplog.text
+    # The scf_step reads the Fock matrix as it was built
+    fock = worker.s3.get_object(Bucket=BUCKET, Key=f"{bin_files}_fock_matrix_0.bin")['Body'].read()
+    assert worker.s3.get_object(Bucket=BUCKET, Key=diis_fock_key(JOBID, 0))['Body'].read() == fock
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+from benchmarks.standins import LocalS3
+from worker.eri_cache import EriCache
+from worker.prefetch import ShardPrefetcher
+
+
+# Holds the downloads of the jobs in blocked until they are released
+class BlockingPrefetcher(ShardPrefetcher):
+    def __init__(self, s3, blocked=()):
+        super().__init__(s3, threads=2)
+        self.blocked = {jobid: threading.Event() for jobid in blocked}
+        self.started = {jobid: threading.Event() for jobid in blocked}
+
+    def fetch(self, bucket, shards, directory):
+        jobid = shards[0]['Key'].split('_')[0]
+        if jobid in self.blocked:
+            self.started[jobid].set()
+            self.blocked[jobid].wait(5)
+        return super().fetch(bucket, shards, directory)
+
+
+def put_job(s3, jobid, shards=2, size=100):
+    for i in range(shards):
+        s3.put_object(Bucket='bucket', Key=f"{jobid}_{i}.bin", Body=b'x' * size)
+
+
+@pytest.fixture
+def s3(tmp_path):
+    s3 = LocalS3(str(tmp_path / 's3'))
+    for jobid in ('a', 'b', 'c'):
+        put_job(s3, jobid)
+    return s3
+
+
+def cache(s3, tmp_path, blocked=(), on_evict=None):
+    return EriCache(s3, str(tmp_path / 'cache'), 400, BlockingPrefetcher(s3, blocked), on_evict)
+
+
+def test_jobs_are_evicted_in_least_recently_used_order(s3, tmp_path):
+    evicted = []
+    eri_cache = cache(s3, tmp_path, on_evict=evicted.append)
+    for jobid in ('a', 'b', 'a', 'c'):
+        prefix, stats = eri_cache.acquire('bucket', jobid)
+        assert prefix == f"file://{tmp_path / 'cache' / jobid / jobid}"
+        eri_cache.release(jobid)
+    assert evicted == ['b']
+    assert list(eri_cache.jobs) == ['a', 'c'] and not (tmp_path / 'cache' / 'b').exists()
+    assert stats.misses == 2 and stats.bytes_downloaded == 200
+
+
+def test_downloads_in_progress_count_towards_max_bytes(s3, tmp_path):
+    put_job(s3, 'big', shards=3)
+    eri_cache = cache(s3, tmp_path, blocked=['a'])
+    acquired = {}
+    thread = threading.Thread(target=lambda: acquired.update(a=eri_cache.acquire('bucket', 'a')))
+    thread.start()
+    assert eri_cache.prefetcher.started['a'].wait(5)
+    # The 200 bytes of a are reserved while they download: b fits, the 300 bytes of big do not
+    assert not eri_cache.holds('a') and eri_cache.reserved == {'a': 200}
+    assert eri_cache.acquire('bucket', 'b')[0] is not None
+    eri_cache.release('b')
+    prefix, stats = eri_cache.acquire('bucket', 'big')
+    assert prefix is None and stats.misses == 0
+    # b is kept, evicting it would not make room for big
+    assert 'big' not in eri_cache.in_use and eri_cache.holds('b')
+
+    eri_cache.prefetcher.blocked['a'].set()
+    thread.join()
+    assert acquired['a'][0] is not None and eri_cache.holds('a') and eri_cache.reserved == {}
+    eri_cache.release('a')
+    # Once the jobs are released, big evicts them
+    assert eri_cache.acquire('bucket', 'big')[0] is not None
+    assert list(eri_cache.jobs) == ['big']
+
+
+def test_a_failed_download_releases_its_reservation(s3, tmp_path):
+    eri_cache = cache(s3, tmp_path)
+    shards = [{'Key': 'a_0.bin', 'Size': 100}, {'Key': 'missing.bin', 'Size': 100}]
+    with pytest.raises(Exception):
+        eri_cache.acquire('bucket', 'a', shards)
+    assert eri_cache.reserved == {} and eri_cache.in_use == {} and not eri_cache.holds('a')
+
+
+def test_evictions_are_reported_outside_the_cache_lock(s3, tmp_path):
+    eri_cache = None
+    reported = []
+
+    # An eviction callback that makes a request (see AffinityRouter.unregister) while other tasks use the cache
+    def on_evict(jobid):
+        assert eri_cache.lock.acquire(blocking=False)
+        eri_cache.lock.release()
+        reported.append(jobid)
+
+    eri_cache = cache(s3, tmp_path, on_evict=on_evict)
+    put_job(s3, 'big', shards=3)
+    for jobid in ('a', 'b', 'big'):
+        eri_cache.acquire('bucket', jobid)
+        eri_cache.release(jobid)
+    assert reported == ['a', 'b']
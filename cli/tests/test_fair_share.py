@@ -0,0 +1,73 @@
+import json
+
+import pytest
+from benchmarks.standins import LocalCloudWatch, LocalDynamo, LocalS3, LocalSession, LocalSqs
+from shared.bulk_queue import create_bulk_queue
+from worker.worker import Worker, WorkerConfig
+
+TASK_QUEUE = 'https://sqs.local/000000000000/task-queue'
+
+
+@pytest.fixture
+def sqs():
+    return LocalSqs()
+
+
+@pytest.fixture
+def worker(tmp_path, sqs):
+    config = WorkerConfig(
+        task_queue=TASK_QUEUE, batch_table='batch', deleted_job_table='deleted', work_dir=str(tmp_path),
+        slots=10, wait_time_seconds=0, eri_cache_bytes=0, affinity=False, bulk_queues_refresh_seconds=0)
+    session = LocalSession(sqs=sqs, s3=LocalS3(str(tmp_path / 's3')), stepfunctions=None, dynamodb=LocalDynamo(),
+                           ecs=None, cloudwatch=LocalCloudWatch())
+    return Worker(config, session=session)
+
+
+def send(sqs, queue, jobid, count):
+    for i in range(count):
+        sqs.send_message(QueueUrl=queue, MessageBody=json.dumps({'input': {'value': {'jobid': jobid, 'slice': i}}}))
+
+
+def jobs(messages):
+    return [json.loads(message['Body'])['input']['value']['jobid'] for message in messages]
+
+
+def test_task_queue_is_read_before_the_bulk_queues(worker, sqs):
+    send(sqs, create_bulk_queue(sqs, 'big'), 'big', 50)
+    send(sqs, TASK_QUEUE, 'small', 3)
+    assert jobs(worker.receive_any(10)) == ['small'] * 3
+    assert jobs(worker.receive_any(10)) == ['big'] * 10
+
+
+def test_slots_are_shared_between_the_jobs_whatever_their_backlog(worker, sqs):
+    send(sqs, create_bulk_queue(sqs, 'big'), 'big', 500)
+    send(sqs, create_bulk_queue(sqs, 'small'), 'small', 12)
+    received = [jobs(worker.receive_any(10)) for _ in range(3)]
+    assert [sorted(batch) for batch in received[:2]] == [['big'] * 5 + ['small'] * 5] * 2
+    # Once the small job runs out, its share goes to the big one
+    assert sorted(received[2]) == ['big'] * 8 + ['small'] * 2
+
+
+def test_single_slots_alternate_between_the_jobs(worker, sqs):
+    for jobid in ('a', 'b', 'c'):
+        send(sqs, create_bulk_queue(sqs, jobid), jobid, 10)
+    assert jobs(m for _ in range(6) for m in worker.receive_any(1)) == ['a', 'b', 'c', 'a', 'b', 'c']
+
+
+def test_announced_queue_is_read_before_it_is_listed(worker, sqs):
+    worker.bulk_queues.refresh_seconds = 3600
+    worker.bulk_queues.refresh()
+    queue = create_bulk_queue(sqs, 'job')
+    send(sqs, queue, 'job', 4)
+    assert worker.receive_any(10) == []
+    announcement = {'input': {'value': {'jobid': 'job', 'bulk_queue': queue}}}
+    sqs.send_message(QueueUrl=TASK_QUEUE, MessageBody=json.dumps(announcement))
+    assert worker.take_announcements(worker.receive_any(10)) == []
+    assert jobs(worker.receive_any(10)) == ['job'] * 4
+
+
+def test_priority_slots_only_read_the_task_queue(worker, sqs):
+    send(sqs, create_bulk_queue(sqs, 'big'), 'big', 5)
+    assert worker.receive_priority(10) == []
+    send(sqs, TASK_QUEUE, 'small', 1)
+    assert jobs(worker.receive_priority(10)) == ['small']
@@ -0,0 +1,211 @@
+import json
+import threading
+import time
+
+import pytest
+from benchmarks.orchestration import BUCKET, load_lambda
+from benchmarks.standins import LocalDynamo, LocalS3
+from shared.completion import CompletionTracker, DynamoBackend
+from shared.manifest import shard_key
+
+# Latency of a send_message_batch call of the stub
+CALL_SECONDS = 0.02
+
+
+# send_message_batch with a fixed latency. Entries whose first slice is in fail_once are reported as failed the first
+# time they are sent.
+class StubSqs:
+    def __init__(self, fail_once=()):
+        self.lock = threading.Lock()
+        self.fail_once = set(fail_once)
+        self.messages = []
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert 1 <= len(Entries) <= 10
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(CALL_SECONDS)
+        failed = []
+        with self.lock:
+            self.in_flight -= 1
+            for entry in Entries:
+                if int(entry['Id']) in self.fail_once:
+                    self.fail_once.discard(int(entry['Id']))
+                    failed.append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError'})
+                else:
+                    self.messages.append(json.loads(entry['MessageBody'])['input']['value'])
+        return {'Successful': [], 'Failed': failed}
+
+    def sent_slices(self):
+        return sorted(s for message in self.messages for s in message.get('slices', [message.get('slice')]))
+
+
+@pytest.fixture
+def setup_tei(tmp_path):
+    return load_lambda('setupTei', {'s3': LocalS3(str(tmp_path)), 'dynamo': LocalDynamo()})
+
+
+def test_fan_out_sends_every_slice_once_in_concurrent_batches(setup_tei):
+    sqs = setup_tei.sqs = StubSqs()
+    slices = list(range(2000))
+    start = time.monotonic()
+    setup_tei.fan_out('queue', 'job', 's3://bucket/manifest.json', slices, 'fanout.json')
+    elapsed = time.monotonic() - start
+
+    assert sqs.sent_slices() == slices
+    assert sqs.calls == 200
+    assert all(message == {'jobid': 'job', 'manifest': 's3://bucket/manifest.json', 'slice': message['slice']}
+               for message in sqs.messages)
+    # The batches are sent from the thread pool, far faster than one call after the other
+    assert sqs.peak > 1
+    assert elapsed < sqs.calls * CALL_SECONDS / 4
+
+
+def test_fan_out_retries_failed_entries(setup_tei):
+    sqs = setup_tei.sqs = StubSqs(fail_once=range(0, 500, 7))
+    setup_tei.fan_out('queue', 'job', 's3://bucket/manifest.json', list(range(500)), 'fanout.json')
+    assert sqs.sent_slices() == list(range(500))
+    # One more call for every batch with a failed entry
+    assert sqs.calls == 50 + len({s // 10 for s in range(0, 500, 7)})
+
+
+def test_fan_out_skips_the_batches_already_sent(setup_tei):
+    setup_tei.put_json('fanout.json', {'sent': [0, 20], 'slices_per_message': 1})
+    sqs = setup_tei.sqs = StubSqs()
+    setup_tei.fan_out('queue', 'job', 's3://bucket/manifest.json', list(range(35)), 'fanout.json')
+    assert sqs.sent_slices() == list(range(10, 20)) + list(range(30, 35))
+    assert setup_tei.get_json('fanout.json')['sent'] == [0, 10, 20, 30]
+
+
+def test_fan_out_groups_slices(setup_tei):
+    sqs = setup_tei.sqs = StubSqs()
+    setup_tei.fan_out('queue', 'job', 's3://bucket/manifest.json', list(range(100)), 'fanout.json', per_message=3)
+    assert sqs.sent_slices() == list(range(100))
+    assert sorted(len(message.get('slices', [0])) for message in sqs.messages) == [1] + [3] * 33
+    assert sqs.calls == 4
+
+
+def test_fan_out_stops_when_the_job_is_deleted(setup_tei):
+    sqs = setup_tei.sqs = StubSqs()
+    setup_tei.dynamo.put_item(TableName='deleted', Item={'jobid': {'S': 'job'}})
+    setup_tei.fan_out('queue', 'job', 's3://bucket/manifest.json', list(range(5000)), 'fanout.json')
+    sent = setup_tei.get_json('fanout.json')['sent']
+    assert len(sent) < 500
+    # Only the batches that were sent are recorded
+    assert set(s for b in sent for s in range(b, b + 10)) <= set(sqs.sent_slices())
+    assert len(sqs.sent_slices()) < 5000
+
+
+def test_fan_out_saves_its_progress_and_stops_at_the_deadline(setup_tei):
+    sqs = setup_tei.sqs = StubSqs()
+    slices = list(range(3000))
+    assert not setup_tei.fan_out(
+        'queue', 'job', 's3://bucket/manifest.json', slices, 'fanout.json', deadline=time.monotonic() + 0.1)
+    first = len(sqs.messages)
+    assert 0 < first < 3000
+    # Every batch sent is recorded, the continued invocation sends the others once
+    assert len(setup_tei.get_json('fanout.json')['sent']) * 10 == first
+    assert setup_tei.fan_out(
+        'queue', 'job', 's3://bucket/manifest.json', slices, 'fanout.json', deadline=time.monotonic() + 60)
+    assert sqs.sent_slices() == slices
+
+
+def test_fan_out_records_the_batches_sent_before_a_failure(setup_tei):
+    sqs = setup_tei.sqs = StubSqs()
+    send_message_batch = sqs.send_message_batch
+
+    # The batch of slice 50 fails, the others are sent
+    def failing(QueueUrl, Entries):
+        if Entries[0]['Id'] == '50':
+            raise ConnectionError('send_message_batch')
+        return send_message_batch(QueueUrl, Entries)
+
+    sqs.send_message_batch = failing
+    with pytest.raises(ConnectionError):
+        setup_tei.fan_out('queue', 'job', 's3://bucket/manifest.json', list(range(1000)), 'fanout.json')
+    sent = setup_tei.get_json('fanout.json')['sent']
+    # Every batch whose messages were sent is recorded, the retry only sends the others
+    assert sorted(sent) == sorted({s // 10 * 10 for s in sqs.sent_slices()}) and 50 not in sent
+    sqs.send_message_batch = send_message_batch
+    setup_tei.fan_out('queue', 'job', 's3://bucket/manifest.json', list(range(1000)), 'fanout.json')
+    assert sqs.sent_slices() == list(range(1000))
+
+
+def test_fan_out_saves_its_progress_while_it_sends(setup_tei, monkeypatch):
+    monkeypatch.setattr(setup_tei, 'PROGRESS_SECONDS', 0.05)
+    monkeypatch.setattr(setup_tei, 'PROGRESS_INTERVAL', 10 ** 6)
+    sqs = setup_tei.sqs = StubSqs()
+    saved = []
+    put_json = setup_tei.put_json
+
+    def record(key, value):
+        saved.append(len(value['sent']))
+        put_json(key, value)
+
+    monkeypatch.setattr(setup_tei, 'put_json', record)
+    setup_tei.fan_out('queue', 'job', 's3://bucket/manifest.json', list(range(2000)), 'fanout.json')
+    # A Lambda killed at its timeout keeps what it saved before
+    assert len(saved) > 2 and saved[0] < 200 and saved[-1] == 200
+    assert sqs.sent_slices() == list(range(2000))
+
+
+class StubLambda:
+    def __init__(self):
+        self.invoked = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.invoked.append(json.loads(Payload))
+
+
+class StubContext:
+    function_name = 'setupTei'
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def get_remaining_time_in_millis(self):
+        return self.seconds * 1000
+
+
+def test_a_continued_resume_sends_the_slices_found_missing_at_first(tmp_path, monkeypatch):
+    s3, dynamo = LocalS3(str(tmp_path)), LocalDynamo()
+    setup_tei = load_lambda('setupTei', {
+        's3': s3, 'dynamo': dynamo, 'tracker': CompletionTracker(DynamoBackend(dynamo, 'batch')),
+        'lambda_client': StubLambda(), 'sfn': None})
+    monkeypatch.setattr(setup_tei, 'fair_share', False)
+    monkeypatch.setattr(setup_tei, 'dispatch_seconds', 0)
+    sqs = setup_tei.sqs = StubSqs()
+    slices = [[f"{i},0,0,0", f"{i + 1},0,0,0"] for i in range(3000)]
+    setup_tei.put_json('tei_args/job/manifest.json', {'slices': slices, 'numSlices': len(slices)})
+    setup_tei.put_json('job_files/job/json_files/job_info.json', {'success': True, 'basis_set_instance_size': 3000})
+
+    def write_shards(indices):
+        for i in indices:
+            s3.put_object(Bucket=BUCKET, Key=shard_key('job', *slices[i]), Body=b'')
+
+    # The first run wrote the shards of the first 500 slices
+    write_shards(range(500))
+    event = {
+        'payload': {
+            'commands': ['info', '--xyz', 'https://example.com/h2o.xyz', '--basis_set', 'sto-3g'],
+            's3_bucket_path': f"s3://{BUCKET}/job_files/job/json_files/job_info.json",
+            'jobid': 'job', 'num_batch_jobs': None, 'batch_execution': 'true', 'epsilon': 1e-9,
+            'result_cache': 'false', 'resume': 1,
+        },
+        'task_token': 'token',
+    }
+    # The deadline is reached during the fan-out
+    setup_tei.lambda_handler(event, StubContext(setup_tei.DEADLINE_MARGIN_SECONDS + 0.1))
+    assert setup_tei.lambda_client.invoked == [event]
+    assert 0 < len(sqs.messages) < 2500
+
+    # The workers write the shards of slices sent so far and of some slices not sent yet before the continuation
+    write_shards(sorted(sqs.sent_slices())[:1000])
+    setup_tei.lambda_handler(event, StubContext(900))
+    assert sqs.sent_slices() == list(range(500, 3000))
+    assert setup_tei.tracker.remaining('job/r1') == 2500
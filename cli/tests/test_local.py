@@ -0,0 +1,49 @@
+import json
+import os
+import stat
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+import cli.local as local
+from cli.local import LOCAL_BUCKET, LocalRunner
+from cli.main import cli
+
+STUB = os.path.join(local.REPO_ROOT, 'benchmarks', 'stub_integrals.py')
+
+
+# The stub integrals binary of the orchestration benchmark, run by the interpreter of the tests
+@pytest.fixture
+def integrals(tmp_path, monkeypatch):
+    monkeypatch.setenv('BENCH_S3_ROOT', str(tmp_path / 'work'))
+    monkeypatch.setenv('BENCH_BASIS_SIZE', '8')
+    path = tmp_path / 'integrals'
+    path.write_text(f"#!/bin/sh\nexec {sys.executable} {STUB} \"$@\"\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def test_local_runner_runs_a_job_end_to_end(tmp_path, integrals):
+    xyz = tmp_path / 'h2.xyz'
+    xyz.write_text("2\n\nH 0 0 0\nH 0 0 0.74\n")
+    runner = LocalRunner(str(tmp_path / 'work'), integrals, 2)
+    state = runner.run(str(xyz), 'sto-3g', 3, 5, 'true', 1e-9, log=lambda message: None)
+
+    assert state['hartree_fock_energy'] == pytest.approx(-1.5)
+    assert state['loopData']['hartree_diff'] == 0
+    job_files = os.path.join(runner.workdir, LOCAL_BUCKET, 'job_files', state['jobid'])
+    with open(os.path.join(job_files, 'json_files', f"{state['jobid']}_info.json")) as f:
+        assert json.load(f)['basis_set_instance_size'] == 8
+    # Every step wrote its output where the Lambdas of the next step read it
+    written = {name for _, _, files in os.walk(job_files) for name in files}
+    for step in ('core_hamiltonian', 'overlap', 'initial_guess', 'fock_matrix', 'scf_step'):
+        assert any(step in name for name in written), step
+
+
+def test_run_local_needs_a_checkout(tmp_path, integrals, monkeypatch):
+    monkeypatch.setattr(local, 'LAMBDA_DIR', str(tmp_path / 'site-packages' / 'cdk' / 'lambda'))
+    result = CliRunner().invoke(cli, [
+        'run-local', '--xyz', 'h2.xyz', '--basis_set', 'sto-3g', '--workdir', str(tmp_path), '--integrals', integrals])
+    assert result.exit_code == 2
+    assert 'checkout of the repository' in result.output
@@ -0,0 +1,65 @@
+import importlib.util
+import itertools
+import math
+import os
+
+import pytest
+
+from cli.local import LAMBDA_DIR
+
+spec = importlib.util.spec_from_file_location('partitioner', os.path.join(LAMBDA_DIR, 'setupTei', 'partitioner.py'))
+partitioner = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(partitioner)
+
+
+# Every quartet that integrals computes: the canonical ones with symmetry=8, all of them with symmetry=1
+def computed_quartets(n, symmetry):
+    for quartet in itertools.product(range(n), repeat=4):
+        a, b, c, d = quartet
+        if symmetry == 1 or (b <= a and d <= c and partitioner.pair_index(c, d) <= partitioner.pair_index(a, b)):
+            yield quartet
+
+
+def slice_costs(n, slices, symmetry=8):
+    return [partitioner.quartets_before(n, end, symmetry) - partitioner.quartets_before(n, begin, symmetry)
+            for begin, end in slices]
+
+
+@pytest.mark.parametrize('symmetry', [1, 8])
+@pytest.mark.parametrize('n', [1, 2, 3, 5, 6])
+def test_quartets_before_counts_the_computed_quartets(n, symmetry):
+    quartets = sorted(computed_quartets(n, symmetry))
+    # The slice boundaries partition() can return: any quartet, and the end of the index space
+    for bound in itertools.chain(itertools.product(range(n), repeat=4), [(n, 0, 0, 0)]):
+        expected = sum(quartet < bound for quartet in quartets)
+        assert partitioner.quartets_before(n, bound, symmetry) == expected, bound
+
+
+@pytest.mark.parametrize('symmetry', [1, 8])
+@pytest.mark.parametrize('n,num_parts', [
+    (1, 1), (1, 4), (2, 3), (3, 2), (4, 4), (4, 16), (5, 7), (6, 6), (6, 24), (6, 1000), (7, 49),
+])
+def test_every_quartet_is_in_exactly_one_slice(n, num_parts, symmetry):
+    slices = partitioner.partition(n, num_parts, symmetry=symmetry)
+    assert 1 <= len(slices) <= num_parts
+    assert slices[0][0] == (0, 0, 0, 0) and slices[-1][1] == (n, 0, 0, 0)
+    for quartet in computed_quartets(n, symmetry):
+        assert sum(begin <= quartet < end for begin, end in slices) == 1, quartet
+
+
+@pytest.mark.parametrize('n', [10, 25, 60, 120])
+@pytest.mark.parametrize('parts_per_function', [1, 4])
+def test_slice_costs_are_within_the_imbalance(n, parts_per_function):
+    slices = partitioner.partition(n, n * parts_per_function)
+    assert len(slices) == n * parts_per_function
+    assert partitioner.imbalance(n, slices) <= partitioner.DEFAULT_MAX_IMBALANCE
+
+
+# Slices of a few quartets can not be balanced to 5%, no slice costs more than the average rounded up then
+@pytest.mark.parametrize('n,num_parts', [(4, 16), (10, 1000), (12, 500), (30, 5000)])
+def test_small_slices_cost_at_most_the_rounded_up_average(n, num_parts):
+    slices = partitioner.partition(n, num_parts)
+    costs = slice_costs(n, slices)
+    average = partitioner.total_cost(n) / len(slices)
+    assert min(costs) > 0
+    assert max(costs) <= max((1 + partitioner.DEFAULT_MAX_IMBALANCE) * average, math.ceil(average))
@@ -0,0 +1,106 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+from benchmarks.standins import LocalS3
+from shared import binfile
+from worker.prefetch import PrefetchStats, ShardPrefetcher
+
+CHUNK = 1000
+
+
+# Records the ranges requested and the largest number of requests in flight, fails the ranges of one key
+class RecordingS3(LocalS3):
+    def __init__(self, root, fail_key=None):
+        super().__init__(root)
+        self.fail_key = fail_key
+        self.ranges = []
+        self.in_flight = 0
+        self.peak = 0
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.ranges.append((Key, kwargs['Range']))
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(0.002)
+        with self.lock:
+            self.in_flight -= 1
+        if Key == self.fail_key:
+            raise ConnectionError(Key)
+        return super().get_object(Bucket, Key, **kwargs)
+
+
+def put_shards(s3, sizes, codec=None):
+    shards, contents = [], {}
+    for i, size in enumerate(sizes):
+        key = f"job/job_eri_{i}.bin"
+        data = bytes((i + j) % 251 for j in range(size))
+        body = data if codec is None else b''.join(binfile.encode(io.BytesIO(data), codec))
+        s3.put_object(Bucket='bucket', Key=key, Body=body)
+        shards.append({'Key': key, 'Size': len(body)})
+        contents[os.path.basename(key)] = data
+    return shards, contents
+
+
+def test_shards_are_split_into_ranges_of_chunk_bytes(tmp_path):
+    s3 = RecordingS3(str(tmp_path / 's3'))
+    shards, contents = put_shards(s3, [2500, 1000, 1, 0])
+    stats = ShardPrefetcher(s3, threads=4, chunk_bytes=CHUNK).fetch('bucket', shards, str(tmp_path / 'eri'))
+
+    assert sorted(s3.ranges) == sorted([
+        ('job/job_eri_0.bin', 'bytes=0-999'), ('job/job_eri_0.bin', 'bytes=1000-1999'),
+        ('job/job_eri_0.bin', 'bytes=2000-2499'), ('job/job_eri_1.bin', 'bytes=0-999'),
+        ('job/job_eri_2.bin', 'bytes=0-0'),
+    ])
+    for name, data in contents.items():
+        assert (tmp_path / 'eri' / name).read_bytes() == data
+    assert (stats.shards, stats.bytes, stats.requests) == (4, 3501, 5)
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'zlib'])
+def test_compressed_shards_are_decoded_across_ranges(tmp_path, codec):
+    s3 = RecordingS3(str(tmp_path / 's3'))
+    shards, contents = put_shards(s3, [20000, 5000], codec)
+    stats = ShardPrefetcher(s3, threads=4, chunk_bytes=CHUNK).fetch('bucket', shards, str(tmp_path / 'eri'))
+    for name, data in contents.items():
+        assert (tmp_path / 'eri' / name).read_bytes() == data
+    # The stored (compressed) bytes are counted
+    assert stats.bytes == sum(shard['Size'] for shard in shards)
+    assert stats.requests == len(s3.ranges)
+
+
+def test_at_most_buffer_bytes_are_requested_ahead(tmp_path):
+    s3 = RecordingS3(str(tmp_path / 's3'))
+    shards, contents = put_shards(s3, [10000] * 5)
+    prefetcher = ShardPrefetcher(s3, threads=16, chunk_bytes=CHUNK, buffer_bytes=3 * CHUNK)
+    prefetcher.fetch('bucket', shards, str(tmp_path / 'eri'))
+    assert len(s3.ranges) == 50
+    assert s3.peak <= 3
+    for name, data in contents.items():
+        assert (tmp_path / 'eri' / name).read_bytes() == data
+
+
+def test_a_failed_range_fails_the_fetch_without_partial_shards(tmp_path):
+    s3 = RecordingS3(str(tmp_path / 's3'), fail_key='job/job_eri_2.bin')
+    shards, _ = put_shards(s3, [3000] * 6)
+    with pytest.raises(ConnectionError):
+        ShardPrefetcher(s3, threads=4, chunk_bytes=CHUNK).fetch('bucket', shards, str(tmp_path / 'eri'))
+    # The shard being written never appears under its name
+    written = os.listdir(tmp_path / 'eri')
+    assert 'job_eri_0.bin' in written and 'job_eri_1.bin' in written
+    assert not {f"job_eri_{i}.bin" for i in range(2, 6)} & set(written)
+    # The feeder and the pool are stopped
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('prefetch')]
+
+
+def test_prefetch_stats_add_up():
+    total = PrefetchStats()
+    total.add(PrefetchStats(shards=2, bytes=3 * 1024 ** 2, requests=3, seconds=1.0, stall_seconds=0.25))
+    total.add(PrefetchStats(shards=1, bytes=1024 ** 2, requests=1, seconds=1.0))
+    assert total.to_dict() == {
+        'shards': 3, 'bytes': 4 * 1024 ** 2, 'requests': 4, 'seconds': 2.0, 'stall_seconds': 0.25, 'mib_per_s': 2.0,
+    }
+    assert PrefetchStats().to_dict()['mib_per_s'] is None
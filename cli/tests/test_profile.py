@@ -0,0 +1,108 @@
+import signal
+import sys
+
+import pytest
+from benchmarks.standins import LocalS3
+from worker.profile import ProfileRecorder, TaskProfile, run_measured
+
+import cli.helpers as helpers
+
+# Reads 1 MB and writes 2 MB besides what the interpreter itself reads
+SCRIPT = "import sys; open(sys.argv[1], 'rb').read(); open(sys.argv[2], 'wb').write(b'x' * 2000000); print('done')"
+
+
+def test_run_measured_counts_the_bytes_of_the_process(tmp_path):
+    (tmp_path / 'input').write_bytes(b'x' * 1000000)
+    started = []
+    with open(tmp_path / 'stdout', 'wb') as stdout:
+        returncode, read, written, rss = run_measured(
+            [sys.executable, '-c', SCRIPT, 'input', 'output'], str(tmp_path), stdout, started.append)
+    assert returncode == 0
+    assert started[0].returncode == 0
+    assert (tmp_path / 'stdout').read_bytes() == b'done\n'
+    if sys.platform.startswith('linux'):
+        assert read >= 1000000 and 2000000 <= written < 2100000
+    assert rss > 0
+
+
+def test_run_measured_reports_a_killed_process(tmp_path):
+    with open(tmp_path / 'stdout', 'wb') as stdout:
+        returncode, _, _, _ = run_measured(
+            [sys.executable, '-c', 'import time; time.sleep(60)'], str(tmp_path), stdout,
+            lambda process: process.send_signal(signal.SIGKILL))
+    assert returncode == -signal.SIGKILL
+
+
+def task(step, sent, start, end, index=None, status='success', compute=0.0):
+    value = {'jobid': 'job', 's3_bucket_path': 's3://bucket/job_files/job/json_files/out.json', 'commands': [step]}
+    if step == 'two_electrons_integrals':
+        value['slice'] = index
+    elif index is not None:
+        value['loopData'] = {'loopCount': index + 1}
+    profile = TaskProfile(sent=sent, received=sent + 0.5, start=start, end=end, status=status, compute=compute,
+                          bytes_read=100, bytes_written=10, peak_rss_kb=1000 + (index or 0))
+    profile.describe(value)
+    return profile
+
+
+def job_tasks():
+    tasks = [task('info', 0, 1, 3)]
+    tasks += [task(step, 4, 4.5, end) for step, end in
+              (('core_hamiltonian', 6), ('overlap', 5), ('initial_guess', 7))]
+    # Slice 7 is a straggler, slice 3 was forwarded to the worker holding its shards before it ran there
+    tasks += [task('two_electrons_integrals', 4, 5, 13 if i == 7 else 7, i, compute=1.5) for i in range(10)]
+    tasks.append(task('two_electrons_integrals', 4, 4.5, 4.6, 3, status='forwarded'))
+    tasks += [task('fock_matrix', 15, 15.5, 17, 0), task('scf_step', 18, 18.5, 21, 0),
+              task('fock_matrix', 22, 22.5, 23, 1), task('scf_step', 24, 24.5, 30, 1)]
+    return tasks
+
+
+@pytest.fixture
+def records(tmp_path, monkeypatch):
+    s3 = LocalS3(str(tmp_path))
+    monkeypatch.setattr(helpers, 's3', s3)
+    # Two workers, one of them flushing every 4 records
+    recorders = [ProfileRecorder(s3, 'worker-a', max_records=4), ProfileRecorder(s3, 'worker-b')]
+    for i, profile in enumerate(job_tasks()):
+        recorders[i % 2].add(profile)
+    for recorder in recorders:
+        recorder.flush_all()
+    return helpers.read_job_profile('bucket', 'job')
+
+
+def test_records_are_read_back_from_the_profile_objects(records):
+    assert len(records) == len(job_tasks())
+    assert {record['worker'] for record in records} == {'worker-a', 'worker-b'}
+    info = next(record for record in records if record['step'] == 'info')
+    assert info['queue'] == 0.5 and info['fetch'] == 2.0
+
+
+def test_profile_job_aggregates_the_steps(records):
+    profile = helpers.profile_job(records)
+    assert profile['tasks'] == 18 and profile['forwarded'] == 1
+    eri = profile['steps']['two_electrons_integrals']
+    assert eri['count'] == 10 and eri['read'] == 1000 and eri['rss_kb'] == 1009
+    assert eri['compute'] == {'mean': 1.5, 'p50': 1.5, 'p95': 1.5, 'max': 1.5}
+    assert eri['total']['p50'] == 3 and eri['total']['max'] == 9
+    assert profile['iterations'] == {0: {'fock_matrix': 2, 'scf_step': 3}, 1: {'fock_matrix': 1, 'scf_step': 6}}
+
+
+def test_profile_job_follows_the_critical_path(records):
+    profile = helpers.profile_job(records)
+    stages = [(stage['stage'], stage['dominant'], stage['duration'], stage['gap'])
+              for stage in profile['critical_path']]
+    assert stages == [
+        ('info', 'info', 3, 0),
+        ('parallel', 'two_electrons_integrals', 9, 1),
+        ('iteration 0', 'scf_step', 6, 2),
+        ('iteration 1', 'scf_step', 8, 1),
+    ]
+    assert profile['wall'] == 30
+
+
+def test_profile_job_finds_the_stragglers(records):
+    profile = helpers.profile_job(records)
+    assert profile['slice_median'] == 2
+    assert [record['index'] for record in profile['stragglers']] == [7]
+    # Without a slice far slower than the median, the slowest ones are listed
+    assert len(helpers.profile_job(records, straggler_factor=10, slowest=3)['stragglers']) == 3
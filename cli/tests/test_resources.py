@@ -0,0 +1,57 @@
+import pytest
+
+import cli.helpers as helpers
+
+
+class FakeEc2:
+    def __init__(self):
+        self.calls = 0
+
+    def describe_vpcs(self, Filters):
+        self.calls += 1
+        return {'Vpcs': [{'VpcId': 'vpc-1'}]}
+
+    def describe_subnets(self, Filters):
+        assert Filters == [{'Name': 'vpc-id', 'Values': ['vpc-1']}]
+        return {'Subnets': [{'SubnetId': 'subnet-a'}, {'SubnetId': 'subnet-b'}, {'SubnetId': 'subnet-c'}]}
+
+
+class FakeEcs:
+    def __init__(self):
+        self.tasks = []
+
+    def run_task(self, **kwargs):
+        self.tasks.append(kwargs)
+        return {'tasks': [{'taskArn': 'task'}]}
+
+
+class FakeSts:
+    def get_caller_identity(self):
+        return {'Account': '123456789012'}
+
+
+@pytest.fixture
+def clients(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers, 'RESOURCE_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'ca-central-1')
+    ec2, ecs = FakeEc2(), FakeEcs()
+    monkeypatch.setattr(helpers, 'ec2', ec2)
+    monkeypatch.setattr(helpers, 'ecs', ecs)
+    monkeypatch.setattr(helpers, 'sts', FakeSts())
+    return ec2, ecs
+
+
+def test_subnets_are_looked_up_once_a_task_is_launched(clients):
+    ec2, ecs = clients
+    resources = helpers.resolve_resource_config('bucket')
+    assert resources.subnets == [] and ec2.calls == 0
+    assert resources.sfn_arn == 'arn:aws:states:ca-central-1:123456789012:stateMachine:IntegralsStateMachine'
+
+    helpers.run_ecs_task(['info'], 's3://bucket/info.json', resources)
+    helpers.run_ecs_task(['info'], 's3://bucket/info.json', resources)
+    assert [task['networkConfiguration']['awsvpcConfiguration']['subnets'] for task in ecs.tasks] == [
+        ['subnet-a', 'subnet-b']] * 2
+    assert ec2.calls == 1
+    # Cached with the account id for the next commands
+    assert helpers.resolve_resource_config('bucket').subnets == ['subnet-a', 'subnet-b']
+    assert ec2.calls == 1
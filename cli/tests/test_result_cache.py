@@ -0,0 +1,55 @@
+import time
+
+import pytest
+from benchmarks.standins import LocalS3
+from shared.result_cache import ResultCache
+
+
+# Counts the head_object calls and the largest number of copies running at once
+class CountingS3(LocalS3):
+    def __init__(self, root):
+        super().__init__(root)
+        self.heads = 0
+        self.copying = 0
+        self.peak = 0
+
+    def head_object(self, Bucket, Key):
+        with self.lock:
+            self.heads += 1
+        return super().head_object(Bucket, Key)
+
+    def copy(self, source, bucket, key):
+        with self.lock:
+            self.copying += 1
+            self.peak = max(self.peak, self.copying)
+        time.sleep(0.01)
+        super().copy(source, bucket, key)
+        with self.lock:
+            self.copying -= 1
+
+
+@pytest.fixture
+def s3(tmp_path):
+    s3 = CountingS3(str(tmp_path))
+    for i in range(40):
+        s3.put_object(Bucket='bucket', Key=f"job_{i}.bin", Body=b'x' * (i + 1))
+    return s3
+
+
+def shards():
+    return {f"job_{i}.bin": f"job_{i}.bin" for i in range(40)}
+
+
+def test_store_takes_the_sizes_of_the_listing(s3):
+    cache = ResultCache(s3, 'bucket')
+    entry = cache.store('key', 'two_electrons_integrals', shards(), sizes={f"job_{i}.bin": i + 1 for i in range(40)})
+    assert entry['bytes'] == sum(range(1, 41)) and s3.heads == 0
+    assert cache.lookup('key') == entry
+    # The shards are copied concurrently
+    assert 1 < s3.peak <= cache.threads
+    assert s3.get_object(Bucket='bucket', Key='result_cache/key/job_39.bin')['Body'].read() == b'x' * 40
+
+
+def test_store_looks_up_the_sizes_it_is_not_given(s3):
+    entry = ResultCache(s3, 'bucket').store('key', 'two_electrons_integrals', shards())
+    assert entry['bytes'] == sum(range(1, 41)) and s3.heads == 40
@@ -0,0 +1,83 @@
+import io
+import json
+import math
+import struct
+
+import numpy
+import pytest
+from benchmarks.standins import LocalS3
+from shared import binfile
+
+import cli.helpers as helpers
+from cli.results import gather_results, job_arrays
+
+INFO = {'success': True, 'basis_set_instance_size': 2}
+
+
+def loop_outputs(energies, diis_errors=None):
+    outputs = {}
+    for i, energy in enumerate(energies):
+        if energy is not None:
+            outputs[f"scf_step_{i}"] = {'success': True, 'hartree_fock_energy': energy}
+        outputs[f"fock_matrix_{i}"] = {'success': True, 'diis_error': (diis_errors or {}).get(i)}
+    return outputs
+
+
+def test_job_arrays_follow_the_loop_iterations():
+    arrays = job_arrays('job', {'info': INFO, **loop_outputs([-1.0, -1.5, -1.75], {1: 0.1, 2: 0.01})})
+    assert arrays['iteration'].tolist() == [0, 1, 2]
+    assert arrays['hartree_fock_energy'].tolist() == [-1.0, -1.5, -1.75]
+    # No previous energy for the first iteration
+    assert math.isnan(arrays['hartree_diff'][0]) and arrays['hartree_diff'][1:].tolist() == [0.5, 0.25]
+    assert math.isnan(arrays['diis_error'][0]) and arrays['diis_error'][1:].tolist() == [0.1, 0.01]
+    metadata = json.loads(arrays['metadata'].item())
+    assert metadata['jobid'] == 'job' and metadata['steps'] == {'info': INFO}
+    assert [output['hartree_fock_energy'] for output in metadata['scf_step']] == [-1.0, -1.5, -1.75]
+
+
+def test_missing_iterations_are_nan():
+    # Iteration 1 has no scf_step output, the energy and both differences next to it are NaN
+    arrays = job_arrays('job', loop_outputs([-1.0, None, -1.75, -1.875]))
+    energy, diff = arrays['hartree_fock_energy'], arrays['hartree_diff']
+    assert math.isnan(energy[1]) and energy[[0, 2, 3]].tolist() == [-1.0, -1.75, -1.875]
+    assert numpy.isnan(diff[:3]).all() and diff[3] == 0.125
+    assert json.loads(arrays['metadata'].item())['scf_step'][1] is None
+
+
+def test_jobs_without_loop_outputs_have_empty_arrays():
+    arrays = job_arrays('job', {'info': INFO, 'fock_matrix_0': {'success': True}})
+    for name in ('iteration', 'hartree_fock_energy', 'hartree_diff', 'diis_error'):
+        assert arrays[name].shape == (0,)
+
+
+def put_json(s3, jobid, name, output):
+    s3.put_object(Bucket='bucket', Key=f"job_files/{jobid}/json_files/{jobid}_{name}.json",
+                  Body=json.dumps(output).encode())
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    s3 = LocalS3(str(tmp_path / 's3'))
+    monkeypatch.setattr(helpers, 's3', s3)
+    return s3
+
+
+def test_gather_results_writes_an_npz_per_job(s3, tmp_path):
+    for name, output in {'info': INFO, **loop_outputs([-1.0, -1.5])}.items():
+        put_json(s3, 'a', name, output)
+    # Compressed and raw matrices of a, the last iteration is 1
+    matrix = struct.pack('<4d', 1, 2, 3, 4)
+    s3.put_object(Bucket='bucket', Key='job_files/a/bin_files/a_overlap.bin',
+                  Body=b''.join(binfile.encode(io.BytesIO(matrix), 'zlib')))
+    s3.put_object(Bucket='bucket', Key='job_files/a/bin_files/a_scf_step_1.bin', Body=matrix)
+    s3.put_object(Bucket='bucket', Key='job_files/a/bin_files/a_scf_step_0.bin', Body=matrix[:8])
+
+    results = gather_results('bucket', ['a', 'b'], str(tmp_path / 'results'), matrices=True, threads=4)
+    assert results[0] == ('a', str(tmp_path / 'results' / 'a.npz'), None)
+    assert results[1] == ('b', None, 'no outputs found')
+    with numpy.load(results[0][1]) as arrays:
+        assert arrays['hartree_fock_energy'].tolist() == [-1.0, -1.5]
+        assert arrays['overlap'].tolist() == [[1, 2], [3, 4]]
+        assert arrays['density'].tolist() == [[1, 2], [3, 4]]
+        # Matrices that were not written are left out
+        assert 'fock_matrix' not in arrays and 'core_hamiltonian' not in arrays
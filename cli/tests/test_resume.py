@@ -0,0 +1,41 @@
+import pytest
+from benchmarks.standins import LocalS3
+
+import cli.helpers as helpers
+
+JOB_INPUT = {
+    'commands': ['info', '--xyz', 'https://example.com/h2o.xyz', '--basis_set', 'sto-3g'],
+    's3_bucket_path': 's3://bucket/job_files/job/json_files/job_info.json',
+    'jobid': 'job',
+    'max_iter': 30,
+    'epsilon': 1e-9,
+}
+PARALLEL = {'resume_from': 'parallel', 'completed_steps': ['overlap'], 'eri_prefix': None}
+LOOP = {
+    'resume_from': 'loop', 'eri_prefix': 'job', 'loopData': {'loopCount': 3, 'hartree_diff': 0.1},
+    'hartree_fock_energy': -74.9,
+}
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    s3 = LocalS3(str(tmp_path))
+    monkeypatch.setattr(helpers, 's3', s3)
+    return s3
+
+
+@pytest.mark.parametrize('plan', [PARALLEL, LOOP])
+def test_resume_reads_the_staged_xyz(s3, plan):
+    # Without a staged copy (the info step ran before inputs were staged), the original URL is kept
+    assert helpers.resume_input('bucket', JOB_INPUT, plan, 1)['commands'] == JOB_INPUT['commands']
+
+    s3.put_object(Bucket='bucket', Key='job_files/job/input/job.xyz', Body=b'1\n\nH 0 0 0\n')
+    resumed = helpers.resume_input('bucket', JOB_INPUT, plan, 1)
+    assert resumed['commands'] == ['info', '--xyz', 's3://bucket/job_files/job/input/job.xyz', '--basis_set', 'sto-3g']
+    assert resumed['resume_from'] == plan['resume_from']
+    assert JOB_INPUT['commands'][2] == 'https://example.com/h2o.xyz'
+
+
+def test_resume_from_info_fetches_the_xyz_again(s3):
+    s3.put_object(Bucket='bucket', Key='job_files/job/input/job.xyz', Body=b'1\n\nH 0 0 0\n')
+    assert helpers.resume_input('bucket', JOB_INPUT, {'resume_from': 'info'}, 1) == JOB_INPUT
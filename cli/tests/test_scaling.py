@@ -0,0 +1,165 @@
+import json
+import os
+
+import pytest
+from benchmarks.scaling_replay import DEFAULT_TRACE, Simulation
+from benchmarks.standins import LocalCloudWatch, LocalDynamo, LocalSqs
+from shared.bulk_queue import create_bulk_queue
+from shared.scaling import Demand, Service, desired_counts, desired_slots, put_plan
+
+SERVICE = Service('workers', 0, 20, 2)
+TRACES = {
+    'default': DEFAULT_TRACE,
+    'single': [{'start': 0, 'slices': 300, 'slice_seconds': 30, 'iterations': 10, 'iteration_seconds': 10}],
+    'staggered': [
+        {'start': 60 * i, 'slices': 20, 'slice_seconds': 10, 'iterations': 5, 'iteration_seconds': 5}
+        for i in range(8)
+    ],
+}
+
+
+def test_desired_slots_cover_the_critical_tasks_and_the_loops():
+    assert desired_slots(Demand(critical=3, planned=0, bulk=0, loop_jobs=0), 60, 0) == 3
+    assert desired_slots(Demand(critical=1, planned=0, bulk=0, loop_jobs=4), 60, 0) == 4
+
+
+def test_desired_slots_drain_the_slices_in_time():
+    # 600 slices of 30s in 300s need 60 slots, 5 of them one slot besides the critical tasks
+    assert desired_slots(Demand(critical=0, planned=400, bulk=200, loop_jobs=0), 30, 0, drain_seconds=300) == 60
+    assert desired_slots(Demand(critical=2, planned=0, bulk=5, loop_jobs=0), 30, 0, drain_seconds=300) == 3
+    # Never more slots than slices
+    assert desired_slots(Demand(critical=0, planned=0, bulk=5, loop_jobs=0), 600, 0, drain_seconds=300) == 5
+
+
+def test_desired_slots_skip_workers_that_would_start_too_late():
+    # The 10 current slots run the 40 slices of 20s in 80s, before new workers would start
+    demand = Demand(critical=0, planned=0, bulk=40, loop_jobs=0)
+    assert desired_slots(demand, 20, 10, drain_seconds=60, startup_seconds=90) == 10
+    assert desired_slots(demand, 20, 10, drain_seconds=60, startup_seconds=30) == 14
+
+
+def test_desired_counts_fill_the_services_in_order_within_their_bounds():
+    services = [Service('fargate', 1, 4, 2), Service('ec2', 0, 2, 8)]
+    assert desired_counts(services, 0) == {'fargate': 1, 'ec2': 0}
+    assert desired_counts(services, 7) == {'fargate': 4, 'ec2': 0}
+    assert desired_counts(services, 20) == {'fargate': 4, 'ec2': 2}
+    assert desired_counts(services, 100) == {'fargate': 4, 'ec2': 2}
+
+
+# A job's slices drain as the controller runs every minute with the slots it asked for the minute before
+def test_desired_slots_follow_a_draining_job_down():
+    bulk, slots, history = 400, 0, []
+    while bulk:
+        slots = desired_slots(Demand(critical=1, planned=0, bulk=bulk, loop_jobs=1), 20, slots)
+        history.append(slots)
+        assert slots <= 1 + bulk
+        bulk = max(0, bulk - (slots - 1) * 3)
+    assert history == sorted(history, reverse=True)
+    assert desired_slots(Demand(critical=1, planned=0, bulk=0, loop_jobs=1), 20, slots) == 1
+
+
+@pytest.mark.parametrize('trace', TRACES.values(), ids=list(TRACES))
+def test_predictive_scaling_runs_the_jobs_faster(trace):
+    reactive = Simulation(trace, 'reactive', SERVICE, startup=90, drain=300).run()
+    predictive = Simulation(trace, 'predictive', SERVICE, startup=90, drain=300).run()
+    assert sum(predictive['jobs']) < sum(reactive['jobs'])
+
+
+# The step policy scales in one task a minute. With a stream of small jobs, the workers started ahead of their slices
+# stay longer than the reactive policy's, large jobs still take fewer worker hours.
+@pytest.mark.parametrize('trace', ['default', 'single'])
+def test_predictive_scaling_runs_large_jobs_for_fewer_worker_hours(trace):
+    reactive = Simulation(TRACES[trace], 'reactive', SERVICE, startup=90, drain=300).run()
+    predictive = Simulation(TRACES[trace], 'predictive', SERVICE, startup=90, drain=300).run()
+    assert predictive['worker_hours'] < reactive['worker_hours']
+
+
+def test_predictive_scaling_starts_a_worker_for_a_loop_below_the_queue_depth_alarms():
+    trace = [{'start': 0, 'slices': 1, 'slice_seconds': 5, 'iterations': 40, 'iteration_seconds': 10}]
+    result = Simulation(trace, 'predictive', SERVICE, startup=90, drain=300).run()
+    assert result['jobs'] == [495]
+
+
+# Worker services whose task definitions set WORKER_SLOTS to slots[name]
+class FakeEcs:
+    def __init__(self, counts, slots):
+        self.counts = counts
+        self.slots = slots
+        self.described = []
+
+    def describe_services(self, cluster, services):
+        return {'services': [
+            {'serviceName': name, 'desiredCount': self.counts[name], 'taskDefinition': f"{name}:1"} for name in services
+        ]}
+
+    def describe_task_definition(self, taskDefinition):
+        self.described.append(taskDefinition)
+        slots = self.slots[taskDefinition.split(':')[0]]
+        environment = [{'name': 'TASK_QUEUE', 'value': 'queue'}, {'name': 'WORKER_SLOTS', 'value': str(slots)}]
+        return {'taskDefinition': {'containerDefinitions': [{'name': 'container', 'environment': environment}]}}
+
+    def update_service(self, cluster, service, desiredCount):
+        self.counts[service] = desiredCount
+
+
+class FakeAutoscaling:
+    def __init__(self):
+        self.minimums = {}
+
+    def register_scalable_target(self, ResourceId, MinCapacity, **kwargs):
+        self.minimums[ResourceId] = MinCapacity
+
+    def describe_scalable_targets(self, ServiceNamespace, ResourceIds):
+        return {'ScalableTargets': [
+            {'ResourceId': id, 'MinCapacity': self.minimums[id]} for id in ResourceIds if id in self.minimums
+        ]}
+
+
+class SliceSeconds(LocalCloudWatch):
+    def get_metric_statistics(self, **kwargs):
+        return {'Datapoints': [{'SampleCount': 10, 'Sum': 300}]}
+
+
+def test_scale_workers_sets_the_desired_counts_from_the_plans_and_queues(monkeypatch):
+    from benchmarks.orchestration import load_lambda
+
+    monkeypatch.setitem(os.environ, 'CLUSTER', 'cluster')
+    monkeypatch.setitem(os.environ, 'SERVICES', json.dumps([
+        {'name': 'fargate', 'min': 0, 'max': 20, 'scalable': True},
+        {'name': 'ec2', 'min': 0, 'max': 1},
+    ]))
+    sqs, dynamo, autoscaling = LocalSqs(), LocalDynamo(), FakeAutoscaling()
+    ecs = FakeEcs({'fargate': 1, 'ec2': 0}, {'fargate': 2, 'ec2': 5})
+    scaler = load_lambda('scaleWorkers', {
+        'sqs': sqs, 'dynamo': dynamo, 'cloudwatch': SliceSeconds(), 'ecs': ecs, 'autoscaling': autoscaling})
+
+    # 500 slices of 30s about to be sent and a job in its loop: 1 + 50 slots
+    put_plan(dynamo, 'batch', 'a', 'eri', 500)
+    put_plan(dynamo, 'batch', 'b', 'loop')
+    result = scaler.lambda_handler({}, None)
+    assert result['slots'] == 51
+    # The EC2 service takes what the Fargate service can not, within its maximum
+    assert ecs.counts == {'fargate': 20, 'ec2': 1}
+    assert autoscaling.minimums == {'service/cluster/fargate': 20}
+
+    # Once sent, 30 slices are left in the job's queue: 3 slots run them in 300s. The EC2 service is scaled in, the
+    # Fargate service is left to its queue depth policy and keeps its minimum while slices are queued.
+    put_plan(dynamo, 'batch', 'a', 'eri')
+    queue = create_bulk_queue(sqs, 'a')
+    for i in range(30):
+        sqs.send_message(QueueUrl=queue, MessageBody='{}')
+    result = scaler.lambda_handler({}, None)
+    assert result['slots'] == 4 and result['counts'] == {'fargate': 2, 'ec2': 0}
+    assert ecs.counts == {'fargate': 20, 'ec2': 0}
+    assert autoscaling.minimums == {'service/cluster/fargate': 20}
+
+    # Once the slices have run, the minimum goes back to the service's, and the desired count the policy set is kept
+    sqs.queues[queue].clear()
+    ecs.counts['fargate'] = 12
+    result = scaler.lambda_handler({}, None)
+    assert result['counts'] == {'fargate': 1, 'ec2': 0}
+    assert ecs.counts == {'fargate': 12, 'ec2': 0}
+    assert autoscaling.minimums == {'service/cluster/fargate': 0}
+
+    # The slots of a task definition revision are read once
+    assert ecs.described == ['fargate:1', 'ec2:1']
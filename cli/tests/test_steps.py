@@ -0,0 +1,95 @@
+import pytest
+from benchmarks.orchestration import BUCKET, XYZ, load_lambda
+from benchmarks.standins import LocalCloudWatch, LocalDynamo, LocalS3
+from shared.result_cache import ResultCache, cache_key
+from shared.scaling import BACKLOG_NAMESPACE, DURATION_METRIC
+
+XYZ_URL = f"s3://{BUCKET}/input/h2o.xyz"
+STATE = {
+    'commands': ['info', '--xyz', XYZ_URL, '--basis_set', 'sto-3g'],
+    'jobid': 'job',
+    'max_iter': 30,
+    'epsilon': 1e-9,
+    'output': {'stepName': 'one_electron'},
+}
+
+
+@pytest.fixture
+def s3(tmp_path):
+    s3 = LocalS3(str(tmp_path))
+    s3.put_object(Bucket=BUCKET, Key='input/h2o.xyz', Body=XYZ.encode())
+    return s3
+
+
+@pytest.fixture
+def setup_calculations(s3):
+    return load_lambda('setupCalculations', {
+        's3': s3, 'dynamo': LocalDynamo(), 'result_cache': ResultCache(s3, BUCKET)})
+
+
+def step_names(result):
+    return [step['commands'][0] for step in result['steps']]
+
+
+def test_one_electron_runs_the_three_steps_in_one_task(setup_calculations):
+    result = setup_calculations.lambda_handler(STATE, None)
+    assert result['commands'][0] == 'one_electron' and '--output_object' not in result['commands']
+    assert step_names(result) == ['core_hamiltonian', 'overlap', 'initial_guess']
+    assert not result['cached']
+    # Every step writes its outputs where the states after the parallel state read them
+    overlap = result['steps'][1]
+    assert overlap['s3_bucket_path'] == f"s3://{BUCKET}/job_files/job/json_files/job_overlap.json"
+    assert overlap['commands'][-2:] == ['--output_object', 'job_files/job/bin_files/job_overlap.bin']
+    assert overlap['cache_key'] == cache_key(XYZ, 'sto-3g', 'overlap')
+
+
+def test_one_electron_leaves_out_cached_and_completed_steps(setup_calculations, s3):
+    for name in ('overlap.bin', 'overlap.json'):
+        s3.put_object(Bucket=BUCKET, Key=f"other/{name}", Body=b'{}')
+    setup_calculations.result_cache.store(cache_key(XYZ, 'sto-3g', 'overlap'), 'overlap', {
+        'output.bin': 'other/overlap.bin', 'output.json': 'other/overlap.json'})
+
+    result = setup_calculations.lambda_handler({**STATE, 'completed_steps': ['initial_guess']}, None)
+    assert step_names(result) == ['core_hamiltonian']
+    assert s3.get_object(Bucket=BUCKET, Key='job_files/job/bin_files/job_overlap.bin')['Body'].read() == b'{}'
+    assert not result['cached']
+
+    # The task is skipped when no step is left
+    result = setup_calculations.lambda_handler(
+        {**STATE, 'completed_steps': ['initial_guess', 'core_hamiltonian']}, None)
+    assert result['steps'] == [] and result['cached']
+
+
+def test_one_electron_steps_without_the_result_cache(setup_calculations):
+    result = setup_calculations.lambda_handler({**STATE, 'result_cache': 'false'}, None)
+    assert step_names(result) == ['core_hamiltonian', 'overlap', 'initial_guess']
+    assert all(step['cache_key'] is None for step in result['steps'])
+
+
+@pytest.fixture
+def setup_tei(s3):
+    return load_lambda('setupTei', {'s3': s3, 'dynamo': LocalDynamo(), 'cloudwatch': LocalCloudWatch()})
+
+
+def publish_slice_seconds(cloudwatch, seconds):
+    cloudwatch.put_metric_data(Namespace=BACKLOG_NAMESPACE, MetricData=[{
+        'MetricName': DURATION_METRIC, 'Dimensions': [{'Name': 'Step', 'Value': 'two_electrons_integrals'}],
+        'Value': seconds}])
+
+
+@pytest.mark.parametrize('seconds, expected', [(None, 1), (5, 1), (2, 1), (0.5, 4), (0.3, 7), (0.01, 10)])
+def test_short_slices_are_grouped_to_take_the_dispatch_time(setup_tei, monkeypatch, seconds, expected):
+    monkeypatch.setattr(setup_tei, 'dispatch_seconds', 2)
+    if seconds is not None:
+        publish_slice_seconds(setup_tei.cloudwatch, seconds)
+    assert setup_tei.slices_per_message() == expected
+
+
+def test_slices_are_sent_one_per_message_without_dispatch_time(setup_tei, monkeypatch):
+    publish_slice_seconds(setup_tei.cloudwatch, 0.01)
+    monkeypatch.setattr(setup_tei, 'dispatch_seconds', 0)
+    assert setup_tei.slices_per_message() == 1
+    # Nor when the duration of the slices can not be read
+    monkeypatch.setattr(setup_tei, 'dispatch_seconds', 2)
+    monkeypatch.setattr(setup_tei.cloudwatch, 'get_metric_statistics', None)
+    assert setup_tei.slices_per_message() == 1
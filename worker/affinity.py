@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+from typing import Optional, Set
+
+# Registry entries live in the batch table under this prefix, with a TTL attribute so stale entries expire
+REGISTRY_PREFIX = 'affinity#'
+# Liveness items of the workers ({WORKER_PREFIX}{queue url}), refreshed by the heartbeat of every worker
+WORKER_PREFIX = 'affinity-worker#'
+# Seconds an entry stays valid without being refreshed by the heartbeat of its worker
+REGISTRY_TTL = 180
+# Seconds between two sweeps of the expired entries by a worker
+SWEEP_SECONDS = REGISTRY_TTL
+
+
+# Job affinity for fock_matrix tasks. Every worker owns a private queue and keeps a liveness item for it in the
+# batch table. A worker that caches the ERI shards of a job registers its queue as the job's owner, and workers
+# that receive a fock_matrix task for a job owned by another live worker forward the message to the owner's queue.
+# Messages are forwarded at most once. A worker deletes the entry of a job it evicts from its cache. The entry of a
+# job only says which queue to forward to: a queue is reclaimed only once the liveness item of its worker has
+# expired. The next worker to look up a job of a stopped owner then moves the owner's queued messages back to the
+# shared task queue and takes over. Every worker also sweeps the expired items periodically, so the messages of a
+# stopped owner go back to the shared queue even when nobody looks its jobs up again.
+class AffinityRouter:
+    def __init__(self, sqs, dynamo, config):
+        self.sqs = sqs
+        self.dynamo = dynamo
+        self.config = config
+        self.queue_url: Optional[str] = None
+        self.jobs: Set[str] = set()
+        self.lock = threading.Lock()
+        self.swept_at = time.time()
+
+    def start(self, name):
+        self.queue_url = self.sqs.create_queue(
+            QueueName=f"integrals-affinity-{name}",
+            Attributes={'VisibilityTimeout': str(self.config.visibility_timeout), 'MessageRetentionPeriod': '3600'},
+        )['QueueUrl']
+        self.put_item(f"{WORKER_PREFIX}{self.queue_url}")
+        logging.info(f"Using affinity queue {self.queue_url}")
+
+    def register(self, jobid):
+        with self.lock:
+            self.jobs.add(jobid)
+        self.put_item(f"{REGISTRY_PREFIX}{jobid}")
+
+    # Called when the job is evicted from the cache. The entry is only deleted while it names this worker's queue,
+    # another worker may have registered the job since.
+    def unregister(self, jobid):
+        with self.lock:
+            self.jobs.discard(jobid)
+        try:
+            self.dynamo.delete_item(
+                TableName=self.config.batch_table,
+                Key={'jobid': {'S': f"{REGISTRY_PREFIX}{jobid}"}},
+                ConditionExpression='#queue = :queue',
+                ExpressionAttributeNames={'#queue': 'queue'},
+                ExpressionAttributeValues={':queue': {'S': self.queue_url}},
+            )
+        except self.dynamo.exceptions.ConditionalCheckFailedException:
+            pass
+        except Exception:
+            logging.exception(f"Could not delete the affinity entry of job {jobid}")
+
+    def put_item(self, key):
+        self.dynamo.put_item(
+            TableName=self.config.batch_table,
+            Item={
+                'jobid': {'S': key},
+                'queue': {'S': self.queue_url},
+                'expires': {'N': str(int(time.time()) + REGISTRY_TTL)},
+            },
+        )
+
+    # Called by the heartbeat so this worker's liveness item and the entries of the jobs it still caches stay valid
+    def refresh(self):
+        with self.lock:
+            keys = [f"{WORKER_PREFIX}{self.queue_url}"] + [f"{REGISTRY_PREFIX}{jobid}" for jobid in self.jobs]
+        for key in keys:
+            try:
+                self.put_item(key)
+            except Exception:
+                logging.exception(f"Could not refresh the affinity item {key}")
+
+    def get_item(self, key) -> Optional[dict]:
+        return self.dynamo.get_item(TableName=self.config.batch_table, Key={'jobid': {'S': key}}).get('Item')
+
+    # Queue of the live worker that caches the job, None if there is none or it is this worker
+    def owner(self, jobid) -> Optional[str]:
+        item = self.get_item(f"{REGISTRY_PREFIX}{jobid}")
+        if item is None or item['queue']['S'] == self.queue_url:
+            return None
+        queue_url = item['queue']['S']
+        worker = self.get_item(f"{WORKER_PREFIX}{queue_url}")
+        if worker is None or int(worker['expires']['N']) < time.time():
+            self.reclaim(queue_url)
+            if worker is not None:
+                self.delete_expired(worker)
+            self.delete_expired(item)
+            return None
+        # The owner is alive but no longer refreshes the job (the entry outlived a failed delete)
+        if int(item['expires']['N']) < time.time():
+            self.delete_expired(item)
+            return None
+        return queue_url
+
+    # Called by the heartbeat: every SWEEP_SECONDS, reclaims the queues of the workers whose liveness item expired
+    # and deletes the expired items
+    def sweep(self):
+        now = time.time()
+        if now < self.swept_at + SWEEP_SECONDS:
+            return
+        self.swept_at = now
+        try:
+            items = self.expired_items(now)
+        except Exception:
+            logging.exception("Could not read the expired affinity entries")
+            return
+        workers = [item for item in items if item['jobid']['S'].startswith(WORKER_PREFIX)]
+        for queue_url in {item['queue']['S'] for item in workers} - {self.queue_url}:
+            logging.info(f"Reclaiming the expired affinity queue {queue_url}")
+            self.reclaim(queue_url)
+        for item in items:
+            if item['queue']['S'] != self.queue_url:
+                self.delete_expired(item)
+
+    def expired_items(self, now):
+        items = []
+        for page in self.dynamo.get_paginator('scan').paginate(
+                TableName=self.config.batch_table,
+                FilterExpression='(begins_with(jobid, :prefix) OR begins_with(jobid, :worker)) AND expires < :now',
+                ExpressionAttributeValues={
+                    ':prefix': {'S': REGISTRY_PREFIX},
+                    ':worker': {'S': WORKER_PREFIX},
+                    ':now': {'N': str(int(now))},
+                }):
+            items.extend(page.get('Items', []))
+        return items
+
+    # Deletes an expired item, unless its worker refreshed it in the meantime
+    def delete_expired(self, item):
+        try:
+            self.dynamo.delete_item(
+                TableName=self.config.batch_table,
+                Key={'jobid': item['jobid']},
+                ConditionExpression='expires = :expires',
+                ExpressionAttributeValues={':expires': item['expires']},
+            )
+        except self.dynamo.exceptions.ConditionalCheckFailedException:
+            pass
+        except Exception:
+            logging.exception(f"Could not delete the affinity entry {item['jobid']['S']}")
+
+    def forward(self, message, queue_url):
+        attributes = message.get('MessageAttributes', {})
+        attributes['forwarded'] = {'DataType': 'String', 'StringValue': 'true'}
+        self.sqs.send_message(QueueUrl=queue_url, MessageBody=message['Body'], MessageAttributes=attributes)
+
+    # Moves the messages of another worker's (stale) queue back to the shared task queue and deletes the queue
+    def reclaim(self, queue_url):
+        try:
+            self.drain(queue_url)
+            self.sqs.delete_queue(QueueUrl=queue_url)
+        except self.sqs.exceptions.QueueDoesNotExist:
+            pass
+        except Exception:
+            logging.exception(f"Could not reclaim affinity queue {queue_url}")
+
+    def drain(self, queue_url):
+        while True:
+            messages = self.sqs.receive_message(
+                QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=0,
+                MessageAttributeNames=['All']).get('Messages', [])
+            if not messages:
+                return
+            for message in messages:
+                attributes = message.get('MessageAttributes', {})
+                attributes.pop('forwarded', None)
+                kwargs = {'MessageAttributes': attributes} if attributes else {}
+                self.sqs.send_message(QueueUrl=self.config.task_queue, MessageBody=message['Body'], **kwargs)
+                self.sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+    # Hands the queued messages of this worker back to the shared queue when the worker stops, and deletes its
+    # liveness item and entries so other workers stop forwarding to it
+    def close(self):
+        if self.queue_url is None:
+            return
+        with self.lock:
+            jobs = list(self.jobs)
+        for jobid in jobs:
+            self.unregister(jobid)
+        try:
+            self.dynamo.delete_item(
+                TableName=self.config.batch_table, Key={'jobid': {'S': f"{WORKER_PREFIX}{self.queue_url}"}})
+        except Exception:
+            logging.exception("Could not delete the affinity liveness item")
+        self.reclaim(self.queue_url)
@@ -0,0 +1,130 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from typing import Dict, Optional, Set
+
+
+# Raised when the integrals process of a task was stopped because its job was deleted
+class JobDeleted(Exception):
+    pass
+
+
+# Set of deleted (aborted) jobs, read with one scan of the deleted jobs table every refresh_seconds instead of a
+# query per message. The integrals processes started for a job are registered while they run and are killed as
+# soon as a refresh finds that the job was deleted. While the set could not be refreshed for a few periods, jobs
+# are looked up in the table directly as before.
+class DeletedJobs(threading.Thread):
+    def __init__(self, dynamo, table, refresh_seconds=5.0, kill_grace_seconds=2.0):
+        super().__init__(name='deleted-jobs', daemon=True)
+        self.dynamo = dynamo
+        self.table = table
+        self.refresh_seconds = refresh_seconds
+        self.kill_grace_seconds = kill_grace_seconds
+        self.lock = threading.Lock()
+        self.jobs: Set[str] = set()
+        self.refreshed_at: Optional[float] = None
+        # jobid -> integrals processes running for the job
+        self.processes: Dict[str, Set[subprocess.Popen]] = {}
+        # Deleted jobs whose failure was already reported to the state machine by this worker
+        self.reported: Set[str] = set()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self.refresh()
+            if self.stopped.wait(self.refresh_seconds):
+                return
+
+    def scan(self) -> Set[str]:
+        jobs = set()
+        for page in self.dynamo.get_paginator('scan').paginate(TableName=self.table, ProjectionExpression='jobid'):
+            jobs.update(item['jobid']['S'] for item in page.get('Items', []))
+        return jobs
+
+    def refresh(self):
+        try:
+            jobs = self.scan()
+        except Exception:
+            logging.exception("Could not read the deleted jobs")
+            return
+        with self.lock:
+            new = jobs - self.jobs
+            self.jobs = jobs
+            self.refreshed_at = time.monotonic()
+            # Resumed jobs are removed from the table, their failure can be reported again if they are aborted again
+            self.reported &= jobs
+            processes = [process for jobid in new for process in self.processes.get(jobid, ())]
+        for process in processes:
+            self.kill(process)
+
+    def is_fresh(self) -> bool:
+        return self.refreshed_at is not None and time.monotonic() - self.refreshed_at < 3 * self.refresh_seconds
+
+    # Whether the job was deleted according to the cached set, without a request while it is fresh
+    def cached(self, jobid) -> Optional[bool]:
+        with self.lock:
+            return jobid in self.jobs if self.is_fresh() else None
+
+    def contains(self, jobid) -> bool:
+        cached = self.cached(jobid)
+        if cached is not None:
+            return cached
+        response = self.dynamo.query(
+            TableName=self.table,
+            KeyConditionExpression='jobid = :id',
+            ExpressionAttributeValues={':id': {'S': jobid}},
+            Select='COUNT',
+        )
+        return response['Count'] != 0
+
+    # Returns True only the first time it is called for a job, so the failure of a deleted job with many queued
+    # slices is reported once per worker
+    def report(self, jobid) -> bool:
+        with self.lock:
+            if jobid in self.reported:
+                return False
+            self.reported.add(jobid)
+            return True
+
+    # Whether the messages of a job can be deleted without running them: the job is deleted according to the
+    # cached set and this worker already reported its failure
+    def droppable(self, jobid) -> bool:
+        with self.lock:
+            return self.is_fresh() and jobid in self.jobs and jobid in self.reported
+
+    def register(self, jobid, process: subprocess.Popen):
+        with self.lock:
+            self.processes.setdefault(jobid, set()).add(process)
+            deleted = jobid in self.jobs
+        if deleted:
+            self.kill(process)
+
+    def unregister(self, jobid, process: subprocess.Popen):
+        with self.lock:
+            processes = self.processes.get(jobid, set())
+            processes.discard(process)
+            if not processes:
+                self.processes.pop(jobid, None)
+
+    # Stops a process with SIGTERM, then SIGKILL if it is still running after the grace period. The process is
+    # reaped by the slot thread waiting for it (see run_measured), so it is only signalled until then.
+    def kill(self, process: subprocess.Popen):
+        logging.info(f"Stopping integrals process {process.pid} of a deleted job")
+        send_signal(process, signal.SIGTERM)
+        timer = threading.Timer(self.kill_grace_seconds, send_signal, (process, signal.SIGKILL))
+        timer.daemon = True
+        timer.start()
+
+    def close(self):
+        self.stopped.set()
+
+
+def send_signal(process: subprocess.Popen, signum):
+    if process.returncode is None:
+        try:
+            os.kill(process.pid, signum)
+        except OSError:
+            pass
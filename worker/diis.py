@@ -0,0 +1,225 @@
+import json
+import logging
+import math
+import os
+import shutil
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+from shared.scf import diis_error_key, diis_fock_key, diis_history_key
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of iterations whose Fock matrices are combined
+DIIS_HISTORY = 6
+# Largest condition number of the DIIS equations, the oldest iterations are dropped until it is smaller
+MAX_CONDITION = 1e12
+
+
+class DiisError(Exception):
+    pass
+
+
+# Reads a .bin matrix (n * n doubles)
+def read_matrix(path):
+    data = numpy.fromfile(path, dtype='<f8')
+    n = math.isqrt(data.size)
+    if n == 0 or n * n != data.size:
+        raise DiisError(f"{os.path.basename(path)} is not a square matrix ({data.size} values)")
+    return data.reshape(n, n)
+
+
+def write_matrix(path, matrix):
+    numpy.ascontiguousarray(matrix, dtype='<f8').tofile(path)
+
+
+# S^-1/2, the error matrices are expressed in the orthonormal basis so their norm does not depend on the overlap
+def orthogonalizer(overlap):
+    try:
+        values, vectors = numpy.linalg.eigh(overlap)
+    except numpy.linalg.LinAlgError as e:
+        raise DiisError(f"The overlap matrix can not be diagonalized: {e}")
+    if values[0] <= 1e-12 * values[-1]:
+        raise DiisError("The overlap matrix is singular")
+    return (vectors / numpy.sqrt(values)) @ vectors.T
+
+
+# Error matrix of a Fock matrix built from density: the commutator FDS - SDF, zero at self-consistency
+def error_matrix(fock, density, overlap, orthogonal):
+    commutator = fock @ density @ overlap - overlap @ density @ fock
+    return orthogonal.T @ commutator @ orthogonal
+
+
+def rms(error) -> float:
+    return float(numpy.sqrt(numpy.mean(error ** 2)))
+
+
+# Pulay's DIIS: the iterations kept (by loop index) and the inner products of their error matrices, stored as the
+# job's DIIS history between the tasks of the loop
+class DiisHistory:
+    def __init__(self, iterations: Optional[List[int]] = None, products: Optional[List[List[float]]] = None,
+                 size=DIIS_HISTORY):
+        self.iterations = iterations or []
+        self.products = products or []
+        self.size = size
+
+    @classmethod
+    def from_dict(cls, data, size=DIIS_HISTORY):
+        return cls(data['iterations'], data['products'], size)
+
+    def to_dict(self) -> dict:
+        return {'iterations': self.iterations, 'products': self.products}
+
+    # Adds the error matrix of iteration index. Iterations from index on (a redelivered task, or a resumed job) are
+    # replaced and the oldest iterations beyond the history size are dropped. errors(i) returns the error matrix of
+    # a kept iteration. Returns the iterations that are no longer in the history, never index itself (its error
+    # matrix is the one just added).
+    def add(self, index, error, errors: Callable[[int], object]) -> List[int]:
+        previous = self.iterations
+        keep = [k for k, i in enumerate(previous) if i < index][-(self.size - 1):] if self.size > 1 else []
+        row = [float(numpy.vdot(error, errors(previous[k]))) for k in keep]
+        self.products = [[self.products[k][j] for j in keep] + [row[n]] for n, k in enumerate(keep)]
+        self.products.append(row + [float(numpy.vdot(error, error))])
+        self.iterations = [previous[k] for k in keep] + [index]
+        return [i for i in previous if i not in self.iterations]
+
+    # Coefficients of the kept iterations (the oldest ones get 0 when the equations are ill-conditioned or
+    # singular, e.g. with collinear or zero error matrices)
+    def coefficients(self):
+        products = numpy.array(self.products)
+        for start in range(len(self.iterations)):
+            m = len(self.iterations) - start
+            if m == 1:
+                break
+            block = products[start:, start:]
+            scale = numpy.max(numpy.diag(block))
+            if not numpy.isfinite(scale) or scale <= 0.0:
+                continue
+            b = -numpy.ones((m + 1, m + 1))
+            b[m, m] = 0.0
+            # Scaled so the condition number reflects the errors' directions rather than their size
+            b[:m, :m] = block / scale
+            rhs = numpy.zeros(m + 1)
+            rhs[m] = -1.0
+            try:
+                if numpy.linalg.cond(b) < MAX_CONDITION:
+                    return numpy.concatenate([numpy.zeros(start), numpy.linalg.solve(b, rhs)[:m]])
+            except numpy.linalg.LinAlgError:
+                pass
+        return numpy.eye(len(self.iterations))[-1]
+
+    # Extrapolated Fock matrix, focks(i) returns the Fock matrix of a kept iteration
+    def extrapolate(self, focks: Callable[[int], object]):
+        return sum(c * focks(i) for c, i in zip(self.coefficients(), self.iterations) if c != 0.0)
+
+
+# DIIS stage of the Fock-SCF loop. After the fock_matrix step of an iteration, computes its error matrix from the
+# Fock matrix, the density it was built from and the overlap, and writes the extrapolated Fock matrix that the
+# iteration's scf_step reads (diis_fock_key). The history is kept in the job's prefix: the error matrix of every
+# kept iteration and the history record (diis_history_key). Matrices already read are kept by the instance, so the
+# fused loop reads every matrix once. With persist False (the fused loop) nothing is written to the bucket.
+class DiisStage:
+    def __init__(self, worker, bucket, jobid, directory, overlap_path, persist=True):
+        self.worker = worker
+        self.bucket = bucket
+        self.jobid = jobid
+        self.directory = directory
+        self.persist = persist
+        if numpy is None:
+            raise DiisError("DIIS needs the numpy module")
+        self.overlap = read_matrix(overlap_path)
+        self.orthogonal = orthogonalizer(self.overlap)
+        self.history = self.load_history() if persist else DiisHistory()
+        self.focks: Dict[int, object] = {}
+        self.errors: Dict[int, object] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def load_history(self) -> DiisHistory:
+        try:
+            obj = self.worker.s3.get_object(Bucket=self.bucket, Key=diis_history_key(self.jobid))
+        except self.worker.s3.exceptions.NoSuchKey:
+            return DiisHistory()
+        return DiisHistory.from_dict(json.loads(obj['Body'].read()))
+
+    def download(self, key):
+        path = os.path.join(self.directory, os.path.basename(key))
+        self.worker.download_bin(self.bucket, key, path)
+        return read_matrix(path)
+
+    def fock(self, index):
+        if index not in self.focks:
+            self.focks[index] = self.download(
+                f"job_files/{self.jobid}/bin_files/{self.jobid}_fock_matrix_{index}.bin")
+        return self.focks[index]
+
+    def error(self, index):
+        if index not in self.errors:
+            self.errors[index] = self.download(diis_error_key(self.jobid, index))
+        return self.errors[index]
+
+    # Runs the stage for iteration index and writes the extrapolated Fock matrix to output_path. Returns the RMS of
+    # the iteration's error matrix.
+    def step(self, index, fock_path, density_path, output_path) -> float:
+        fock = read_matrix(fock_path)
+        density = read_matrix(density_path)
+        if fock.shape != self.overlap.shape or density.shape != self.overlap.shape:
+            raise DiisError(f"The matrices of iteration {index} do not have the size of the overlap matrix")
+        error = error_matrix(fock, density, self.overlap, self.orthogonal)
+        self.focks[index] = fock
+        self.errors[index] = error
+        if self.persist:
+            error_path = os.path.join(self.directory, f"diis_error_{index}.bin")
+            write_matrix(error_path, error)
+            self.worker.upload_bin(error_path, self.bucket, diis_error_key(self.jobid, index))
+        try:
+            dropped = self.history.add(index, error, self.error)
+        except self.worker.s3.exceptions.NoSuchKey:
+            # The matrices of the earlier iterations are gone (the fused loop does not keep them), start over. The
+            # error matrices that are left of the old history are deleted with it.
+            logging.warning(f"DIIS history of job {self.jobid} is incomplete, starting a new one")
+            dropped = [i for i in self.history.iterations if i != index]
+            self.history = DiisHistory(size=self.history.size)
+            self.history.add(index, error, self.error)
+        try:
+            extrapolated = self.history.extrapolate(self.fock)
+        except numpy.linalg.LinAlgError as e:
+            raise DiisError(f"The DIIS equations of iteration {index} can not be solved: {e}")
+        write_matrix(output_path, extrapolated)
+        for i in dropped:
+            self.focks.pop(i, None)
+            self.errors.pop(i, None)
+        if self.persist:
+            self.worker.upload_bin(output_path, self.bucket, diis_fock_key(self.jobid, index))
+            self.worker.s3.put_object(
+                Bucket=self.bucket, Key=diis_history_key(self.jobid),
+                Body=json.dumps(self.history.to_dict()).encode())
+            if dropped:
+                self.worker.s3.delete_objects(Bucket=self.bucket, Delete={
+                    'Objects': [{'Key': diis_error_key(self.jobid, i)} for i in dropped]})
+        return rms(error)
+
+
+# DIIS stage of the fock_matrix task of iteration index in the state machine loop, fock_key is the task's output and
+# density_url its input density. Returns the RMS of the iteration's error matrix, or None when the matrices cannot
+# be extrapolated: the scf_step then reads the Fock matrix as it was built.
+def run_diis_step(worker, bucket, jobid, index, fock_key, density_url, slot_dir) -> Optional[float]:
+    directory = os.path.join(slot_dir, 'diis')
+    try:
+        fock_path = os.path.join(directory, 'fock.bin')
+        density_path = os.path.join(directory, 'density.bin')
+        overlap_path = os.path.join(directory, 'overlap.bin')
+        worker.download_bin(bucket, fock_key, fock_path)
+        density = urlparse(density_url, allow_fragments=False)
+        worker.download_bin(density.netloc, density.path.lstrip('/'), density_path)
+        worker.download_bin(bucket, f"job_files/{jobid}/bin_files/{jobid}_overlap.bin", overlap_path)
+        stage = DiisStage(worker, bucket, jobid, directory, overlap_path)
+        return stage.step(index, fock_path, density_path, os.path.join(directory, 'extrapolated.bin'))
+    except DiisError as e:
+        logging.warning(f"No DIIS extrapolation for iteration {index} of job {jobid}: {e}")
+        worker.s3.copy({'Bucket': bucket, 'Key': fock_key}, bucket, diis_fock_key(jobid, index))
+        return None
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
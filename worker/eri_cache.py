@@ -0,0 +1,145 @@
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from worker.prefetch import PrefetchStats, ShardPrefetcher
+
+
+# Counts reported in the JSON output of a task that used the cache
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    bytes_downloaded: int = 0
+    bytes_saved: int = 0
+    # Counts of the download of the missing shards, reported separately as eri_prefetch
+    prefetch: Optional[PrefetchStats] = None
+
+    def to_dict(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_downloaded': self.bytes_downloaded,
+            'bytes_saved': self.bytes_saved,
+        }
+
+
+# Size-bounded local cache of the two_electrons_integrals shards ({jobid}_*.bin objects) of recent jobs.
+# Shards are kept per job and whole jobs are evicted in least recently used order. Jobs that a running task
+# uses are never evicted, and shards being downloaded count towards max_bytes.
+class EriCache:
+    def __init__(self, s3, root, max_bytes, prefetcher: Optional[ShardPrefetcher] = None, on_evict=None):
+        self.s3 = s3
+        self.on_evict = on_evict
+        self.root = root
+        self.max_bytes = max_bytes
+        self.prefetcher = prefetcher or ShardPrefetcher(s3)
+        self.lock = threading.Lock()
+        # jobid -> bytes on disk, least recently used first
+        self.jobs: 'OrderedDict[str, int]' = OrderedDict()
+        # jobid -> stored size of the shards being downloaded, counted towards max_bytes until the download ends
+        self.reserved: Dict[str, int] = {}
+        self.in_use: Dict[str, int] = {}
+        self.job_locks: Dict[str, threading.Lock] = {}
+        shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(root, exist_ok=True)
+
+    def job_dir(self, jobid) -> str:
+        return os.path.join(self.root, jobid)
+
+    def holds(self, jobid) -> bool:
+        with self.lock:
+            return jobid in self.jobs
+
+    def list_shards(self, bucket, jobid) -> List[dict]:
+        shards = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{jobid}_"):
+            shards.extend(page.get('Contents', []))
+        return shards
+
+    # Makes sure all shards of the job are on the local disk and marks the job as in use. jobid is the eri prefix
+    # of the job, which is a result_cache/... path when the shards come from the result cache. Returns the local
+    # eri prefix to pass to integrals (None when the job does not fit in the cache) and the cache counts.
+    def acquire(self, bucket, jobid, shards: Optional[List[dict]] = None):
+        stats = CacheStats()
+        with self.lock:
+            job_lock = self.job_locks.setdefault(jobid, threading.Lock())
+            self.in_use[jobid] = self.in_use.get(jobid, 0) + 1
+        with job_lock:
+            shards = shards if shards is not None else self.list_shards(bucket, jobid)
+            size = sum(shard['Size'] for shard in shards)
+            if size > self.max_bytes:
+                logging.info(f"ERI shards of job {jobid} ({size} bytes) do not fit in the cache")
+                self.release(jobid)
+                return None, stats
+            if not self.reserve(jobid, size):
+                logging.info(f"ERI shards of job {jobid} ({size} bytes) do not fit next to the jobs in use")
+                self.release(jobid)
+                return None, stats
+            try:
+                os.makedirs(self.job_dir(jobid), exist_ok=True)
+                missing = []
+                for shard in shards:
+                    # Shards are decompressed on download, a file only exists once its download completed
+                    if os.path.exists(self.shard_path(jobid, shard['Key'])):
+                        stats.hits += 1
+                        stats.bytes_saved += shard['Size']
+                    else:
+                        missing.append(shard)
+                if missing:
+                    stats.prefetch = self.prefetcher.fetch(bucket, missing, self.job_dir(jobid))
+                    stats.misses = len(missing)
+                    stats.bytes_downloaded = stats.prefetch.bytes
+                # The size reserved is the stored (possibly compressed) size, the cache holds the decoded shards
+                on_disk = sum(os.path.getsize(self.shard_path(jobid, shard['Key'])) for shard in shards)
+            except BaseException:
+                with self.lock:
+                    self.reserved.pop(jobid, None)
+                self.release(jobid)
+                raise
+            with self.lock:
+                self.reserved.pop(jobid, None)
+                self.jobs[jobid] = on_disk
+                self.jobs.move_to_end(jobid)
+        return f"file://{os.path.join(self.job_dir(jobid), os.path.basename(jobid))}", stats
+
+    def shard_path(self, jobid, key) -> str:
+        return os.path.join(self.job_dir(jobid), os.path.basename(key))
+
+    def release(self, jobid):
+        with self.lock:
+            self.in_use[jobid] -= 1
+            if self.in_use[jobid] == 0:
+                del self.in_use[jobid]
+
+    # Reserves size bytes for the shards of a job before they are downloaded, so that concurrent downloads count
+    # towards max_bytes. Least recently used jobs that are not in use are evicted to make room. Returns False, and
+    # evicts nothing, when the jobs in use and the other downloads leave no room.
+    def reserve(self, jobid, size) -> bool:
+        evicted = []
+        with self.lock:
+            used = sum(self.jobs.values()) + sum(self.reserved.values()) - self.jobs.get(jobid, 0)
+            for other in self.jobs:
+                if used + size <= self.max_bytes:
+                    break
+                if other != jobid and other not in self.in_use:
+                    used -= self.jobs[other]
+                    evicted.append(other)
+            if used + size > self.max_bytes:
+                return False
+            for other in evicted:
+                del self.jobs[other]
+                self.job_locks.pop(other, None)
+                shutil.rmtree(self.job_dir(other), ignore_errors=True)
+            self.reserved[jobid] = size
+        # on_evict may make requests (see AffinityRouter.unregister), other tasks do not wait for them
+        for other in evicted:
+            logging.info(f"Evicted ERI shards of job {other} from the cache")
+            if self.on_evict:
+                self.on_evict(other)
+        return True
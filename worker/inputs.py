@@ -0,0 +1,96 @@
+import hashlib
+import logging
+import os
+import threading
+import urllib.request
+from urllib.parse import urlparse
+
+from shared.manifest import staged_xyz_key
+
+
+class InvalidInput(Exception):
+    pass
+
+
+# Checks that text is an xyz file: an atom count, a comment line and one "symbol x y z" line per atom
+def validate_xyz(text):
+    lines = text.strip().splitlines()
+    try:
+        count = int(lines[0].strip())
+    except (IndexError, ValueError):
+        raise InvalidInput("the first line of the xyz file is not an atom count")
+    atoms = lines[2:2 + count]
+    if count < 1 or len(atoms) != count:
+        raise InvalidInput(f"the xyz file declares {lines[0].strip()} atoms but lists {len(atoms)}")
+    for line in atoms:
+        fields = line.split()
+        try:
+            if len(fields) < 4 or not fields[0].isalpha():
+                raise ValueError
+            [float(field) for field in fields[1:4]]
+        except ValueError:
+            raise InvalidInput(f"invalid atom line in the xyz file: {line.strip()}")
+
+
+# Input files staged in S3 by the info step, kept on the local disk so that only the first task of a job on a
+# worker downloads them. Staged objects are never modified, so a cached file is always current.
+class InputCache:
+    def __init__(self, s3, root, max_files=1024):
+        self.s3 = s3
+        self.root = root
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    # Fetches the xyz file at url, checks it and stores it in the job's S3 prefix. Returns the S3 URL of the staged
+    # copy and the sha256 of its contents.
+    def stage(self, bucket, jobid, url):
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        try:
+            validate_xyz(data.decode())
+        except UnicodeDecodeError:
+            raise InvalidInput("the xyz file is not text")
+        digest = hashlib.sha256(data).hexdigest()
+        key = staged_xyz_key(jobid)
+        self.s3.put_object(Bucket=bucket, Key=key, Body=data, Metadata={'sha256': digest, 'source': url})
+        staged = f"s3://{bucket}/{key}"
+        self.write(self.local_path(staged), data)
+        return staged, digest
+
+    def local_path(self, url) -> str:
+        return os.path.join(self.root, hashlib.sha1(url.encode()).hexdigest() + os.path.splitext(url)[1])
+
+    # Returns a file:// URL for a staged s3:// input, downloading it on first use. Other URLs are returned as is.
+    def localize(self, url) -> str:
+        if not url.startswith('s3://'):
+            return url
+        path = self.local_path(url)
+        if not os.path.exists(path):
+            parsed = urlparse(url, allow_fragments=False)
+            obj = self.s3.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip('/'))
+            self.write(path, obj['Body'].read())
+        else:
+            os.utime(path)
+        return f"file://{path}"
+
+    # Writes through a temporary file so that concurrent tasks never read a partial file
+    def write(self, path, data):
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        self.evict()
+
+    # Drops the least recently used files once there are more than max_files
+    def evict(self):
+        with self.lock:
+            names = [name for name in os.listdir(self.root) if not name.endswith('.tmp')]
+            if len(names) <= self.max_files:
+                return
+            paths = sorted((os.path.join(self.root, name) for name in names), key=os.path.getmtime)
+            for path in paths[:len(paths) - self.max_files]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    logging.exception(f"Could not remove {path} from the input cache")
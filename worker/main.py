@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import urllib.request
+from typing import Optional, Tuple
+
+from shared import binfile
+
+from worker.worker import Worker, WorkerConfig
+
+
+# Reads the task metadata from the ECS task metadata endpoint (None when not running on ECS)
+def get_task_metadata() -> Optional[dict]:
+    metadata_uri = os.environ.get('ECS_CONTAINER_METADATA_URI_V4')
+    if not metadata_uri:
+        return None
+    try:
+        with urllib.request.urlopen(f"{metadata_uri}/task", timeout=2) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        logging.exception("Could not read the ECS task metadata")
+        return None
+
+
+# Returns the (vCPUs, memory in MiB) available to this task, falling back to the host's resources
+def get_task_resources(metadata: Optional[dict]) -> Tuple[float, int]:
+    limits = (metadata or {}).get('Limits', {})
+    # Fargate and task-level limits are reported in vCPUs and MiB
+    cpus = float(limits['CPU']) if limits.get('CPU') else float(os.cpu_count() or 1)
+    if limits.get('Memory'):
+        memory = int(limits['Memory'])
+    else:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    return cpus, memory
+
+
+# Number of concurrent integrals executions, WORKER_SLOTS overrides the value derived from the task size
+def get_slot_count(cpus: float, memory: int) -> int:
+    if os.environ.get('WORKER_SLOTS'):
+        return max(1, int(os.environ['WORKER_SLOTS']))
+    cpus_per_slot = float(os.environ.get('WORKER_SLOT_VCPUS', 1))
+    memory_per_slot = int(os.environ.get('WORKER_SLOT_MEMORY_MIB', 4096))
+    return max(1, min(int(cpus // cpus_per_slot), memory // memory_per_slot))
+
+
+# Codec of uploaded .bin objects, BIN_CODEC=none uploads them uncompressed
+def get_bin_codec() -> Optional[str]:
+    codec = os.environ.get('BIN_CODEC', binfile.default_codec())
+    return None if codec == 'none' else codec
+
+
+# Subcommands whose outputs the worker uploads (OUTPUT_URL_COMMANDS, comma separated), see INTEGRALS.md
+def get_output_url_commands() -> Tuple[str, ...]:
+    return tuple(command for command in os.environ.get('OUTPUT_URL_COMMANDS', '').split(',') if command)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'ca-central-1')
+    metadata = get_task_metadata()
+    cpus, memory = get_task_resources(metadata)
+    config = WorkerConfig(
+        task_queue=os.environ['TASK_QUEUE'],
+        batch_table=os.environ['BATCH_TABLE'],
+        deleted_job_table=os.environ['DELETED_JOB_TABLE'],
+        cluster=os.environ.get('ECS_CLUSTER', 'Integrals-CDK-Cluster'),
+        task_arn=metadata['TaskARN'] if metadata else None,
+        integrals_path=os.environ.get('INTEGRALS_PATH', '/integrals/integrals'),
+        work_dir=os.environ.get('WORKER_DIR', '/tmp/integrals'),
+        slots=get_slot_count(cpus, memory),
+        eri_cache_bytes=int(os.environ.get('ERI_CACHE_MIB', 8192)) * 1024 * 1024,
+        affinity=os.environ.get('WORKER_AFFINITY', 'true') == 'true',
+        bin_codec=get_bin_codec(),
+        output_url_commands=get_output_url_commands(),
+        deleted_jobs_refresh_seconds=float(os.environ.get('DELETED_JOBS_REFRESH_SECONDS', 5)),
+        priority_slots=int(os.environ.get('WORKER_PRIORITY_SLOTS', 0)),
+        concurrent_steps=os.environ.get('WORKER_CONCURRENT_STEPS', 'true') == 'true',
+    )
+    logging.info(f"Starting worker with {config.slots} slots ({cpus} vCPUs, {memory} MiB)")
+    Worker(config).run()
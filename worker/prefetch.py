@@ -0,0 +1,120 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List
+
+from shared import binfile
+
+
+# Counts of one prefetch, reported in the task's JSON output under eri_prefetch. stall_seconds is the time the
+# shards were written waiting for data that had not arrived yet.
+@dataclass
+class PrefetchStats:
+    shards: int = 0
+    bytes: int = 0
+    requests: int = 0
+    seconds: float = 0.0
+    stall_seconds: float = 0.0
+
+    def add(self, other: 'PrefetchStats'):
+        self.shards += other.shards
+        self.bytes += other.bytes
+        self.requests += other.requests
+        self.seconds += other.seconds
+        self.stall_seconds += other.stall_seconds
+
+    def to_dict(self) -> dict:
+        return {
+            'shards': self.shards,
+            'bytes': self.bytes,
+            'requests': self.requests,
+            'seconds': round(self.seconds, 3),
+            'stall_seconds': round(self.stall_seconds, 3),
+            'mib_per_s': round(self.bytes / 1024 ** 2 / self.seconds, 1) if self.seconds else None,
+        }
+
+
+# Downloads ERI shards with concurrent ranged GETs. Every shard is split into ranges of chunk_bytes, the ranges of
+# all shards are requested in order by a pool of threads and the calling thread decodes and writes the shards in
+# the same order while later ranges are still downloading. At most buffer_bytes of ranges are requested but not
+# yet written at any time.
+class ShardPrefetcher:
+    def __init__(self, s3, threads=16, chunk_bytes=8 * 1024 * 1024, buffer_bytes=256 * 1024 * 1024):
+        self.s3 = s3
+        self.threads = threads
+        self.chunk_bytes = chunk_bytes
+        self.buffer_bytes = buffer_bytes
+
+    def get_range(self, bucket, key, start, size) -> bytes:
+        response = self.s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{start + size - 1}")
+        return response['Body'].read()
+
+    # Downloads the shards ({'Key', 'Size'} with their stored size) to directory, named after their keys
+    def fetch(self, bucket, shards: List[dict], directory) -> PrefetchStats:
+        stats = PrefetchStats(shards=len(shards))
+        start_time = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        ranges = [
+            (shard['Key'], start, min(self.chunk_bytes, shard['Size'] - start))
+            for shard in shards for start in range(0, shard['Size'], self.chunk_bytes)
+        ]
+        slots = threading.Semaphore(max(1, self.buffer_bytes // self.chunk_bytes))
+        stopped = threading.Event()
+        futures: 'queue.Queue' = queue.Queue()
+
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='prefetch') as executor:
+            # Requests the ranges in order, each once a buffer slot is free
+            def feed():
+                for key, start, size in ranges:
+                    slots.acquire()
+                    if stopped.is_set():
+                        return
+                    try:
+                        futures.put(executor.submit(self.get_range, bucket, key, start, size))
+                    except RuntimeError:
+                        # The executor was shut down after a failure
+                        return
+
+            feeder = threading.Thread(target=feed, name='prefetch-feeder', daemon=True)
+            feeder.start()
+
+            def next_range() -> bytes:
+                waited = time.monotonic()
+                data = futures.get().result()
+                stats.stall_seconds += time.monotonic() - waited
+                slots.release()
+                stats.bytes += len(data)
+                stats.requests += 1
+                return data
+
+            try:
+                for shard in shards:
+                    self.write_shard(shard, next_range, os.path.join(directory, os.path.basename(shard['Key'])))
+            finally:
+                stopped.set()
+                slots.release()
+                executor.shutdown(wait=True, cancel_futures=True)
+                feeder.join()
+        stats.seconds = time.monotonic() - start_time
+        return stats
+
+    # Decodes the ranges of one shard into path as they arrive
+    def write_shard(self, shard, next_range, path):
+        ranges = -(-shard['Size'] // self.chunk_bytes)
+        buffer = b''
+
+        def read(size) -> bytes:
+            nonlocal ranges, buffer
+            if not buffer and ranges > 0:
+                buffer = next_range()
+                ranges -= 1
+            data, buffer = buffer[:size], buffer[size:]
+            return data
+
+        binfile.decode_to_file(read, path)
+        # Ranges the decoder did not need (e.g. trailing bytes) still have to be taken off the queue
+        for _ in range(ranges):
+            next_range()
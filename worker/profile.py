@@ -0,0 +1,148 @@
+import itertools
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from worker.prefetch import PrefetchStats
+
+
+# Timings and resource use of one task. sent/received/start/end are epoch seconds, the phases are durations:
+# compute is the time spent in integrals processes, upload the time spent uploading outputs and signal the time
+# spent reporting to the state machine and the completion tracker. Everything else between start and end is
+# fetching inputs and setting up the task.
+@dataclass
+class TaskProfile:
+    sent: float
+    received: float
+    start: float
+    end: float = 0.0
+    jobid: Optional[str] = None
+    bucket: Optional[str] = None
+    step: Optional[str] = None
+    index: Optional[int] = None
+    # Steps run by the task (see Worker.handle_steps), index is the first one's
+    tasks: int = 1
+    status: str = 'error'
+    compute: float = 0.0
+    upload: float = 0.0
+    signal: float = 0.0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_rss_kb: int = 0
+    # ERI shard downloads of the task (fetch time includes them)
+    prefetch: Optional[PrefetchStats] = None
+
+    # Step, index (ERI slice or loop iteration) and job of the task input
+    def describe(self, value):
+        self.jobid = value['jobid']
+        self.bucket = urlparse(value['s3_bucket_path']).netloc
+        self.step = value['commands'][0]
+        if 'slice' in value:
+            self.index = value['slice']
+        elif value.get('loopData') and self.step in ('fock_matrix', 'scf_step'):
+            self.index = int(value['loopData']['loopCount']) - 1
+
+    def record(self, worker_id) -> dict:
+        return {
+            'step': self.step,
+            'index': self.index,
+            'tasks': self.tasks,
+            'status': self.status,
+            'worker': worker_id,
+            'sent': round(self.sent, 3),
+            'received': round(self.received, 3),
+            'start': round(self.start, 3),
+            'end': round(self.end, 3),
+            'queue': round(self.received - self.sent, 3),
+            'fetch': round(max(0.0, self.end - self.start - self.compute - self.upload - self.signal), 3),
+            'compute': round(self.compute, 3),
+            'upload': round(self.upload, 3),
+            'signal': round(self.signal, 3),
+            'read': self.bytes_read,
+            'written': self.bytes_written,
+            'rss_kb': self.peak_rss_kb,
+            'stall': round(self.prefetch.stall_seconds, 3) if self.prefetch else 0.0,
+        }
+
+
+# Buffers task records and writes them to the job's prefix as JSON lines objects
+# (job_files/{jobid}/profile/{worker}_{recorder}_{n}.jsonl), so that a job with thousands of slices produces a few
+# objects. The recorder id keeps the keys of workers sharing a worker id (e.g. in one process) apart.
+class ProfileRecorder:
+    def __init__(self, s3, worker_id, max_records=100):
+        self.s3 = s3
+        self.worker_id = worker_id
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        # jobid -> (bucket, records)
+        self.buffers: Dict[str, Tuple[str, List[dict]]] = {}
+        self.sequence = itertools.count()
+        self.recorder_id = uuid.uuid4().hex[:8]
+
+    # Adds a task record, flush writes the job's records right away (single tasks and the last slice of a job)
+    def add(self, profile: TaskProfile, flush=False):
+        if profile.jobid is None:
+            return
+        with self.lock:
+            _, records = self.buffers.setdefault(profile.jobid, (profile.bucket, []))
+            records.append(profile.record(self.worker_id))
+            flush = flush or len(records) >= self.max_records
+        if flush:
+            self.flush(profile.jobid)
+
+    def flush(self, jobid):
+        with self.lock:
+            bucket, records = self.buffers.pop(jobid, (None, []))
+            key = f"job_files/{jobid}/profile/{self.worker_id}_{self.recorder_id}_{next(self.sequence):06d}.jsonl"
+        if not records:
+            return
+        try:
+            body = '\n'.join(json.dumps(record, separators=(',', ':')) for record in records)
+            self.s3.put_object(Bucket=bucket, Key=key, Body=body.encode())
+        except Exception:
+            logging.exception(f"Could not write the task profiles of job {jobid}")
+
+    def flush_all(self):
+        with self.lock:
+            jobids = list(self.buffers)
+        for jobid in jobids:
+            self.flush(jobid)
+
+
+# Adds the time spent in the block to the given phase of the profile (if any)
+@contextmanager
+def timed(profile: Optional[TaskProfile], phase):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            setattr(profile, phase, getattr(profile, phase) + time.monotonic() - start)
+
+
+# Runs a process and returns its exit code with the bytes it read and wrote and its peak RSS (KiB). The I/O counts
+# are read from /proc once the process has exited but before it is reaped, so they are only known on Linux.
+# on_start is called with the process once it started.
+def run_measured(args, cwd, stdout, on_start=None) -> Tuple[int, int, int, int]:
+    process = subprocess.Popen(args, cwd=cwd, stdout=stdout)
+    if on_start:
+        on_start(process)
+    read = written = 0
+    try:
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        with open(f"/proc/{process.pid}/io") as io:
+            counters = dict(line.split(': ') for line in io.read().splitlines())
+        read, written = int(counters['rchar']), int(counters['wchar'])
+    except (AttributeError, OSError, KeyError, ValueError):
+        pass
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, read, written, usage.ru_maxrss
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from shared import binfile
+from shared.scf import loop_continues, next_loop_data
+
+from worker.diis import DiisError, DiisStage
+
+
+class LoopFailed(Exception):
+    pass
+
+
+# Takes the list of "commands" as input and returns the value that follows flag
+def get_arg(cmds, flag):
+    for i in range(len(cmds)):
+        if cmds[i] == flag:
+            return cmds[i + 1]
+
+
+# Runs the Fock-SCF loop of a job inside one worker task. Intermediate matrices stay on the local disk, only the
+# scf_step density (the state needed to continue the loop) and the JSON outputs of each iteration are uploaded,
+# under the same keys the state machine loop uses. Returns the task output in the same shape as the
+# updateLoopVariables Lambda, so the execution output is unchanged.
+def run_scf_loop(worker, value, slot_dir):
+    cmds = value['commands']
+    jobid = get_arg(cmds, '--jobid')
+    xyz = get_arg(cmds, '--xyz')
+    basis_set = get_arg(cmds, '--basis_set')
+    bucket = get_arg(cmds, '--bucket')
+    loop_data = value['loopData']
+    energy = value['hartree_fock_energy']
+    bin_prefix = f"job_files/{jobid}/bin_files/{jobid}"
+    json_prefix = f"s3://{bucket}/job_files/{jobid}/json_files/{jobid}"
+
+    job_dir = os.path.join(slot_dir, jobid)
+    os.makedirs(job_dir, exist_ok=True)
+    local = {step: os.path.join(job_dir, f"{step}.bin") for step in ('core_hamiltonian', 'overlap', 'initial_guess')}
+    for step, path in local.items():
+        worker.download_bin(bucket, f"{bin_prefix}_{step}.bin", path)
+    density = local['initial_guess']
+    if int(loop_data['loopCount']) > 1:
+        # A resumed job continues from the density of the last completed iteration
+        density = os.path.join(job_dir, 'resume_density.bin')
+        worker.download_bin(bucket, f"{bin_prefix}_scf_step_{int(loop_data['loopCount']) - 2}.bin", density)
+    # The ERI shards are read by every fock_matrix iteration, keep them in the worker's cache. Shards restored from
+    # the result cache live under a different prefix than the job id.
+    shard_prefix = get_arg(cmds, '--eri_prefix') or jobid
+    shards = worker.resolve_shards(bucket, shard_prefix)
+    eri_prefix, cache_stats = (
+        worker.eri_cache.acquire(bucket, shard_prefix, shards) if worker.eri_cache else (None, None))
+    if cache_stats is not None:
+        worker.add_prefetch(cache_stats.prefetch)
+
+    # With DIIS the history of the loop is kept in memory, a resumed job starts a new one
+    diis = None
+    if value.get('diis') == 'true':
+        try:
+            diis = DiisStage(worker, bucket, jobid, os.path.join(job_dir, 'diis'), local['overlap'], persist=False)
+        except DiisError as e:
+            logging.warning(f"No DIIS extrapolation for job {jobid}: {e}")
+
+    uploads = ThreadPoolExecutor(max_workers=2, thread_name_prefix='checkpoint')
+    pending = []
+    try:
+        # Without the cache the shards are staged once for all iterations
+        local_eri = eri_prefix or worker.stage_shards(bucket, shard_prefix, os.path.join(job_dir, 'eri'))
+        while loop_continues(loop_data, value['max_iter'], value['epsilon']):
+            if worker.is_job_deleted(jobid):
+                raise LoopFailed(f"JOB {jobid} IS DELETED")
+            index = int(loop_data['loopCount']) - 1
+            fock = os.path.join(job_dir, f"fock_matrix_{index}.bin")
+            scf = os.path.join(job_dir, f"scf_step_{index}.bin")
+
+            fock_output = worker.run_integrals([
+                'fock_matrix',
+                '--xyz', xyz,
+                '--basis_set', basis_set,
+                '--jobid', jobid,
+                '--eri_prefix', local_eri,
+                '--bucket', bucket,
+                '--density_url', f"file://{density}",
+                '--output_url', f"file://{fock}"
+            ], job_dir)
+            check_output(fock_output, 'fock_matrix', jobid)
+            diis_error = None
+            if diis:
+                extrapolated = os.path.join(job_dir, f"fock_matrix_diis_{index}.bin")
+                try:
+                    diis_error = diis.step(index, fock, density, extrapolated)
+                    fock = extrapolated
+                except DiisError as e:
+                    logging.warning(f"No DIIS extrapolation for job {jobid} from iteration {index}: {e}")
+                    diis = None
+                fock_output = json.dumps({**json.loads(fock_output), 'diis_error': diis_error})
+            pending.append(uploads.submit(worker.upload_output, fock_output, f"{json_prefix}_fock_matrix_{index}.json"))
+
+            scf_output = worker.run_integrals([
+                'scf_step',
+                '--xyz', xyz,
+                '--basis_set', basis_set,
+                '--jobid', jobid,
+                '--fock_matrix_url', f"file://{fock}",
+                '--hamiltonian_url', f"file://{local['core_hamiltonian']}",
+                '--overlap_url', f"file://{local['overlap']}",
+                '--output_url', f"file://{scf}"
+            ], job_dir)
+            result = check_output(scf_output, 'scf_step', jobid)
+            # Checkpoint of the iteration, uploaded while the next iteration runs
+            pending.append(uploads.submit(worker.upload_output, scf_output, f"{json_prefix}_scf_step_{index}.json"))
+            pending.append(uploads.submit(
+                binfile.upload, worker.s3, scf, bucket, f"{bin_prefix}_scf_step_{index}.bin", worker.config.bin_codec))
+            # The checkpoints are uploaded by other threads, count them against this task here
+            worker.count_bytes(written=len(fock_output) + len(scf_output) + os.path.getsize(scf))
+
+            loop_data = next_loop_data(
+                loop_data, energy, result['hartree_fock_energy'], diis_error, value.get('diis_epsilon'))
+            energy = result['hartree_fock_energy']
+            density = scf
+            logging.info(f"Job {jobid} iteration {index}: energy {energy}, diff {loop_data['hartree_diff']}")
+        for upload in pending:
+            upload.result()
+    finally:
+        uploads.shutdown(wait=True)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        if eri_prefix:
+            worker.eri_cache.release(shard_prefix)
+
+    profile = worker.current_profile()
+    worker.upload_output(json.dumps({
+        'success': True,
+        'hartree_fock_energy': energy,
+        'loopData': loop_data,
+        'eri_cache': cache_stats.to_dict() if cache_stats else None,
+        'eri_prefetch': profile.prefetch.to_dict() if profile and profile.prefetch else None,
+    }), value['s3_bucket_path'])
+    return {
+        'jobid': jobid,
+        's3_bucket_path': value['s3_bucket_path'],
+        'max_iter': value['max_iter'],
+        'commands': cmds,
+        'hartree_fock_energy': energy,
+        'loopData': loop_data,
+        'epsilon': value['epsilon'],
+        'diis': value.get('diis', 'false'),
+        'diis_epsilon': value.get('diis_epsilon'),
+        'eri_prefix': shard_prefix
+    }
+
+
+def check_output(output, step, jobid) -> dict:
+    if not output:
+        raise LoopFailed(f"NO OUTPUT FILE GENERATED for {step} of job {jobid}")
+    result = json.loads(output)
+    if result.get('success') is not True:
+        raise LoopFailed(json.dumps(result.get('error')))
+    return result
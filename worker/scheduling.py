@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from shared.bulk_queue import list_bulk_queues, publish_backlog, queue_backlog
+from shared.scaling import publish_task_seconds
+
+
+# The bulk (ERI slice) queues of the running jobs, see shared/bulk_queue.py. The list is read at most every
+# refresh_seconds, queues announced by setupTei on the task queue are added right away. Every call to rotation()
+# starts at the next queue, so the receive loop shares the slots between the jobs in weighted round robin (every job
+# the same weight) however many slices each job has queued.
+class BulkQueues:
+    def __init__(self, sqs, cloudwatch, refresh_seconds=5.0):
+        self.sqs = sqs
+        self.cloudwatch = cloudwatch
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.urls: List[str] = []
+        self.listed_at = None
+        # url -> time it was announced, kept until the listing has caught up with its creation
+        self.announced: Dict[str, float] = {}
+        self.next = 0
+
+    def refresh(self):
+        if self.listed_at is not None and time.monotonic() - self.listed_at < self.refresh_seconds:
+            return
+        try:
+            urls = sorted(list_bulk_queues(self.sqs))
+        except Exception:
+            logging.exception("Could not list the bulk queues")
+            urls = self.urls
+        with self.lock:
+            now = time.monotonic()
+            self.announced = {url: at for url, at in self.announced.items() if now - at < 60}
+            self.urls = sorted(set(urls) | set(self.announced))
+            self.listed_at = now
+
+    def add(self, url):
+        with self.lock:
+            self.announced[url] = time.monotonic()
+            if url not in self.urls:
+                self.urls.append(url)
+
+    # Queue URLs starting at the next queue in turn
+    def rotation(self) -> List[str]:
+        self.refresh()
+        with self.lock:
+            if not self.urls:
+                return []
+            start = self.next % len(self.urls)
+            self.next = start + 1
+            return self.urls[start:] + self.urls[:start]
+
+    # Stops receiving from a queue until it is listed again (it was deleted or could not be read)
+    def forget(self, url):
+        with self.lock:
+            self.announced.pop(url, None)
+            if url in self.urls:
+                self.urls.remove(url)
+
+    # Deletes the queue of a job whose slices are all done (or whose execution failed), the slices still queued
+    # are dropped with it
+    def retire(self, url):
+        self.forget(url)
+        try:
+            self.sqs.delete_queue(QueueUrl=url)
+            logging.info(f"Deleted bulk queue {url}")
+        except Exception:
+            logging.exception(f"Could not delete bulk queue {url}")
+
+    # Called by the heartbeat, publishes the number of slices waiting in the bulk queues for the service's scaling
+    def publish_backlog(self):
+        with self.lock:
+            urls = list(self.urls)
+        try:
+            publish_backlog(self.cloudwatch, queue_backlog(self.sqs, urls))
+        except Exception:
+            logging.exception("Could not publish the bulk queue backlog")
+
+
+# Time the slots spent on the tasks of every step, published every heartbeat for the scaleWorkers Lambda (see
+# shared/scaling.py)
+class TaskDurations:
+    def __init__(self, cloudwatch):
+        self.cloudwatch = cloudwatch
+        self.lock = threading.Lock()
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+
+    def add(self, step, seconds):
+        with self.lock:
+            self.durations[step].append(seconds)
+
+    def publish(self):
+        with self.lock:
+            durations, self.durations = self.durations, defaultdict(list)
+        if not durations:
+            return
+        try:
+            publish_task_seconds(self.cloudwatch, durations)
+        except Exception:
+            logging.exception("Could not publish the task durations")
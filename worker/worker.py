@@ -0,0 +1,830 @@
+import json
+import logging
+import math
+import os
+import shutil
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import boto3
+from botocore.config import Config
+from shared import binfile
+from shared.bulk_queue import is_bulk_queue
+from shared.completion import CompletionTracker, DynamoBackend
+from shared.manifest import shard_objects, shard_record, shard_record_key, slice_task
+from shared.result_cache import CACHE_PREFIX, ResultCache
+from shared.scaling import delete_plan
+
+from worker.affinity import AffinityRouter
+from worker.deleted_jobs import DeletedJobs, JobDeleted
+from worker.diis import run_diis_step
+from worker.eri_cache import EriCache
+from worker.inputs import InputCache, InvalidInput
+from worker.prefetch import PrefetchStats, ShardPrefetcher
+from worker.profile import ProfileRecorder, TaskProfile, run_measured, timed
+from worker.scf_loop import LoopFailed, get_arg, run_scf_loop
+from worker.scheduling import BulkQueues, TaskDurations
+
+
+# Settings for a worker process, see worker/main.py for how they are read from the environment
+@dataclass
+class WorkerConfig:
+    task_queue: str
+    batch_table: str
+    deleted_job_table: str
+    cluster: str = 'Integrals-CDK-Cluster'
+    task_arn: Optional[str] = None
+    integrals_path: str = '/integrals/integrals'
+    work_dir: str = '/tmp/integrals'
+    slots: int = 1
+    # Long polling wait for receive_message (seconds, 20 is the SQS maximum)
+    wait_time_seconds: int = 20
+    # Visibility timeout given to received messages and extended by the heartbeat while a task runs
+    visibility_timeout: int = 300
+    heartbeat_interval: int = 60
+    protection_minutes: int = 180
+    # Size of the local ERI shard cache used by fock_matrix tasks (0 disables the cache)
+    eri_cache_bytes: int = 8 * 1024 ** 3
+    # Forward fock_matrix tasks to the worker that caches the job's ERI shards
+    affinity: bool = True
+    # Codec of the .bin objects the worker uploads (None uploads them uncompressed), see shared/binfile.py
+    bin_codec: Optional[str] = binfile.default_codec()
+    # integrals subcommands that accept --output_url in place of --output_object. The worker writes their output
+    # locally and uploads it with bin_codec, the others upload their --output_object themselves, uncompressed.
+    output_url_commands: Tuple[str, ...] = ()
+    # Seconds between two reads of the deleted jobs table, the integrals processes of an aborted job are stopped
+    # within about this time
+    deleted_jobs_refresh_seconds: float = 5.0
+    # Slots that only take tasks from the task queue (the steps on the critical path of a job, never ERI slices).
+    # Without them, such a task waits for the first slot of the fleet to finish its slice (the task queue is always
+    # read first). A worker with a single slot does not reserve it.
+    priority_slots: int = 0
+    # Seconds between two listings of the bulk queues, a new job's slices are picked up within about this time
+    bulk_queues_refresh_seconds: float = 5.0
+    # Run the steps of a one-electron task at the same time rather than one after the other. They take seconds, so
+    # the slot's CPUs are shared for a short time rather than the job waiting for the sum of the steps.
+    concurrent_steps: bool = True
+
+
+# Flags of integrals commands whose value is the URL of a .bin input
+BIN_INPUT_FLAGS = ('--density_url', '--fock_matrix_url', '--hamiltonian_url', '--overlap_url')
+
+
+# Keeps ECS task protection enabled while at least one slot is busy
+class TaskProtection:
+    def __init__(self, ecs, config: WorkerConfig):
+        self.ecs = ecs
+        self.config = config
+        self.lock = threading.Lock()
+        self.active = 0
+        self.enabled_at = 0.0
+
+    def _set(self, enabled):
+        if self.config.task_arn is None:
+            return
+        try:
+            if enabled:
+                self.ecs.update_task_protection(
+                    cluster=self.config.cluster, tasks=[self.config.task_arn],
+                    protectionEnabled=True, expiresInMinutes=self.config.protection_minutes)
+                self.enabled_at = time.monotonic()
+            else:
+                self.ecs.update_task_protection(
+                    cluster=self.config.cluster, tasks=[self.config.task_arn], protectionEnabled=False)
+        except Exception:
+            logging.exception("Could not update task protection")
+
+    def acquire(self):
+        with self.lock:
+            self.active += 1
+            if self.active == 1:
+                self._set(True)
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self._set(False)
+
+    # Renews protection before it expires when tasks run for longer than the protection window
+    def renew(self):
+        with self.lock:
+            if self.active > 0 and time.monotonic() - self.enabled_at > self.config.protection_minutes * 30:
+                self._set(True)
+
+
+# Extends the visibility timeout of all in-flight messages so they are not redelivered while running, and runs
+# the other periodic upkeep (hooks) of the worker
+class VisibilityHeartbeat(threading.Thread):
+    def __init__(self, sqs, config: WorkerConfig, hooks: List[Callable[[], None]]):
+        super().__init__(name='heartbeat', daemon=True)
+        self.sqs = sqs
+        self.config = config
+        self.hooks = hooks
+        self.lock = threading.Lock()
+        # message id -> (queue url, receipt handle)
+        self.receipts: Dict[str, Tuple[str, str]] = {}
+        self.stopped = threading.Event()
+
+    def add(self, message_id, queue_url, receipt):
+        with self.lock:
+            self.receipts[message_id] = (queue_url, receipt)
+
+    def remove(self, message_id):
+        with self.lock:
+            self.receipts.pop(message_id, None)
+
+    def beat(self):
+        queues: Dict[str, List[dict]] = {}
+        with self.lock:
+            for message_id, (queue_url, receipt) in self.receipts.items():
+                queues.setdefault(queue_url, []).append(
+                    {'Id': message_id, 'ReceiptHandle': receipt, 'VisibilityTimeout': self.config.visibility_timeout})
+        for queue_url, entries in queues.items():
+            for i in range(0, len(entries), 10):
+                try:
+                    response = self.sqs.change_message_visibility_batch(QueueUrl=queue_url, Entries=entries[i:i + 10])
+                    for failed in response.get('Failed', []):
+                        logging.warning(f"Visibility heartbeat failed for {failed['Id']}: {failed.get('Message')}")
+                except Exception:
+                    logging.exception("Visibility heartbeat failed")
+        for hook in self.hooks:
+            hook()
+
+    def run(self):
+        while not self.stopped.wait(self.config.heartbeat_interval):
+            self.beat()
+
+
+# Long-lived worker that pulls tasks from the task queue and runs them in a fixed number of slots
+class Worker:
+    # session creates the AWS clients (boto3 by default, the benchmarks pass local stand-ins)
+    def __init__(self, config: WorkerConfig, session=boto3):
+        self.config = config
+        # One connection per slot plus the receive loop and heartbeat
+        client_config = Config(max_pool_connections=config.slots + 4, retries={'mode': 'standard'})
+        self.sqs = session.client('sqs', config=client_config)
+        self.s3 = session.client('s3', config=client_config)
+        self.sfn = session.client('stepfunctions', config=client_config)
+        self.dynamo = session.client('dynamodb', config=client_config)
+        self.ecs = session.client('ecs', config=client_config)
+        self.cloudwatch = session.client('cloudwatch', config=client_config)
+        self.tracker = CompletionTracker(DynamoBackend(self.dynamo, config.batch_table))
+        # Slots of the receive loop and the slots reserved for the task queue (see WorkerConfig.priority_slots)
+        reserved = min(config.priority_slots, config.slots - 1)
+        self.free_slots = threading.Semaphore(config.slots - reserved)
+        self.free_priority_slots = threading.Semaphore(reserved) if reserved > 0 else None
+        self.executor = ThreadPoolExecutor(max_workers=config.slots, thread_name_prefix='slot')
+        self.protection = TaskProtection(self.ecs, config)
+        self.deleted_jobs = DeletedJobs(self.dynamo, config.deleted_job_table, config.deleted_jobs_refresh_seconds)
+        use_cache = config.eri_cache_bytes > 0
+        self.affinity = AffinityRouter(self.sqs, self.dynamo, config) if use_cache and config.affinity else None
+        self.prefetcher = ShardPrefetcher(self.s3)
+        self.eri_cache = EriCache(
+            self.s3, os.path.join(config.work_dir, 'eri_cache'), config.eri_cache_bytes, self.prefetcher,
+            on_evict=self.affinity.unregister if self.affinity else None
+        ) if use_cache else None
+        self.inputs = InputCache(self.s3, os.path.join(config.work_dir, 'inputs'))
+        self.worker_id = (config.task_arn or f"{os.uname().nodename}-{os.getpid()}").split('/')[-1]
+        self.recorder = ProfileRecorder(self.s3, self.worker_id)
+        # Profile of the task run by the current slot thread
+        self.profiles = threading.local()
+        self.bulk_queues = BulkQueues(self.sqs, self.cloudwatch, config.bulk_queues_refresh_seconds)
+        self.durations = TaskDurations(self.cloudwatch)
+        hooks = [
+            self.protection.renew, self.recorder.flush_all, self.bulk_queues.publish_backlog, self.durations.publish]
+        hooks += [self.affinity.refresh, self.affinity.sweep] if self.affinity else []
+        self.heartbeat = VisibilityHeartbeat(self.sqs, config, hooks)
+        self.stopping = threading.Event()
+        self.slot_dirs = [os.path.join(config.work_dir, f"slot_{i}") for i in range(config.slots)]
+        self.slot_lock = threading.Lock()
+        self.manifests: Dict[str, dict] = {}
+        self.manifest_lock = threading.Lock()
+        for slot_dir in self.slot_dirs:
+            os.makedirs(slot_dir, exist_ok=True)
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stopping.set())
+        self.heartbeat.start()
+        self.deleted_jobs.start()
+        if self.affinity:
+            self.affinity.start(self.worker_id)
+        priority = None
+        if self.free_priority_slots:
+            priority = threading.Thread(
+                target=self.receive_loop, args=(self.free_priority_slots, self.receive_priority), name='priority')
+            priority.start()
+        self.receive_loop(self.free_slots, self.receive_any)
+        if priority:
+            priority.join()
+        logging.info("Stopping worker")
+        if self.affinity:
+            self.affinity.close()
+        self.executor.shutdown(wait=True)
+        self.deleted_jobs.close()
+        self.recorder.flush_all()
+
+    # Runs the messages returned by receive on the slots of the semaphore until the worker stops
+    def receive_loop(self, slots: threading.Semaphore, receive: Callable[[int], List[dict]]):
+        while not self.stopping.is_set():
+            # Wait for at least one free slot, then receive as many messages as there are free slots
+            if not slots.acquire(timeout=1):
+                continue
+            available = 1
+            while available < 10 and slots.acquire(blocking=False):
+                available += 1
+            messages = self.take_announcements(self.drop_deleted(receive(available)))
+            for _ in range(available - len(messages)):
+                slots.release()
+            for message in messages:
+                self.heartbeat.add(message['MessageId'], message['QueueUrl'], message['ReceiptHandle'])
+                self.executor.submit(self.process, message, slots)
+
+    # Receives up to count messages for the slots reserved for the task queue
+    def receive_priority(self, count) -> List[dict]:
+        return self.receive(self.config.task_queue, count, self.config.wait_time_seconds)
+
+    # Receives up to count messages. Tasks forwarded to this worker's affinity queue are taken first, then the
+    # tasks of the shared task queue, then ERI slices from the bulk queues of the running jobs in turn. Queues are
+    # long-polled for a shorter time while there may be forwarded tasks or slices to take.
+    def receive_any(self, count) -> List[dict]:
+        wait = self.config.wait_time_seconds
+        if self.affinity and self.affinity.jobs:
+            messages = self.receive(self.affinity.queue_url, count, 0)
+            if messages:
+                return messages
+            wait = min(wait, 2)
+        bulk_queues = self.bulk_queues.rotation()
+        if not bulk_queues:
+            # Until the next listing of the bulk queues (only one worker receives the announcement of a new queue)
+            wait = min(wait, math.ceil(self.config.bulk_queues_refresh_seconds))
+            return self.receive(self.config.task_queue, count, wait)
+        messages = self.receive(self.config.task_queue, count, 0)
+        if messages:
+            return messages
+        messages = self.receive_bulk(bulk_queues, count)
+        return messages or self.receive(self.config.task_queue, count, min(wait, 2))
+
+    # Receives up to count slices from the bulk queues. Every queue is asked for an equal share of count (at least
+    # one, the first queues of the rotation first), the share of the queues that ran out goes to the others.
+    def receive_bulk(self, queues, count) -> List[dict]:
+        messages = []
+        while queues and len(messages) < count:
+            share = max(1, (count - len(messages)) // len(queues))
+            remaining = []
+            for url in queues:
+                wanted = min(share, count - len(messages))
+                if wanted == 0:
+                    break
+                received = self.receive(url, wanted, 0)
+                messages += received
+                if len(received) == wanted:
+                    remaining.append(url)
+            queues = remaining
+        return messages
+
+    def receive(self, queue_url, count, wait) -> List[dict]:
+        try:
+            response = self.sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=count,
+                WaitTimeSeconds=wait,
+                VisibilityTimeout=self.config.visibility_timeout,
+                MessageAttributeNames=['All'],
+                AttributeNames=['SentTimestamp'],
+            )
+        except Exception:
+            if is_bulk_queue(queue_url):
+                # The queue of a job that completed or was deleted
+                self.bulk_queues.forget(queue_url)
+                return []
+            logging.exception("Could not receive messages")
+            time.sleep(1)
+            return []
+        messages = response.get('Messages', [])
+        received = time.time()
+        for message in messages:
+            message['QueueUrl'] = queue_url
+            message['ReceivedAt'] = received
+        return messages
+
+    # Deletes the messages of jobs known to be deleted without running them, in batches and without taking a slot,
+    # so the queued slices of an aborted job are cleared quickly. The first task of a deleted job a worker sees is
+    # still run, to report the failure to the state machine. Returns the other messages.
+    def drop_deleted(self, messages) -> List[dict]:
+        kept = []
+        dropped: Dict[str, List[dict]] = {}
+        for message in messages:
+            try:
+                jobid = json.loads(message['Body'])['input']['value']['jobid']
+            except (ValueError, KeyError, TypeError):
+                jobid = None
+            if jobid is not None and self.deleted_jobs.droppable(jobid):
+                dropped.setdefault(message['QueueUrl'], []).append(message)
+            else:
+                kept.append(message)
+        for queue_url, queue_messages in dropped.items():
+            logging.info(f"Dropping {len(queue_messages)} messages of deleted jobs")
+            try:
+                self.sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+                    {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                    for i, message in enumerate(queue_messages)
+                ])
+            except Exception:
+                logging.exception("Could not delete the messages of deleted jobs")
+        return kept
+
+    # Adds the bulk queues announced by setupTei to the queues the worker takes slices from and deletes the
+    # announcements. Returns the other messages.
+    def take_announcements(self, messages) -> List[dict]:
+        kept = []
+        for message in messages:
+            try:
+                url = json.loads(message['Body'])['input']['value'].get('bulk_queue')
+            except (ValueError, KeyError, TypeError, AttributeError):
+                url = None
+            if url is None:
+                kept.append(message)
+                continue
+            self.bulk_queues.add(url)
+            try:
+                self.delete_message(message)
+            except Exception:
+                logging.exception(f"Could not delete the announcement of bulk queue {url}")
+        return kept
+
+    def process(self, message, slots: threading.Semaphore):
+        slot_dir = self.take_slot_dir()
+        self.protection.acquire()
+        sent = int(message.get('Attributes', {}).get('SentTimestamp', 0)) / 1000 or message['ReceivedAt']
+        profile = TaskProfile(sent=sent, received=message['ReceivedAt'], start=time.time())
+        self.profiles.current = profile
+        bulk = is_bulk_queue(message['QueueUrl'])
+        try:
+            self.handle(message, slot_dir)
+            self.delete_message(message)
+            # The queue of a job is deleted once its last slice is done or the job failed
+            if bulk and profile.status in ('completed_job', 'failed'):
+                self.bulk_queues.retire(message['QueueUrl'])
+        except Exception:
+            # Leave the message on the queue, it becomes visible again once the heartbeat stops
+            logging.exception(f"Task for message {message['MessageId']} failed unexpectedly")
+        finally:
+            self.profiles.current = None
+            profile.end = time.time()
+            if profile.step and profile.status in ('success', 'completed_job'):
+                # One duration per step of a multi-step task, so the mean is the time of a single step
+                for _ in range(profile.tasks):
+                    self.durations.add(profile.step, (profile.end - profile.start) / profile.tasks)
+            # Records of single tasks are written right away, ERI slices are buffered until the job completes
+            self.recorder.add(profile, flush=profile.index is None or profile.status == 'completed_job')
+            self.heartbeat.remove(message['MessageId'])
+            self.protection.release()
+            self.give_slot_dir(slot_dir)
+            slots.release()
+
+    def take_slot_dir(self) -> str:
+        with self.slot_lock:
+            return self.slot_dirs.pop()
+
+    def give_slot_dir(self, slot_dir):
+        with self.slot_lock:
+            self.slot_dirs.append(slot_dir)
+
+    # Loads a fan-out manifest written by setupTei, cached since every slice of a job shares it
+    def get_manifest(self, url) -> dict:
+        with self.manifest_lock:
+            if url in self.manifests:
+                return self.manifests[url]
+        parsed = urlparse(url, allow_fragments=False)
+        obj = self.s3.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip('/'))
+        manifest = json.loads(obj['Body'].read())
+        with self.manifest_lock:
+            if len(self.manifests) >= 64:
+                self.manifests.clear()
+            self.manifests[url] = manifest
+        return manifest
+
+    # Returns the task token and the full task input for a message. Fan-out messages from setupTei only
+    # carry the manifest location and a slice index (or several), the rest is filled in from the manifest.
+    def resolve_task(self, body):
+        value = body['input']['value']
+        if 'manifest' not in value:
+            return body['token'], value
+        manifest = self.get_manifest(value['manifest'])
+        if 'slices' in value:
+            # Short slices sent in one message, run by handle_steps
+            steps = [slice_task(manifest, i) for i in value['slices']]
+            return manifest['token'], {**steps[0], 'steps': steps}
+        return manifest['token'], slice_task(manifest, value['slice'])
+
+    # Runs a single task and reports the result to the state machine through the task token
+    def handle(self, message, slot_dir):
+        token, value = self.resolve_task(json.loads(message['Body']))
+        attributes = message.get('MessageAttributes', {})
+        batch = attributes.get('batch', {}).get('StringValue') == 'true'
+        jobid = value['jobid']
+        profile = self.current_profile()
+        if profile:
+            profile.describe(value)
+
+        if self.is_job_deleted(jobid):
+            self.fail_deleted(token, jobid, batch)
+            return
+
+        # The info step stages the xyz file in the job's prefix, every later command of the job reads the staged copy
+        if value['commands'][0] == 'info' and not get_arg(value['commands'], '--xyz').startswith('s3://'):
+            try:
+                self.stage_xyz(value)
+            except (OSError, InvalidInput) as e:
+                self.send_failure(token, f"COULD NOT STAGE THE XYZ FILE of job {jobid}: {e}")
+                return
+
+        # The fused Fock-SCF loop is run by the worker itself rather than a single integrals command
+        if value['commands'][0] == 'scf_loop':
+            try:
+                self.send_success(token, run_scf_loop(self, value, slot_dir))
+                self.end_plan(jobid)
+            except JobDeleted:
+                self.fail_deleted(token, jobid, batch)
+            except LoopFailed as e:
+                self.send_failure(token, str(e))
+            return
+
+        # Tasks of several steps (the one-electron steps, or ERI slices grouped by setupTei) run in this slot
+        if 'steps' in value:
+            self.handle_steps(token, value, batch, slot_dir)
+            return
+
+        if value['commands'][0] == 'fock_matrix' and self.eri_cache:
+            # Send the task to the worker that already holds the job's ERI shards (messages are forwarded once)
+            eri_prefix = get_arg(value['commands'], '--eri_prefix')
+            if self.affinity and 'forwarded' not in attributes and not self.eri_cache.holds(eri_prefix):
+                owner = self.affinity.owner(eri_prefix)
+                if owner:
+                    self.affinity.forward(message, owner)
+                    if profile:
+                        profile.status = 'forwarded'
+                    return
+        try:
+            output = self.run_step(value, slot_dir)
+        except JobDeleted:
+            self.fail_deleted(token, jobid, batch)
+            return
+        self.report(token, value, batch, output)
+
+    # Runs the steps of value['steps'] in this slot, so they share the slot's staged inputs and the cost of one
+    # message. ERI slices grouped by setupTei (batch) run one after the other and report to the job's tracker one by
+    # one, as single slices do. The one-electron steps run at the same time (see WorkerConfig.concurrent_steps),
+    # store their outputs as their own tasks would and report once, with the success of every step in step_results
+    # (also written to the task's s3_bucket_path). The task fails when one of its steps fails.
+    def handle_steps(self, token, value, batch, slot_dir):
+        profile = self.current_profile()
+        if profile:
+            profile.tasks = len(value['steps'])
+        try:
+            if batch:
+                for step in value['steps']:
+                    if not self.report(token, step, batch, self.run_step(step, slot_dir)):
+                        return
+                return
+            outputs = self.run_steps(value['steps'], slot_dir)
+        except JobDeleted:
+            self.fail_deleted(token, value['jobid'], batch)
+            return
+        results = {}
+        for step, output in zip(value['steps'], outputs):
+            cause = self.failure(step, output)
+            if cause is not None:
+                self.send_failure(token, f"{step['commands'][0]} failed: {cause}")
+                return
+            results[step['commands'][0]] = True
+        for step in value['steps']:
+            self.store_result(step)
+        self.upload_output(json.dumps({'success': True, 'steps': results}), value['s3_bucket_path'])
+        self.send_success(token, {**value, 'step_results': results})
+
+    # Runs steps and returns their outputs. With concurrent_steps they run at the same time, each in a directory of
+    # its own in the slot directory, and add to the task's profile.
+    def run_steps(self, steps, slot_dir) -> List[Optional[str]]:
+        if not self.config.concurrent_steps or len(steps) == 1:
+            return [self.run_step(step, slot_dir) for step in steps]
+        profile = self.current_profile()
+
+        def run(index, step):
+            directory = os.path.join(slot_dir, f"step_{index}")
+            os.makedirs(directory, exist_ok=True)
+            self.profiles.current = profile
+            try:
+                return self.run_step(step, directory)
+            finally:
+                self.profiles.current = None
+                shutil.rmtree(directory, ignore_errors=True)
+        with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix='step') as executor:
+            return list(executor.map(run, range(len(steps)), steps))
+
+    # Runs the command of a task and uploads its JSON output. Returns the output, None when there is none.
+    def run_step(self, value, slot_dir) -> Optional[str]:
+        profile = self.current_profile()
+        cache_stats = None
+        if value['commands'][0] == 'fock_matrix' and self.eri_cache:
+            output, cache_stats = self.run_fock_matrix(value['commands'], slot_dir)
+        else:
+            output = self.run_integrals(value['commands'], slot_dir)
+        if not output:
+            return None
+        if cache_stats is not None:
+            output = json.dumps({**json.loads(output), 'eri_cache': cache_stats.to_dict()})
+        if value['commands'][0] == 'fock_matrix' and value.get('diis') == 'true':
+            output = self.extrapolate_fock(value, output, slot_dir)
+        if profile and profile.prefetch:
+            output = json.dumps({**json.loads(output), 'eri_prefetch': profile.prefetch.to_dict()})
+        self.upload_output(output, value['s3_bucket_path'])
+        return output
+
+    # Cause of the failure of a step from its output, None when it succeeded
+    def failure(self, value, output) -> Optional[str]:
+        if not output:
+            return f"NO OUTPUT FILE GENERATED for job {value['jobid']}"
+        result = json.loads(output)
+        if result.get('success') is not True:
+            return json.dumps(result.get('error'))
+        return None
+
+    # Reports the result of a task to the state machine (through the job's tracker for ERI slices) and stores its
+    # outputs in the result cache. Returns whether the task succeeded.
+    def report(self, token, value, batch, output) -> bool:
+        profile = self.current_profile()
+        cause = self.failure(value, output)
+        if cause is not None:
+            self.send_failure(token, cause)
+        elif batch:
+            # Only the slice that completes the job reports success, redeliveries are not counted twice
+            with timed(profile, 'signal'):
+                completed = self.tracker.complete(
+                    value.get('tracker_id', value['jobid']), value['slice'], value['num_tasks'])
+            if profile:
+                profile.status = 'success'
+            if completed:
+                shards = self.record_shards(value)
+                self.send_success(token, value)
+                self.tracker.delete(value.get('tracker_id', value['jobid']))
+                self.store_result(value, shards)
+                if profile:
+                    profile.status = 'completed_job'
+        else:
+            shards = self.record_shards(value) if value['commands'][0] == 'two_electrons_integrals' else None
+            self.send_success(token, value)
+            self.store_result(value, shards)
+        return cause is None
+
+    # Writes the record of the job's ERI shards once the two_electrons_integrals step is complete, so that the
+    # fock_matrix tasks know the shards and their sizes without listing them. Returns the shards.
+    def record_shards(self, value) -> List[dict]:
+        bucket = get_arg(value['commands'], '--bucket')
+        jobid = value['jobid']
+        shards = self.list_objects(bucket, f"{jobid}_")
+        try:
+            self.s3.put_object(
+                Bucket=bucket, Key=shard_record_key(jobid), Body=json.dumps(shard_record(shards)).encode())
+        except Exception:
+            logging.exception(f"Could not write the ERI shard record of job {jobid}")
+        return shards
+
+    # Shards of an ERI prefix with their stored sizes, from the record written when the two_electrons_integrals
+    # step completed or from the result cache entry of cached shards. Shards without a record are listed.
+    def resolve_shards(self, bucket, eri_prefix) -> List[dict]:
+        record = None
+        try:
+            if eri_prefix.startswith(f"{CACHE_PREFIX}/"):
+                entry = ResultCache(self.s3, bucket).lookup(eri_prefix.split('/')[1])
+                record = entry if entry and 'shards' in entry else None
+            else:
+                obj = self.s3.get_object(Bucket=bucket, Key=shard_record_key(eri_prefix))
+                record = json.loads(obj['Body'].read())
+        except self.s3.exceptions.NoSuchKey:
+            pass
+        if record is None:
+            return self.list_objects(bucket, f"{eri_prefix}_")
+        return shard_objects(eri_prefix, record)
+
+    # Downloads the shards of an ERI prefix to directory, for tasks that do not use the cache
+    def stage_shards(self, bucket, eri_prefix, directory) -> str:
+        self.add_prefetch(self.prefetcher.fetch(bucket, self.resolve_shards(bucket, eri_prefix), directory))
+        return f"file://{os.path.join(directory, os.path.basename(eri_prefix))}"
+
+    def add_prefetch(self, stats: Optional[PrefetchStats]):
+        profile = self.current_profile()
+        if profile is None or stats is None:
+            return
+        if profile.prefetch is None:
+            profile.prefetch = PrefetchStats()
+        profile.prefetch.add(stats)
+        profile.bytes_read += stats.bytes
+
+    # Adds the outputs of a successful step to the result cache when the setup Lambda asked for it (cache_key)
+    def store_result(self, value, shards: Optional[List[dict]] = None):
+        if not value.get('cache_key'):
+            return
+        cmds = value['commands']
+        step = cmds[0]
+        bucket = get_arg(cmds, '--bucket')
+        cache = ResultCache(self.s3, bucket)
+        try:
+            if step == 'two_electrons_integrals':
+                jobid = value['jobid']
+                shards = shards if shards is not None else self.list_objects(bucket, f"{jobid}_")
+                cache.store(value['cache_key'], step, {shard['Key']: shard['Key'] for shard in shards},
+                            sizes={shard['Key']: shard['Size'] for shard in shards},
+                            eri_prefix=cache.object_key(value['cache_key'], jobid), source_job=jobid,
+                            **shard_record(shards))
+            elif step in ('core_hamiltonian', 'overlap', 'initial_guess'):
+                cache.store(value['cache_key'], step, {
+                    'output.bin': get_arg(cmds, '--output_object'),
+                    'output.json': urlparse(value['s3_bucket_path']).path.lstrip('/'),
+                }, source_job=value['jobid'])
+        except Exception:
+            logging.exception(f"Could not store the {step} outputs of job {value['jobid']} in the result cache")
+
+    # Replaces the --xyz URL of the task (and so of the state passed on to the next steps) with the staged copy
+    def stage_xyz(self, value):
+        cmds = value['commands']
+        bucket = urlparse(value['s3_bucket_path']).netloc
+        staged, digest = self.inputs.stage(bucket, value['jobid'], get_arg(cmds, '--xyz'))
+        value['commands'] = [staged if i > 0 and cmds[i - 1] == '--xyz' else arg for i, arg in enumerate(cmds)]
+        value['xyz_sha256'] = digest
+        logging.info(f"Staged the xyz file of job {value['jobid']} at {staged}")
+
+    def list_objects(self, bucket, prefix) -> List[dict]:
+        objects = []
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            objects.extend(page.get('Contents', []))
+        return objects
+
+    def is_job_deleted(self, jobid) -> bool:
+        return self.deleted_jobs.contains(jobid)
+
+    # Reports a task of a deleted job as failed. The many slices of a batch job are reported once per worker, the
+    # execution has already failed after the first one.
+    def fail_deleted(self, token, jobid, batch):
+        profile = self.current_profile()
+        if self.deleted_jobs.report(jobid) or not batch:
+            self.send_failure(token, f"JOB {jobid} IS DELETED")
+        if profile:
+            profile.status = 'cancelled'
+
+    # Runs a fock_matrix command with the ERI shards read from the local cache. Returns the output and the
+    # cache counts (None when the shards do not fit in the cache and are read from S3).
+    def run_fock_matrix(self, commands, slot_dir):
+        jobid = get_arg(commands, '--eri_prefix')
+        bucket = get_arg(commands, '--bucket')
+        prefix, stats = self.eri_cache.acquire(bucket, jobid, self.resolve_shards(bucket, jobid))
+        self.add_prefetch(stats.prefetch)
+        if prefix is None:
+            return self.run_integrals(commands, slot_dir), None
+        try:
+            if self.affinity:
+                self.affinity.register(jobid)
+            local_commands = list(commands)
+            local_commands[local_commands.index('--eri_prefix') + 1] = prefix
+            return self.run_integrals(local_commands, slot_dir), stats
+        finally:
+            self.eri_cache.release(jobid)
+
+    # The job no longer needs a slot reserved by the scaler (see shared/scaling.py), the plan expires otherwise
+    def end_plan(self, jobid):
+        try:
+            delete_plan(self.dynamo, self.config.batch_table, jobid)
+        except Exception:
+            logging.exception(f"Could not delete the plan of job {jobid}")
+
+    # DIIS stage of a successful fock_matrix task (see worker/diis.py), adds the iteration's error norm to the output
+    def extrapolate_fock(self, value, output, slot_dir) -> str:
+        result = json.loads(output)
+        if result.get('success') is not True:
+            return output
+        cmds = value['commands']
+        diis_error = run_diis_step(
+            self, get_arg(cmds, '--bucket'), value['jobid'], int(value['loopData']['loopCount']) - 1,
+            get_arg(cmds, '--output_object'), get_arg(cmds, '--density_url'), slot_dir)
+        return json.dumps({**result, 'diis_error': diis_error})
+
+    # Runs the integrals binary and returns its standard output (the task's JSON output)
+    def run_integrals(self, commands, slot_dir) -> str:
+        # Staged inputs are read from the local input cache
+        commands = [
+            self.inputs.localize(arg) if i > 0 and commands[i - 1] == '--xyz' else arg
+            for i, arg in enumerate(commands)
+        ]
+        bin_dir = os.path.join(slot_dir, 'bin')
+        try:
+            commands, outputs = self.localize_bins(commands, bin_dir)
+            output = self.run_binary(commands, slot_dir)
+            for path, bucket, key in outputs:
+                if os.path.exists(path):
+                    self.upload_bin(path, bucket, key)
+            return output
+        finally:
+            shutil.rmtree(bin_dir, ignore_errors=True)
+
+    # Moves the .bin transfers of a command from the integrals binary to the worker, which compresses them: s3://
+    # inputs are downloaded to bin_dir, the --output_object of output_url_commands is written to bin_dir and the ERI
+    # shards of an --eri_prefix that is not local are staged there. Returns the local command and the
+    # (path, bucket, key) outputs to upload.
+    def localize_bins(self, commands, bin_dir) -> Tuple[List[str], List[Tuple[str, str, str]]]:
+        bucket = get_arg(commands, '--bucket')
+        local = list(commands)
+        outputs = []
+        for i in range(1, len(commands) - 1):
+            flag, arg = commands[i], commands[i + 1]
+            if flag in BIN_INPUT_FLAGS and arg.startswith('s3://'):
+                url = urlparse(arg, allow_fragments=False)
+                path = os.path.join(bin_dir, os.path.basename(url.path))
+                self.download_bin(url.netloc, url.path.lstrip('/'), path)
+                local[i + 1] = f"file://{path}"
+            elif flag == '--output_object' and commands[0] in self.config.output_url_commands:
+                path = os.path.join(bin_dir, os.path.basename(arg))
+                local[i:i + 2] = ['--output_url', f"file://{path}"]
+                outputs.append((path, bucket, arg))
+            elif flag == '--eri_prefix' and not arg.startswith('file://'):
+                local[i + 1] = self.stage_shards(bucket, arg, os.path.join(bin_dir, 'eri'))
+        return local, outputs
+
+    def download_bin(self, bucket, key, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.count_bytes(read=binfile.download(self.s3, bucket, key, path))
+
+    def upload_bin(self, path, bucket, key):
+        with timed(self.current_profile(), 'upload'):
+            self.count_bytes(written=binfile.upload(self.s3, path, bucket, key, self.config.bin_codec))
+
+    # Runs the integrals binary. The process is registered with the deleted jobs, which stop it if the job is
+    # deleted while it runs (JobDeleted is raised then).
+    def run_binary(self, commands, slot_dir) -> str:
+        output_path = os.path.join(slot_dir, 'output.json')
+        profile = self.current_profile()
+        jobid = get_arg(commands, '--jobid')
+        started = []
+
+        def on_start(process):
+            started.append(process)
+            if jobid:
+                self.deleted_jobs.register(jobid, process)
+        try:
+            with open(output_path, 'wb') as output_file, timed(profile, 'compute'):
+                returncode, read, written, rss = run_measured(
+                    [self.config.integrals_path] + commands, slot_dir, output_file, on_start)
+        finally:
+            for process in started:
+                if jobid:
+                    self.deleted_jobs.unregister(jobid, process)
+        if returncode < 0 and jobid and self.is_job_deleted(jobid):
+            raise JobDeleted(jobid)
+        if profile:
+            profile.bytes_read += read
+            profile.bytes_written += written
+            profile.peak_rss_kb = max(profile.peak_rss_kb, rss)
+        with open(output_path) as output_file:
+            output = output_file.read()
+        logging.info(output)
+        return output
+
+    def upload_output(self, output, s3_path):
+        url = urlparse(s3_path, allow_fragments=False)
+        with timed(self.current_profile(), 'upload'):
+            self.s3.put_object(Bucket=url.netloc, Key=url.path.lstrip('/'), Body=output.encode())
+        self.count_bytes(written=len(output))
+
+    def send_success(self, token, value):
+        profile = self.current_profile()
+        with timed(profile, 'signal'):
+            self.sfn.send_task_success(taskToken=token, output=json.dumps(value))
+        if profile:
+            profile.status = 'success'
+
+    def send_failure(self, token, cause):
+        profile = self.current_profile()
+        with timed(profile, 'signal'):
+            self.sfn.send_task_failure(taskToken=token, cause=cause)
+        if profile:
+            profile.status = 'failed'
+
+    # Profile of the task run by the calling slot thread (None outside of a task)
+    def current_profile(self) -> Optional[TaskProfile]:
+        return getattr(self.profiles, 'current', None)
+
+    # Adds bytes moved by the worker itself (rather than the integrals processes) to the current task's profile
+    def count_bytes(self, read=0, written=0):
+        profile = self.current_profile()
+        if profile:
+            profile.bytes_read += read
+            profile.bytes_written += written
+
+    def delete_message(self, message):
+        self.sqs.delete_message(QueueUrl=message['QueueUrl'], ReceiptHandle=message['ReceiptHandle'])